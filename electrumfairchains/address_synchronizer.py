@@ -24,14 +24,15 @@
 import threading
 import asyncio
 import itertools
+import bisect
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
 
 from . import bitcoin
 from .bitcoin import COINBASE_MATURITY, TYPE_ADDRESS, TYPE_PUBKEY
 from .util import PrintError, profiler, bfh, TxMinedInfo
 from .transaction import Transaction, TxOutput
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
 from .blockchain import hash_header
 from .i18n import _
@@ -77,6 +78,11 @@ class AddressSynchronizer(PrintError):
         self.threadlocal_cache = threading.local()
 
         self._get_addr_balance_cache = {}
+        # maturity height -> addresses whose cached balance has immature coinbase outputs
+        self._balance_cache_maturity = defaultdict(set)  # type: Dict[int, Set[str]]
+        self._balance_cache_height = None
+        # address -> scripthash, shared with the synchronizer
+        self._scripthash_cache = {}  # type: Dict[str, str]
 
         self.load_and_cleanup()
 
@@ -109,16 +115,34 @@ class AddressSynchronizer(PrintError):
                 h.append((tx_hash, tx_height))
         return h
 
+    def get_address_status(self, addr: str) -> Optional[str]:
+        """Return the electrum status hash of the stored history of addr."""
+        status = self.db.get_addr_status(addr)
+        if status is None:
+            hist = self.db.get_addr_history(addr)
+            if hist and hist != ['*']:
+                # wallet from before statuses were stored
+                status = history_status(hist)
+                self.db.set_addr_status(addr, status)
+        return status
+
     def get_address_history_len(self, addr: str) -> int:
         """Return number of transactions where address is involved."""
         return len(self._history_local.get(addr, ()))
 
+    def get_scripthash(self, addr: str) -> str:
+        h = self._scripthash_cache.get(addr)
+        if h is None:
+            h = self._scripthash_cache[addr] = bitcoin.address_to_scripthash(addr)
+        return h
+
     def get_txin_address(self, txi):
         addr = txi.get('address')
         if addr and addr != "(pubkey)":
             return addr
-        prevout_hash = txi.get('prevout_hash')
-        prevout_n = txi.get('prevout_n')
+        return self.get_prevout_address(txi.get('prevout_hash'), txi.get('prevout_n'))
+
+    def get_prevout_address(self, prevout_hash, prevout_n):
         for addr in self.db.get_txo(prevout_hash):
             l = self.db.get_txo_addr(prevout_hash, addr)
             for n, v, is_cb in l:
@@ -151,7 +175,25 @@ class AddressSynchronizer(PrintError):
             self.network.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
 
     def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
+        with self.lock:
+            local_height = self.get_local_height()
+            if self._balance_cache_height is not None and local_height < self._balance_cache_height:
+                # reorg to a shorter chain; coinbase outputs may be immature again
+                self._get_addr_balance_cache = {}
+                self._balance_cache_maturity.clear()
+            else:
+                # only balances with coinbase outputs that just matured change
+                for height in [h for h in self._balance_cache_maturity if h <= local_height]:
+                    for addr in self._balance_cache_maturity.pop(height):
+                        self._get_addr_balance_cache.pop(addr, None)
+            self._balance_cache_height = local_height
+
+    def _invalidate_tx_caches(self, tx_hash):
+        # balances of the addresses tx_hash funds or spends from depend on its height
+        for addr in itertools.chain(self.db.get_txi(tx_hash), self.db.get_txo(tx_hash)):
+            self._get_addr_balance_cache.pop(addr, None)
+        # and so does its position in the history
+        self._history_dirty.add(tx_hash)
 
     def stop_threads(self, write_to_disk=True):
         if self.network:
@@ -168,9 +210,11 @@ class AddressSynchronizer(PrintError):
 
     def add_address(self, address):
         if not self.db.get_addr_history(address):
-            self.db.history[address] = []
+            self.db.set_addr_history(address, [])
             self.set_up_to_date(False)
         if self.synchronizer:
+            # computed here, so that the event loop does not have to
+            self.get_scripthash(address)
             self.synchronizer.add(address)
 
     def get_conflicting_transactions(self, tx_hash, tx):
@@ -181,11 +225,9 @@ class AddressSynchronizer(PrintError):
         """
         conflicting_txns = set()
         with self.transaction_lock:
-            for txin in tx.inputs():
-                if txin['type'] == 'coinbase':
-                    continue
-                prevout_hash = txin['prevout_hash']
-                prevout_n = txin['prevout_n']
+            if tx.is_coinbase():
+                return conflicting_txns
+            for prevout_hash, prevout_n in tx.outpoints():
                 spending_tx_hash = self.db.get_spent_outpoint(prevout_hash, prevout_n)
                 if spending_tx_hash is None:
                     continue
@@ -211,13 +253,17 @@ class AddressSynchronizer(PrintError):
             # BUT we track is_mine inputs in a txn, and during subsequent calls
             # of add_transaction tx, we might learn of more-and-more inputs of
             # being is_mine, as we roll the gap_limit forward
-            is_coinbase = tx.inputs()[0]['type'] == 'coinbase'
+            # only outpoints and outputs are needed here; they are read
+            # without deserializing the input scripts
+            is_coinbase = tx.is_coinbase()
+            outpoints = [] if is_coinbase else tx.outpoints()
             tx_height = self.get_tx_height(tx_hash).height
             if not allow_unrelated:
                 # note that during sync, if the transactions are not properly sorted,
                 # it could happen that we think tx is unrelated but actually one of the inputs is is_mine.
                 # this is the main motivation for allow_unrelated
-                is_mine = any([self.is_mine(self.get_txin_address(txin)) for txin in tx.inputs()])
+                is_mine = any([self.is_mine(self.get_prevout_address(prevout_hash, prevout_n))
+                               for prevout_hash, prevout_n in outpoints])
                 is_for_me = any([self.is_mine(self.get_txout_address(txo)) for txo in tx.outputs()])
                 if not is_mine and not is_for_me:
                     raise UnrelatedTransactionException()
@@ -259,13 +305,9 @@ class AddressSynchronizer(PrintError):
                         if n == prevout_n:
                             if addr and self.is_mine(addr):
                                 self.db.add_txi_addr(tx_hash, addr, ser, v)
-                                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                                self._index_txi(addr, ser, tx_hash)
                             return
-            for txi in tx.inputs():
-                if txi['type'] == 'coinbase':
-                    continue
-                prevout_hash = txi['prevout_hash']
-                prevout_n = txi['prevout_n']
+            for prevout_hash, prevout_n in outpoints:
                 ser = prevout_hash + ':%d' % prevout_n
                 self.db.set_spent_outpoint(prevout_hash, prevout_n, tx_hash)
                 add_value_from_prev_output()
@@ -276,11 +318,12 @@ class AddressSynchronizer(PrintError):
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    self._index_txo(addr, ser, tx_hash, v, is_coinbase)
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, v)
+                        self._index_txi(addr, ser, next_tx)
                         self._add_tx_to_local_history(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
@@ -293,11 +336,9 @@ class AddressSynchronizer(PrintError):
             # undo spends in spent_outpoints
             if tx is not None:
                 # if we have the tx, this branch is faster
-                for txin in tx.inputs():
-                    if txin['type'] == 'coinbase':
-                        continue
-                    prevout_hash = txin['prevout_hash']
-                    prevout_n = txin['prevout_n']
+                if tx.is_coinbase():
+                    return
+                for prevout_hash, prevout_n in tx.outpoints():
                     self.db.remove_spent_outpoint(prevout_hash, prevout_n)
             else:
                 # expensive but always works
@@ -311,8 +352,12 @@ class AddressSynchronizer(PrintError):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi(tx_hash), self.db.get_txo(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+            for addr in self.db.get_txi(tx_hash):
+                for ser, v in self.db.get_txi_addr(tx_hash, addr):
+                    self._unindex_txi(addr, ser, tx_hash)
+            for addr in self.db.get_txo(tx_hash):
+                for n, v, is_cb in self.db.get_txo_addr(tx_hash, addr):
+                    self._unindex_txo(addr, tx_hash + ':%d' % n, tx_hash)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
 
@@ -330,7 +375,7 @@ class AddressSynchronizer(PrintError):
         self.add_unverified_tx(tx_hash, tx_height)
         self.add_transaction(tx_hash, tx, allow_unrelated=True)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def receive_history_callback(self, addr, hist, tx_fees, status=None):
         with self.lock:
             old_hist = self.get_address_history(addr)
             for tx_hash, height in old_hist:
@@ -338,9 +383,10 @@ class AddressSynchronizer(PrintError):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    self._invalidate_tx_caches(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
-            self.db.set_addr_history(addr, hist)
+            self.db.set_addr_history(addr, hist, status)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -361,6 +407,58 @@ class AddressSynchronizer(PrintError):
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             self._add_tx_to_local_history(txid)
+        self._load_coin_index()
+
+    def _load_coin_index(self):
+        # address -> outpoint -> (txid, value, is_coinbase), for coins received by address
+        self._addr_received = defaultdict(dict)  # type: Dict[str, Dict[str, Tuple[str, int, bool]]]
+        # address -> outpoint -> spending txid
+        self._addr_sent = defaultdict(dict)  # type: Dict[str, Dict[str, str]]
+        # address -> outpoint -> (txid, value, is_coinbase), received and not spent
+        self._addr_utxos = defaultdict(dict)  # type: Dict[str, Dict[str, Tuple[str, int, bool]]]
+        self._get_addr_balance_cache = {}
+        self._balance_cache_maturity.clear()
+        # wallet history, see get_history: sorted list of (txpos, txid),
+        # txid -> (txpos, delta), sum of deltas, and txids to re-evaluate
+        self._history_keys = []  # type: List[Tuple[Tuple[int, int], str]]
+        self._history_entries = {}  # type: Dict[str, Tuple[Tuple[int, int], int]]
+        self._history_total = 0
+        self._history_dirty = set()  # type: Set[str]
+        for txid in self.db.list_txo():
+            for addr in self.db.get_txo(txid):
+                for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                    self._index_txo(addr, txid + ':%d' % n, txid, v, is_cb)
+        for txid in self.db.list_txi():
+            for addr in self.db.get_txi(txid):
+                for ser, v in self.db.get_txi_addr(txid, addr):
+                    self._index_txi(addr, ser, txid)
+
+    def _index_txo(self, addr, ser, txid, v, is_cb):
+        self._addr_received[addr][ser] = (txid, v, is_cb)
+        if ser not in self._addr_sent[addr]:
+            self._addr_utxos[addr][ser] = (txid, v, is_cb)
+        self._get_addr_balance_cache.pop(addr, None)
+        self._history_dirty.add(txid)
+
+    def _unindex_txo(self, addr, ser, txid):
+        self._addr_received[addr].pop(ser, None)
+        self._addr_utxos[addr].pop(ser, None)
+        self._get_addr_balance_cache.pop(addr, None)
+        self._history_dirty.add(txid)
+
+    def _index_txi(self, addr, ser, spending_txid):
+        self._addr_sent[addr][ser] = spending_txid
+        self._addr_utxos[addr].pop(ser, None)
+        self._get_addr_balance_cache.pop(addr, None)
+        self._history_dirty.add(spending_txid)
+
+    def _unindex_txi(self, addr, ser, spending_txid):
+        self._addr_sent[addr].pop(ser, None)
+        coin = self._addr_received[addr].get(ser)
+        if coin is not None:
+            self._addr_utxos[addr][ser] = coin
+        self._get_addr_balance_cache.pop(addr, None)
+        self._history_dirty.add(spending_txid)
 
     @profiler
     def check_history(self):
@@ -392,6 +490,7 @@ class AddressSynchronizer(PrintError):
         with self.lock:
             with self.transaction_lock:
                 self.db.clear_history()
+                self._load_coin_index()
                 self.storage.write()
 
     def get_txpos(self, tx_hash):
@@ -418,11 +517,37 @@ class AddressSynchronizer(PrintError):
                 self.threadlocal_cache.local_height = orig_val
         return f
 
+    def _update_history_index(self):
+        """Re-evaluates the position and delta of the txs that changed since
+        the last call, keeping the wallet history sorted by txpos."""
+        dirty = self._history_dirty
+        self._history_dirty = set()
+        keys = self._history_keys
+        rebuild = len(dirty) > len(keys) // 4
+        for txid in dirty:
+            old = self._history_entries.pop(txid, None)
+            if old is not None:
+                old_txpos, old_delta = old
+                self._history_total -= old_delta
+                if not rebuild:
+                    del keys[bisect.bisect_left(keys, (old_txpos, txid))]
+            if not self.db.get_txi(txid) and not self.db.get_txo(txid):
+                continue
+            txpos, delta = self.get_txpos(txid), self.get_tx_value(txid)
+            self._history_entries[txid] = (txpos, delta)
+            self._history_total += delta
+            if not rebuild:
+                bisect.insort(keys, (txpos, txid))
+        if rebuild:
+            self._history_keys = sorted((txpos, txid) for txid, (txpos, delta)
+                                        in self._history_entries.items())
+
     @with_local_height_cached
-    def get_history(self, domain=None):
-        # get domain
+    def get_history(self, domain=None, *, limit=None):
+        """Returns a list of (txid, tx_mined_status, delta, balance), oldest first.
+        If limit is given, only the newest limit entries are returned."""
         if domain is None:
-            domain = self.get_addresses()
+            return self._get_wallet_history(limit)
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -458,6 +583,26 @@ class AddressSynchronizer(PrintError):
             self.print_error("Error: history not synchronized")
             return []
 
+        return h2[-limit:] if limit else h2
+
+    def _get_wallet_history(self, limit):
+        with self.lock, self.transaction_lock:
+            self._update_history_index()
+            c, u, x = self.get_balance()
+            balance = c + u + x
+            # fixme: this may happen if history is incomplete
+            if balance != self._history_total:
+                self.print_error("Error: history not synchronized")
+                return []
+            keys = self._history_keys
+            if limit:
+                keys = keys[-limit:]
+            h2 = []
+            for txpos, tx_hash in reversed(keys):
+                delta = self._history_entries[tx_hash][1]
+                h2.append((tx_hash, self.get_tx_height(tx_hash), delta, balance))
+                balance -= delta
+        h2.reverse()
         return h2
 
     def _add_tx_to_local_history(self, txid):
@@ -499,11 +644,14 @@ class AddressSynchronizer(PrintError):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self._invalidate_tx_caches(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self._invalidate_tx_caches(tx_hash)
                 self.unverified_tx[tx_hash] = tx_height
 
     def remove_unverified_tx(self, tx_hash, tx_height):
@@ -511,12 +659,14 @@ class AddressSynchronizer(PrintError):
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._invalidate_tx_caches(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._invalidate_tx_caches(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -536,6 +686,7 @@ class AddressSynchronizer(PrintError):
                     header = blockchain.read_header(tx_height)
                     if not header or hash_header(header) != info.header_hash:
                         self.db.remove_verified_tx(tx_hash)
+                        self._invalidate_tx_caches(tx_hash)
                         # NOTE: we should add these txns to self.unverified_tx,
                         # but with what height?
                         # If on the new fork after the reorg, the txn is at the
@@ -677,26 +828,20 @@ class AddressSynchronizer(PrintError):
 
     def get_addr_io(self, address):
         with self.lock, self.transaction_lock:
-            h = self.get_address_history(address)
             received = {}
             sent = {}
-            for tx_hash, height in h:
-                l = self.db.get_txo_addr(tx_hash, address)
-                for n, v, is_cb in l:
-                    received[tx_hash + ':%d'%n] = (height, v, is_cb)
-            for tx_hash, height in h:
-                l = self.db.get_txi_addr(tx_hash, address)
-                for txi, v in l:
-                    sent[txi] = height
+            for ser, (tx_hash, v, is_cb) in self._addr_received.get(address, {}).items():
+                received[ser] = (self.get_tx_height(tx_hash).height, v, is_cb)
+            for ser, tx_hash in self._addr_sent.get(address, {}).items():
+                sent[ser] = self.get_tx_height(tx_hash).height
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
+        with self.lock, self.transaction_lock:
+            coins = list(self._addr_utxos.get(address, {}).items())
         out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
+        for txo, (tx_hash, value, is_cb) in coins:
+            tx_height = self.get_tx_height(tx_hash).height
             prevout_hash, prevout_n = txo.split(':')
             x = {
                 'address':address,
@@ -729,11 +874,13 @@ class AddressSynchronizer(PrintError):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
         local_height = self.get_local_height()
+        maturity_heights = set()
         for txo, (tx_height, v, is_cb) in received.items():
             if txo in excluded_coins:
                 continue
             if is_cb and tx_height + COINBASE_MATURITY > local_height:
                 x += v
+                maturity_heights.add(tx_height + COINBASE_MATURITY)
             elif tx_height > 0:
                 c += v
             else:
@@ -747,8 +894,12 @@ class AddressSynchronizer(PrintError):
         # cache result.
         if not excluded_coins:
             # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_addr_balance_cache[address] = result
+            # removed from history, if the height of one changes,
+            # or when a coinbase output matures
+            with self.lock:
+                self._get_addr_balance_cache[address] = result
+                for height in maturity_heights:
+                    self._balance_cache_maturity[height].add(address)
         return result
 
     @with_local_height_cached
@@ -94,6 +94,31 @@ def _CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: bytes)
     return child_pubkey, child_chaincode
 
 
+@protect_against_invalid_ecpoint
+def _CKD_pub_from_ecpubkey(parent: ecc.ECPubkey, parent_pubkey: bytes, parent_chaincode: bytes,
+                           child_index: int) -> bytes:
+    I = hmac_oneshot(parent_chaincode, parent_pubkey + child_index.to_bytes(4, 'big'), hashlib.sha512)
+    pubkey = ecc.ECPrivkey(I[0:32]) + parent
+    if pubkey.is_at_infinity():
+        raise ecc.InvalidECPointException()
+    return pubkey.get_public_key_bytes(compressed=True)
+
+
+def derive_child_pubkeys(parent: ecc.ECPubkey, parent_chaincode: bytes,
+                         child_indexes: Iterable[int]) -> List[bytes]:
+    """Compressed public keys of several non-hardened children of the same
+    parent, as CKD_pub would return them. The parent point is not decoded
+    again for every child.
+    """
+    parent_pubkey = parent.get_public_key_bytes(compressed=True)
+    pubkeys = []
+    for child_index in child_indexes:
+        if child_index < 0: raise ValueError('the bip32 index needs to be non-negative')
+        if child_index & BIP32_PRIME: raise Exception('not possible to derive hardened child from parent pubkey')
+        pubkeys.append(_CKD_pub_from_ecpubkey(parent, parent_pubkey, parent_chaincode, child_index))
+    return pubkeys
+
+
 def xprv_header(xtype: str, *, net=None) -> bytes:
     if net is None:
         net = FairChains
@@ -411,8 +411,8 @@ def address_to_script(addr: str, *, net=None) -> str:
         raise BitcoinException(f'unknown address type: {addrtype}')
     return script
 
-def address_to_scripthash(addr: str) -> str:
-    script = address_to_script(addr)
+def address_to_scripthash(addr: str, *, net=None) -> str:
+    script = address_to_script(addr, net=net)
     return script_to_scripthash(script)
 
 def script_to_scripthash(script: str) -> str:
@@ -437,9 +437,7 @@ def base_encode(v: bytes, base: int) -> str:
     chars = __b58chars
     if base == 43:
         chars = __b43chars
-    long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * c
+    long_value = int.from_bytes(v, 'big')
     result = bytearray()
     while long_value >= base:
         div, mod = divmod(long_value, base)
@@ -529,13 +527,14 @@ WIF_SCRIPT_TYPES_INV = inv_dict(WIF_SCRIPT_TYPES)
 
 
 def serialize_privkey(secret: bytes, compressed: bool, txin_type: str,
-                      internal_use: bool=False) -> str:
+                      internal_use: bool=False, *, net=None) -> str:
+    if net is None: net = FairChains
     # we only export secrets inside curve range
     secret = ecc.ECPrivkey.normalize_secret_bytes(secret)
     if internal_use:
-        prefix = bytes([(WIF_SCRIPT_TYPES[txin_type] + FairChains.WIF_PREFIX) & 255])
+        prefix = bytes([(WIF_SCRIPT_TYPES[txin_type] + net.WIF_PREFIX) & 255])
     else:
-        prefix = bytes([FairChains.WIF_PREFIX])
+        prefix = bytes([net.WIF_PREFIX])
     suffix = b'\01' if compressed else b''
     vchIn = prefix + secret + suffix
     base58_wif = EncodeBase58Check(vchIn)
@@ -545,7 +544,8 @@ def serialize_privkey(secret: bytes, compressed: bool, txin_type: str,
         return '{}:{}'.format(txin_type, base58_wif)
 
 
-def deserialize_privkey(key: str) -> Tuple[str, bytes, bool]:
+def deserialize_privkey(key: str, *, net=None) -> Tuple[str, bytes, bool]:
+    if net is None: net = FairChains
     if is_minikey(key):
         return 'p2pkh', minikey_to_private_key(key), False
 
@@ -563,14 +563,14 @@ def deserialize_privkey(key: str) -> Tuple[str, bytes, bool]:
 
     if txin_type is None:
         # keys exported in version 3.0.x encoded script type in first byte
-        prefix_value = vch[0] - FairChains.WIF_PREFIX
+        prefix_value = vch[0] - net.WIF_PREFIX
         try:
             txin_type = WIF_SCRIPT_TYPES_INV[prefix_value]
         except KeyError:
             raise BitcoinException('invalid prefix ({}) for WIF key (1)'.format(vch[0]))
     else:
         # all other keys must have a fixed first byte
-        if vch[0] != FairChains.WIF_PREFIX:
+        if vch[0] != net.WIF_PREFIX:
             raise BitcoinException('invalid prefix ({}) for WIF key (2)'.format(vch[0]))
 
     if len(vch) not in [33, 34]:
@@ -582,14 +582,14 @@ def deserialize_privkey(key: str) -> Tuple[str, bytes, bool]:
     return txin_type, secret_bytes, compressed
 
 
-def is_compressed_privkey(sec: str) -> bool:
-    return deserialize_privkey(sec)[2]
+def is_compressed_privkey(sec: str, *, net=None) -> bool:
+    return deserialize_privkey(sec, net=net)[2]
 
 
-def address_from_private_key(sec: str) -> str:
-    txin_type, privkey, compressed = deserialize_privkey(sec)
+def address_from_private_key(sec: str, *, net=None) -> str:
+    txin_type, privkey, compressed = deserialize_privkey(sec, net=net)
     public_key = ecc.ECPrivkey(privkey).get_public_key_hex(compressed=compressed)
-    return pubkey_to_address(txin_type, public_key)
+    return pubkey_to_address(txin_type, public_key, net=net)
 
 def is_segwit_address(addr: str, *, net=None) -> bool:
     if net is None: net = FairChains
@@ -615,9 +615,9 @@ def is_address(addr: str, *, net=None) -> bool:
            or is_b58_address(addr, net=net)
 
 
-def is_private_key(key: str) -> bool:
+def is_private_key(key: str, *, net=None) -> bool:
     try:
-        k = deserialize_privkey(key)
+        k = deserialize_privkey(key, net=net)
         return k is not False
     except:
         return False
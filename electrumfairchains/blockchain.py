@@ -21,11 +21,15 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import mmap
+import time
+import hashlib
 import threading
 from typing import Optional, Dict, Mapping, Sequence
 
 from . import util
-from .bitcoin import hash_encode, int_to_hex, rev_hex
+from . import metrics
+from .bitcoin import hash_encode, hash_decode, int_to_hex, rev_hex
 from .crypto import sha256d
 from . import constants
 from .util import bfh, bh2u
@@ -33,6 +37,11 @@ from .simple_config import SimpleConfig, FairChains
 
 
 HEADER_SIZE = 108  # bytes
+HASH_SIZE = 32  # bytes
+NULL_HEADER = bytes(HEADER_SIZE)
+# appended headers are buffered and fsynced in groups, see HeaderStore.append
+HEADERS_FLUSH_INTERVAL = 10  # seconds
+HEADERS_FLUSH_BYTES = 4 * 2016 * HEADER_SIZE
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 CHUNK_SIZE  = 2016
 
@@ -80,19 +89,148 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
 
+class HeaderStore:
+    """Read-only, memory-mapped view of a headers file, with a write-behind
+    buffer for appended headers.
+
+    The mapping is created lazily and recreated when a header past its
+    end is requested (i.e. the file has grown). Block hashes are memoized
+    in a flat bytearray, one HASH_SIZE slot per header, stored in display
+    (reversed) byte order. A zeroed slot means 'not computed yet'.
+
+    Appended headers are kept in memory and written to the file (with a
+    single fsync) once HEADERS_FLUSH_BYTES are pending or the oldest of them
+    is HEADERS_FLUSH_INTERVAL seconds old. Reads see the pending headers.
+    A crash can only lose that unsynced tail, which is downloaded again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._hashes = bytearray()
+        self._pending = bytearray()
+        self._pending_offset = 0  # file offset of self._pending
+        self._pending_since = None  # type: Optional[float]
+
+    def close(self) -> None:
+        """Release the mapping. Must be called before the file
+        is truncated, replaced or deleted."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def invalidate(self, index: int = 0) -> None:
+        """Release the mapping and forget the hashes of headers
+        at and after index. Pending headers must have been flushed."""
+        assert not self._pending
+        self.close()
+        del self._hashes[index * HASH_SIZE:]
+
+    def pending_size(self) -> int:
+        return len(self._pending)
+
+    def append(self, data: bytes, offset: int) -> None:
+        """Appends data at offset, which must be the end of the file
+        including pending headers."""
+        if self._pending:
+            assert offset == self._pending_offset + len(self._pending), offset
+        else:
+            self._pending_offset = offset
+            self._pending_since = time.monotonic()
+        self._pending += data
+        if len(self._pending) >= HEADERS_FLUSH_BYTES:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self) -> None:
+        if self._pending and time.monotonic() - self._pending_since >= HEADERS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes pending headers to the file and fsyncs it."""
+        if not self._pending:
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(self._pending_offset)
+            f.write(self._pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = bytearray()
+        self._pending_since = None
+
+    def _get_mmap(self, min_size: int) -> Optional[mmap.mmap]:
+        if self._mmap is not None and len(self._mmap) >= min_size:
+            return self._mmap
+        self.close()
+        if os.path.getsize(self.path) < min_size:
+            return None
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read(self, index: int) -> bytes:
+        """Returns the raw header at position index in the file."""
+        start = index * HEADER_SIZE
+        if self._pending and start >= self._pending_offset:
+            start -= self._pending_offset
+            h = bytes(self._pending[start:start + HEADER_SIZE])
+            if len(h) < HEADER_SIZE:
+                raise Exception('Expected to read a full header at index {}'.format(index))
+            return h
+        m = self._get_mmap(start + HEADER_SIZE)
+        if m is None:
+            raise Exception('Expected to read a full header at index {}'.format(index))
+        return m[start:start + HEADER_SIZE]
+
+    def get_hash(self, index: int) -> Optional[bytes]:
+        """Returns the block hash (display byte order) of the header at
+        position index, or None if that header is not in the file."""
+        start = index * HASH_SIZE
+        h = self._hashes[start:start + HASH_SIZE]
+        if len(h) == HASH_SIZE and any(h):
+            return bytes(h)
+        raw = self.read(index)
+        if raw == NULL_HEADER:
+            return None
+        h = sha256d(raw)[::-1]
+        self.set_hash(index, h)
+        return h
+
+    def set_hash(self, index: int, header_hash: bytes) -> None:
+        """Primes the hash index with an already known block hash."""
+        assert len(header_hash) == HASH_SIZE, len(header_hash)
+        start = index * HASH_SIZE
+        missing = start + HASH_SIZE - len(self._hashes)
+        if missing > 0:
+            self._hashes.extend(bytes(missing))
+        self._hashes[start:start + HASH_SIZE] = header_hash
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
+# (chains of the default FairChain; those of others are kept per genesis hash)
 blockchains = {}  # type: Dict[str, Blockchain]
 blockchains_lock = threading.RLock()
+_other_blockchains = {}  # type: Dict[str, Dict[str, Blockchain]]
+
+
+def get_blockchains(net=None) -> Dict[str, 'Blockchain']:
+    if net is None or net.GENESIS == FairChains.GENESIS:
+        return blockchains
+    with blockchains_lock:
+        return _other_blockchains.setdefault(net.GENESIS, {})
 
 
 def read_blockchains(config: 'SimpleConfig'):
+    net = config.net
+    chains = get_blockchains(net)
     best_chain = Blockchain(config=config,
                             forkpoint=0,
                             parent=None,
-                            forkpoint_hash=FairChains.GENESIS,
+                            forkpoint_hash=net.GENESIS,
                             prev_hash=None)
-    blockchains[FairChains.GENESIS] = best_chain
+    chains[net.GENESIS] = best_chain
     # consistency checks
     # if best_chain.height() > constants.net.max_checkpoint():  # fork management skipped in FairChains because of PoC
     if best_chain.height() > 0:
@@ -100,6 +238,7 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(0+1) # fork management skipped in FairChains because of PoC
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             util.print_error("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.reset_header_store()
             os.unlink(best_chain.path())
             best_chain.update_size()
     # forks
@@ -109,8 +248,10 @@ def read_blockchains(config: 'SimpleConfig'):
     l = filter(lambda x: x.startswith('fork2_') and '.' not in x, os.listdir(fdir))
     l = sorted(l, key=lambda x: int(x.split('_')[1]))  # sort by forkpoint
 
-    def delete_chain(filename, reason):
+    def delete_chain(filename, reason, chain=None):
         util.print_error(f"[blockchain] deleting chain {filename}: {reason}")
+        if chain is not None:
+            chain.reset_header_store()
         os.unlink(os.path.join(fdir, filename))
 
     def instantiate_chain(filename):
@@ -124,7 +265,7 @@ def read_blockchains(config: 'SimpleConfig'):
             delete_chain(filename, "deleting fork below max checkpoint")
             return
         # find parent (sorting by forkpoint guarantees it's already instantiated)
-        for parent in blockchains.values():
+        for parent in chains.values():
             if parent.check_hash(forkpoint - 1, prev_hash):
                 break
         else:
@@ -138,21 +279,29 @@ def read_blockchains(config: 'SimpleConfig'):
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h):
-            delete_chain(filename, "incorrect first hash for chain")
+            delete_chain(filename, "incorrect first hash for chain", b)
             return
         if not b.parent.can_connect(h, check_height=False):
-            delete_chain(filename, "cannot connect chain to parent")
+            delete_chain(filename, "cannot connect chain to parent", b)
             return
         chain_id = b.get_id()
         assert first_hash == chain_id, (first_hash, chain_id)
-        blockchains[chain_id] = b
+        chains[chain_id] = b
 
     for filename in l:
         instantiate_chain(filename)
 
 
-def get_best_chain() -> 'Blockchain':
-    return blockchains[FairChains.GENESIS]
+def get_best_chain(net=None) -> 'Blockchain':
+    return get_blockchains(net)[(net or FairChains).GENESIS]
+
+
+def flush_blockchains(force: bool=True, net=None) -> None:
+    """Writes headers buffered by any chain to disk. If not force,
+    only those that have been pending for HEADERS_FLUSH_INTERVAL."""
+    with blockchains_lock: chains = list(get_blockchains(net).values())
+    for b in chains:
+        b.flush(force)
 
 # block hash -> chain work; up to and including that block
 _CHAINWORK_CACHE = {
@@ -174,11 +323,13 @@ class Blockchain(util.PrintError):
         if 0 < forkpoint <= 0:
             raise Exception(f"cannot fork below max checkpoint. forkpoint: {forkpoint}")
         self.config = config
+        self.net = config.net
         self.forkpoint = forkpoint  # height of first header
         self.parent = parent
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._store = HeaderStore(self.path())
         self.update_size()
 
     def with_lock(func):
@@ -189,7 +340,7 @@ class Blockchain(util.PrintError):
 
     @property
     def checkpoints(self):
-        return FairChains.CHECKPOINTS
+        return self.net.CHECKPOINTS
 
     def get_max_child(self) -> Optional[int]:
         children = self.get_direct_children()
@@ -204,7 +355,7 @@ class Blockchain(util.PrintError):
 
     def get_direct_children(self) -> Sequence['Blockchain']:
         with blockchains_lock:
-            return list(filter(lambda y: y.parent==self, blockchains.values()))
+            return list(filter(lambda y: y.parent==self, get_blockchains(self.net).values()))
 
     def get_parent_heights(self) -> Mapping['Blockchain', int]:
         """Returns map: (parent chain -> height of last common block)"""
@@ -265,7 +416,7 @@ class Blockchain(util.PrintError):
         # save_header might have already put it there but that's OK
         chain_id = self.get_id()
         with blockchains_lock:
-            blockchains[chain_id] = self
+            get_blockchains(self.net)[chain_id] = self
         return self
 
     @with_lock
@@ -279,7 +430,26 @@ class Blockchain(util.PrintError):
     @with_lock
     def update_size(self) -> None:
         p = self.path()
-        self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        file_size = os.path.getsize(p) if os.path.exists(p) else 0
+        self._size = (file_size + self._store.pending_size()) // HEADER_SIZE
+
+    @with_lock
+    def flush(self, force: bool=True) -> None:
+        """Writes buffered headers to disk; if not force, only
+        if they have been pending for long enough."""
+        if force:
+            self._store.flush()
+        else:
+            self._store.flush_if_due()
+
+    @with_lock
+    def reset_header_store(self) -> None:
+        """Flushes buffered headers, then drops the mapping and the hash
+        index of the headers file. Call this before the file is replaced
+        or removed from outside."""
+        self._store.flush()
+        self._store.close()
+        self._store = HeaderStore(self.path())
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
@@ -295,21 +465,35 @@ class Blockchain(util.PrintError):
         #if block_hash_as_num > target:
         #    raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
-    def verify_chunk(self, index: int, data: bytes) -> None:
+    def verify_chunk(self, index: int, data: bytes) -> Optional[str]:
+        """Verifies the raw headers of chunk index without deserializing them.
+        Returns the hash of the last header in the chunk (None if empty).
+        """
         num = len(data) // HEADER_SIZE
         start_height = index * 2016
-        prev_hash = self.get_hash(start_height - 1)
-        target = self.get_target(index-1)
+        # note: there is no proof-of-work to check in FairChains, see verify_header
+        data = memoryview(data)
+        sha256 = hashlib.sha256
+        prev_hash = hash_decode(self.get_hash(start_height - 1))
+        header_hash = None
         for i in range(num):
             height = start_height + i
-            try:
-                expected_header_hash = self.get_hash(height)
-            except MissingHeader:
-                expected_header_hash = None
             raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+            header_hash = sha256(sha256(raw_header).digest()).digest()
+            if height == 0:
+                expected_header_hash = hash_decode(self.net.GENESIS)
+            else:
+                expected_header_hash = self._get_hash_bytes(height)
+                if expected_header_hash is not None:
+                    expected_header_hash = expected_header_hash[::-1]
+            if expected_header_hash is not None and expected_header_hash != header_hash:
+                raise Exception("hash mismatches with expected: {} vs {}"
+                                .format(hash_encode(expected_header_hash), hash_encode(header_hash)))
+            if raw_header[4:36] != prev_hash:
+                raise Exception("prev hash mismatch: %s vs %s"
+                                % (hash_encode(prev_hash), hash_encode(bytes(raw_header[4:36]))))
+            prev_hash = header_hash
+        return hash_encode(header_hash) if header_hash is not None else None
 
     @with_lock
     def path(self):
@@ -325,13 +509,13 @@ class Blockchain(util.PrintError):
         return os.path.join(d, filename)
 
     @with_lock
-    def save_chunk(self, index: int, chunk: bytes):
+    def save_chunk(self, index: int, chunk: bytes, tip_hash: str=None):
         assert index >= 0, index
         chunk_within_checkpoint_region = index < len(self.checkpoints)
         # chunks in checkpoint region are the responsibility of the 'main chain'
         if chunk_within_checkpoint_region and self.parent is not None:
-            main_chain = get_best_chain()
-            main_chain.save_chunk(index, chunk)
+            main_chain = get_best_chain(self.net)
+            main_chain.save_chunk(index, chunk, tip_hash)
             return
 
         delta_height = (index * 2016 - self.forkpoint)
@@ -343,6 +527,9 @@ class Blockchain(util.PrintError):
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
         self.write(chunk, delta_bytes, truncate)
+        if tip_hash is not None and len(chunk) >= HEADER_SIZE:
+            tip_index = (delta_bytes + len(chunk)) // HEADER_SIZE - 1
+            self._store.set_hash(tip_index, bfh(tip_hash))
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -355,7 +542,7 @@ class Blockchain(util.PrintError):
                     break
                 # make sure we are making progress
                 cnt += 1
-                if cnt > len(blockchains):
+                if cnt > len(get_blockchains(self.net)):
                     raise Exception(f'swapping fork with parent too many times: {cnt}')
                 # we might have become the parent of some of our former siblings
                 for old_sibling in old_parent.get_direct_children():
@@ -380,6 +567,8 @@ class Blockchain(util.PrintError):
         # swap files
         # child takes parent's name
         # parent's new name will be something new (not child's old name)
+        self._store.flush()
+        parent._store.flush()
         self.assert_headers_file_available(self.path())
         child_old_name = self.path()
         with open(self.path(), 'rb') as f:
@@ -398,14 +587,19 @@ class Blockchain(util.PrintError):
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self._store.close()
+        parent._store.close()
         os.replace(child_old_name, parent.path())
+        self.reset_header_store()
+        parent.reset_header_store()
         self.update_size()
         parent.update_size()
         # update pointers
-        blockchains.pop(child_old_id, None)
-        blockchains.pop(parent_old_id, None)
-        blockchains[self.get_id()] = self
-        blockchains[parent.get_id()] = parent
+        chains = get_blockchains(self.net)
+        chains.pop(child_old_id, None)
+        chains.pop(parent_old_id, None)
+        chains[self.get_id()] = self
+        chains[parent.get_id()] = parent
         return True
 
     def get_id(self) -> str:
@@ -423,8 +617,15 @@ class Blockchain(util.PrintError):
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        if offset == self._size * HEADER_SIZE:
+            # append: buffered, see HeaderStore.append
+            self._store.append(data, offset)
+            self.update_size()
+            return
+        self._store.flush()
+        self._store.invalidate(offset // HEADER_SIZE)
         with open(filename, 'rb+') as f:
-            if truncate and offset != self._size * HEADER_SIZE:
+            if truncate:
                 f.seek(offset)
                 f.truncate()
             f.seek(offset)
@@ -454,15 +655,21 @@ class Blockchain(util.PrintError):
         delta = height - self.forkpoint
         name = self.path()
         self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
+        h = self._store.read(delta)
+        if h == NULL_HEADER:
             return None
         return deserialize_header(h, height)
 
+    @with_lock
+    def _get_hash_bytes(self, height: int) -> Optional[bytes]:
+        if height < 0:
+            return None
+        if height < self.forkpoint:
+            return self.parent._get_hash_bytes(height)
+        if height > self.height():
+            return None
+        return self._store.get_hash(height - self.forkpoint)
+
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
         height = self.height()
@@ -478,16 +685,16 @@ class Blockchain(util.PrintError):
         if height == -1:
             return '0000000000000000000000000000000000000000000000000000000000000000'
         elif height == 0:
-            return FairChains.GENESIS
+            return self.net.GENESIS
         elif is_height_checkpoint():
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
+            header_hash = self._get_hash_bytes(height)
+            if header_hash is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return bh2u(header_hash)
 
     def get_target(self, index: int) -> int:
         # compute target from chunk x, used in chunk x+1
@@ -572,7 +779,7 @@ class Blockchain(util.PrintError):
             #self.print_error("cannot connect at height", height)
             return False
         if height == 0:
-            return hash_header(header) == FairChains.GENESIS
+            return hash_header(header) == self.net.GENESIS
         try:
             prev_hash = self.get_hash(height - 1)
         except:
@@ -593,12 +800,14 @@ class Blockchain(util.PrintError):
         assert idx >= 0, idx
         try:
             data = bfh(hexdata)
-            self.verify_chunk(idx, data)
-            #self.print_error("validated chunk %d" % idx)
-            self.save_chunk(idx, data)
+            with metrics.timer('header_chunk_connect_seconds'):
+                tip_hash = self.verify_chunk(idx, data)
+                #self.print_error("validated chunk %d" % idx)
+                self.save_chunk(idx, data, tip_hash)
             return True
         except BaseException as e:
             self.print_error(f'verify_chunk idx {idx} failed: {repr(e)}')
+            metrics.inc('header_chunk_failures_total')
             return False
 
     def get_checkpoints(self):
@@ -612,18 +821,18 @@ class Blockchain(util.PrintError):
         return cp
 
 
-def check_header(header: dict) -> Optional[Blockchain]:
+def check_header(header: dict, net=None) -> Optional[Blockchain]:
     if type(header) is not dict:
         return None
-    with blockchains_lock: chains = list(blockchains.values())
+    with blockchains_lock: chains = list(get_blockchains(net).values())
     for b in chains:
         if b.check_header(header):
             return b
     return None
 
 
-def can_connect(header: dict) -> Optional[Blockchain]:
-    with blockchains_lock: chains = list(blockchains.values())
+def can_connect(header: dict, net=None) -> Optional[Blockchain]:
+    with blockchains_lock: chains = list(get_blockchains(net).values())
     for b in chains:
         if b.can_connect(header):
             return b
@@ -24,11 +24,12 @@
 # SOFTWARE.
 from collections import defaultdict
 from math import floor, log10
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Optional
 
 from .bitcoin import sha256, COIN, TYPE_ADDRESS, is_address
 from .transaction import Transaction, TxOutput
 from .util import NotEnoughFunds, PrintError
+from . import metrics
 
 
 # A simple deterministic PRNG.  Used to deterministically shuffle a
@@ -78,6 +79,12 @@ class Bucket(NamedTuple):
     witness: bool       # whether any coin uses segwit
 
 
+class SelectionCosts(NamedTuple):
+    target: int             # value the buckets must add up to, net of their fees
+    fee_per_weight: float   # marginal fee of one weight unit
+    cost_of_change: int     # fee of creating a change output and spending it later
+
+
 def strip_unneeded(bkts, sufficient_funds):
     '''Remove buckets that are unnecessary in achieving the spend amount'''
     bkts = sorted(bkts, key = lambda bkt: bkt.value)
@@ -238,9 +245,12 @@ class CoinChooserBase(PrintError):
             return total_input >= spent_amount + fee_estimator_w(total_weight)
 
         # Collect the coins into buckets, choose a subset of the buckets
-        buckets = self.bucketize_coins(coins)
-        buckets = self.choose_buckets(buckets, sufficient_funds,
-                                      self.penalty_func(tx))
+        with metrics.timer('coin_selection_seconds', chooser=type(self).__name__):
+            buckets = self.bucketize_coins(coins)
+            self.costs = self.selection_costs(buckets, base_weight, input_value, spent_amount,
+                                              change_addrs, fee_estimator_w)
+            buckets = self.choose_buckets(buckets, sufficient_funds,
+                                          self.penalty_func(tx))
 
         tx.add_inputs([coin for b in buckets for coin in b.coins])
         tx_weight = get_tx_weight(buckets)
@@ -263,6 +273,20 @@ class CoinChooserBase(PrintError):
 
         return tx
 
+    def selection_costs(self, buckets, base_weight, input_value, spent_amount,
+                        change_addrs, fee_estimator_w):
+        # the fee estimator need not be linear; use the marginal rate
+        # over a large weight, and check the final selection exactly
+        fee_per_weight = (fee_estimator_w(base_weight + 400000) - fee_estimator_w(base_weight)) / 400000
+        target = spent_amount - input_value + fee_estimator_w(base_weight)
+        change_addr = change_addrs[0] if change_addrs else None
+        if not change_addr and buckets:
+            change_addr = buckets[0].coins[0]['address']
+        output_weight = 4 * Transaction.estimated_output_size(change_addr) if change_addr else 4 * 34
+        input_weight = min((bkt.weight // len(bkt.coins) for bkt in buckets), default=4 * 148)
+        cost_of_change = int(fee_per_weight * (output_weight + input_weight))
+        return SelectionCosts(target, fee_per_weight, cost_of_change)
+
     def choose_buckets(self, buckets, sufficient_funds, penalty_func):
         raise NotImplemented('To be subclassed')
 
@@ -380,8 +404,95 @@ class CoinChooserPrivacy(CoinChooserRandom):
         return penalty
 
 
+def branch_and_bound(values: List[int], fees: List[int], target: int,
+                     cost_of_change: int, max_waste: int, max_tries: int) -> Optional[List[int]]:
+    '''Depth-first search for a subset of values, which must be positive
+    and sorted in decreasing order, that adds up to between target and
+    target + cost_of_change. fees[i] is the fee paid to spend values[i].
+    Returns the indexes of the subset with the least waste, i.e. excess
+    plus fees, below max_waste found within max_tries steps, or None.'''
+    n = len(values)
+    remaining = [0] * (n + 1)  # sum of values[i:]
+    for i in reversed(range(n)):
+        remaining[i] = remaining[i + 1] + values[i]
+    if remaining[0] < target:
+        return None
+    best, best_waste = None, max_waste
+    selected = []
+    value = fee = 0
+    i = 0
+    for tries in range(max_tries):
+        if (value + remaining[i] < target or value > target + cost_of_change
+                or fee >= best_waste):
+            backtrack = True
+        elif value >= target:
+            waste = value - target + fee
+            if waste < best_waste:
+                best, best_waste = list(selected), waste
+            backtrack = True
+        else:
+            backtrack = False
+        if backtrack:
+            if not selected:
+                break
+            # try the branch without the last selected value; skipping
+            # equal values, whose branches would be the same
+            j = selected.pop()
+            value -= values[j]
+            fee -= fees[j]
+            i = j + 1
+            while i < n and values[i] == values[j] and fees[i] == fees[j]:
+                i += 1
+        else:
+            selected.append(i)
+            value += values[i]
+            fee += fees[i]
+            i += 1
+    return best
+
+
+class CoinChooserBranchAndBound(CoinChooserPrivacy):
+    """Looks for a set of coins that pays the amount and the fee almost
+    exactly, so that no change output is needed, when that is cheaper
+    than creating change.
+    Coins are grouped by address as in the Privacy chooser, and the search
+    is over the value of each group minus the fee to spend it. It prefers
+    confirmed coins. If no such set is found, the Privacy chooser is used.
+    """
+
+    max_tries = 100000
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        costs = self.costs
+        def fee(bkt):
+            return int(bkt.weight * costs.fee_per_weight)
+        num_searched = 0
+        for allowed in [lambda bkt: bkt.min_height > 0,
+                        lambda bkt: bkt.min_height >= 0,
+                        lambda bkt: True]:
+            bkts = [bkt for bkt in buckets if allowed(bkt) and bkt.value > fee(bkt)]
+            if len(bkts) == num_searched:
+                continue
+            num_searched = len(bkts)
+            bkts.sort(key=lambda bkt: bkt.value - fee(bkt), reverse=True)
+            fees = [fee(bkt) for bkt in bkts]
+            values = [bkt.value - f for bkt, f in zip(bkts, fees)]
+            # any selection with change pays at least this much
+            max_waste = min(fees) + costs.cost_of_change
+            found = branch_and_bound(values, fees, costs.target, costs.cost_of_change,
+                                     max_waste, self.max_tries)
+            if found is not None:
+                winner = [bkts[i] for i in found]
+                if sufficient_funds(winner):
+                    self.print_error("Bucket sets:", len(buckets))
+                    self.print_error("Exact match with excess:", sum(values[i] for i in found) - costs.target)
+                    return winner
+        return super().choose_buckets(buckets, sufficient_funds, penalty_func)
+
+
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
 }
 
 def get_name(config):
@@ -34,7 +34,7 @@ from functools import wraps
 from decimal import Decimal
 from typing import Optional, TYPE_CHECKING
 
-from .import util, ecc
+from .import util, ecc, metrics
 from .util import bfh, bh2u, format_satoshis, json_decode, print_error, json_encode, is_hash256_str
 from . import bitcoin
 from .bitcoin import is_address,  hash_160, COIN, TYPE_ADDRESS
@@ -44,7 +44,7 @@ from .i18n import _
 from .transaction import Transaction, multisig_script, TxOutput
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .synchronizer import Notifier
-from .storage import WalletStorage
+from .storage import WalletStorage, convert_wallet_file
 from . import keystore
 from .wallet import Wallet, Imported_Wallet, Abstract_Wallet, create_new_wallet, restore_wallet_from_text
 from .address_synchronizer import TX_HEIGHT_LOCAL
@@ -69,6 +69,7 @@ class Command:
         self.requires_network = 'n' in s
         self.requires_wallet = 'w' in s
         self.requires_password = 'p' in s
+        self.modifies_wallet = 'm' in s
         self.description = func.__doc__
         self.help = self.description.split('.')[0] if self.description else None
         varnames = func.__code__.co_varnames[1:func.__code__.co_argcount]
@@ -145,7 +146,8 @@ class Commands:
                               passphrase=passphrase,
                               password=password,
                               encrypt_file=encrypt_file,
-                              segwit=segwit)
+                              segwit=segwit,
+                              db_type=self.config.get('wallet_db', 'json'))
         return {
             'seed': d['seed'],
             'path': d['wallet'].storage.path,
@@ -164,13 +166,24 @@ class Commands:
                                      passphrase=passphrase,
                                      password=password,
                                      encrypt_file=encrypt_file,
-                                     network=self.network)
+                                     network=self.network,
+                                     db_type=self.config.get('wallet_db', 'json'))
         return {
             'path': d['wallet'].storage.path,
             'msg': d['msg'],
         }
 
-    @command('wp')
+    @command('')
+    def convert_wallet(self, db_type):
+        """Convert the wallet file to another format: 'json', or 'sqlite' for
+        wallets with a very large history. The original file is kept with a
+        '.bak' suffix. New wallets use the format of the 'wallet_db' config
+        option."""
+        path = self.config.get_wallet_path()
+        backup_path = convert_wallet_file(path, db_type)
+        return {'path': path, 'backup': backup_path}
+
+    @command('wpm')
     def password(self, password=None, new_password=None):
         """Change wallet password. """
         if self.wallet.storage.is_encrypted_with_hw_device() and new_password:
@@ -220,7 +233,7 @@ class Commands:
         """Return the transaction history of any address. Note: This is a
         walletless server query, results are not checked by SPV.
         """
-        sh = bitcoin.address_to_scripthash(address)
+        sh = bitcoin.address_to_scripthash(address, net=self.network.net)
         return self.network.run_from_another_thread(self.network.get_history_for_scripthash(sh))
 
     @command('w')
@@ -238,7 +251,7 @@ class Commands:
         """Returns the UTXO list of any address. Note: This
         is a walletless server query, results are not checked by SPV.
         """
-        sh = bitcoin.address_to_scripthash(address)
+        sh = bitcoin.address_to_scripthash(address, net=self.network.net)
         return self.network.run_from_another_thread(self.network.listunspent_for_scripthash(sh))
 
     @command('')
@@ -306,12 +319,12 @@ class Commands:
         address = bitcoin.hash160_to_p2sh(hash_160(bfh(redeem_script)))
         return {'address':address, 'redeemScript':redeem_script}
 
-    @command('w')
+    @command('wm')
     def freeze(self, address):
         """Freeze address. Freeze the funds at one of your wallet\'s addresses"""
         return self.wallet.set_frozen_state_of_addresses([address], True)
 
-    @command('w')
+    @command('wm')
     def unfreeze(self, address):
         """Unfreeze address. Unfreeze the funds at one of your wallet\'s address"""
         return self.wallet.set_frozen_state_of_addresses([address], False)
@@ -362,7 +375,7 @@ class Commands:
         """Return the balance of any address. Note: This is a walletless
         server query, results are not checked by SPV.
         """
-        sh = bitcoin.address_to_scripthash(address)
+        sh = bitcoin.address_to_scripthash(address, net=self.network.net)
         out = self.network.run_from_another_thread(self.network.get_balance_for_scripthash(sh))
         out["confirmed"] =  str(Decimal(out["confirmed"])/COIN)
         out["unconfirmed"] =  str(Decimal(out["unconfirmed"])/COIN)
@@ -385,6 +398,15 @@ class Commands:
         from .version import EFC_VERSION
         return EFC_VERSION
 
+    @command('')
+    def getmetrics(self):
+        """Return the counters, gauges and latency percentiles collected
+        by the daemon. Requires the 'metrics' config option."""
+        registry = metrics.get_registry()
+        if registry is None:
+            raise Exception("Metrics are disabled. Run 'setconfig metrics true' and restart the daemon.")
+        return registry.snapshot()
+
     @command('w')
     def getmpk(self):
         """Get master public key. Return your wallet\'s master public key"""
@@ -410,7 +432,7 @@ class Commands:
         s = self.wallet.get_seed(password)
         return s
 
-    @command('wp')
+    @command('wpm')
     def importprivkey(self, privkey, password=None):
         """Import a private key."""
         if not self.wallet.can_import_privkey():
@@ -479,7 +501,7 @@ class Commands:
             self.wallet.sign_transaction(tx, password)
         return tx
 
-    @command('wp')
+    @command('wpm')
     def payto(self, destination, amount, fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, rbf=None, password=None, locktime=None):
         """Create a transaction. """
         tx_fee = satoshis(fee)
@@ -487,7 +509,7 @@ class Commands:
         tx = self._mktx([(destination, amount)], tx_fee, change_addr, domain, nocheck, unsigned, rbf, password, locktime)
         return tx.as_dict()
 
-    @command('wp')
+    @command('wpm')
     def paytomany(self, outputs, fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False, rbf=None, password=None, locktime=None):
         """Create a multi-output transaction. """
         tx_fee = satoshis(fee)
@@ -517,7 +539,7 @@ class Commands:
             kwargs['fx'] = fx
         return json_encode(self.wallet.get_full_history(**kwargs))
 
-    @command('w')
+    @command('wm')
     def setlabel(self, key, label):
         """Assign a label to an item. Item may be a bitcoin address or a
         transaction ID"""
@@ -633,7 +655,7 @@ class Commands:
             out = list(filter(lambda x: x.get('status')==f, out))
         return list(map(self._format_request, out))
 
-    @command('w')
+    @command('wm')
     def createnewaddress(self):
         """Create a new receiving address, beyond the gap limit of the wallet"""
         return self.wallet.create_new_address(False)
@@ -644,7 +666,7 @@ class Commands:
         An address is considered as used if it has received a transaction, or if it is used in a payment request."""
         return self.wallet.get_unused_address()
 
-    @command('w')
+    @command('wm')
     def addrequest(self, amount, memo='', expiration=None, force=False):
         """Create a payment request, using the first unused address of the wallet.
         The address will be considered as used after this operation.
@@ -662,7 +684,7 @@ class Commands:
         out = self.wallet.get_payment_request(addr, self.config)
         return self._format_request(out)
 
-    @command('w')
+    @command('wm')
     def addtransaction(self, tx):
         """ Add a transaction to the wallet history """
         tx = Transaction(tx)
@@ -671,7 +693,7 @@ class Commands:
         self.wallet.storage.write()
         return tx.txid()
 
-    @command('wp')
+    @command('wpm')
     def signrequest(self, address, password=None):
         "Sign payment request with an OpenAlias"
         alias = self.config.get('alias')
@@ -680,12 +702,12 @@ class Commands:
         alias_addr = self.wallet.contacts.resolve(alias)['address']
         self.wallet.sign_payment_request(address, alias, alias_addr, password)
 
-    @command('w')
+    @command('wm')
     def rmrequest(self, address):
         """Remove a payment request"""
         return self.wallet.remove_payment_request(address, self.config)
 
-    @command('w')
+    @command('wm')
     def clearrequests(self):
         """Remove all payment requests"""
         for k in list(self.wallet.receive_requests.keys()):
@@ -723,7 +745,7 @@ class Commands:
             fee_level = Decimal(fee_level)
         return self.config.fee_per_kb(dyn=dyn, mempool=mempool, fee_level=fee_level)
 
-    @command('w')
+    @command('wm')
     def removelocaltx(self, txid):
         """Remove a 'local' transaction from the wallet, and its dependent
         transactions.
@@ -785,6 +807,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in FAIR).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'db_type': 'Wallet file format: json or sqlite',
 }
 
 command_options = {
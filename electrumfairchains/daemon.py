@@ -24,26 +24,32 @@
 # SOFTWARE.
 import asyncio
 import ast
+import concurrent.futures
 import os
 import time
 import traceback
 import sys
 import threading
+from functools import wraps
 from typing import Dict, Optional, Tuple
 
 import jsonrpclib
 
-from .jsonrpc import VerifyingJSONRPCServer
+from .jsonrpc import VerifyingJSONRPCServer, AsyncJSONRPCServer
 from .version import EFC_VERSION
 from .network import Network
 from .util import (json_decode, DaemonThread, print_error, to_string,
-                   create_and_start_event_loop, profiler, standardize_path)
+                   create_and_start_event_loop, profiler, standardize_path,
+                   http_session_pool)
 from .wallet import Wallet, Abstract_Wallet
 from .storage import WalletStorage
 from .commands import known_commands, Commands
-from .simple_config import SimpleConfig
+from .simple_config import SimpleConfig, FairChains, set_config, set_config_global
+from .constants import FairChains_Collection
 from .exchange_rate import FxThread
 from .plugin import run_hook
+from .signing_pool import init_signing_pool, set_signing_pool
+from . import metrics
 
 
 def get_lockfile(config: SimpleConfig):
@@ -129,6 +135,7 @@ class Daemon(DaemonThread):
             fd, server = get_fd_or_server(config)
             if fd is None: raise Exception('failed to lock daemon; already running?')
         self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        metrics.init_metrics(config)
         if config.get('offline'):
             self.network = None
         else:
@@ -137,43 +144,146 @@ class Daemon(DaemonThread):
         self.fx = FxThread(config, self.network)
         if self.network:
             self.network.start([self.fx.run])
+        # FairChain name -> Network; all of them share the event loop
+        self.networks = {}  # type: Dict[str, Network]
+        self._fairchain_lockfile_fds = []
+        self._fairchain_lockfiles = []
+        if self.network:
+            self.networks[config.net.FAIRCHAIN] = self.network
+            self.init_fairchains(config, listen_jsonrpc)
+        init_signing_pool(config)
         self.gui = None
         # path -> wallet;   make sure path is standardized.
         self.wallets = {}  # type: Dict[str, Abstract_Wallet]
+        # commands that modify a wallet are serialized per wallet;
+        # loading and closing wallets is serialized daemon-wide
+        self._wallet_locks = {}  # type: Dict[str, threading.Lock]
+        self._daemon_lock = threading.Lock()
         # Setup JSONRPC server
         self.server = None
         if listen_jsonrpc:
             self.init_server(config, fd)
+        self.metrics_server = None
+        if metrics.is_enabled():
+            metrics.get_registry().add_collector(self.collect_metrics)
+            self.init_metrics_server(config)
         self.start()
 
+    def get_fairchain_config(self, fairchain) -> SimpleConfig:
+        options = dict(self.config.cmdline_options, selected_fairchain=fairchain)
+        if options.get('efc_path'):
+            options['efc_path'] = options['efc_path'] + '.' + fairchain
+        return SimpleConfig(options)
+
+    def init_fairchains(self, config: SimpleConfig, listen_jsonrpc):
+        '''Starts a Network for each of the other FairChains listed in
+        config 'fairchains'. Only the wallets of the selected FairChain
+        can be loaded; the others are served for walletless commands.'''
+        for fairchain in config.get('fairchains', []):
+            if fairchain in self.networks:
+                continue
+            if fairchain not in FairChains_Collection.FAIRCHAINS.values():
+                self.print_error('unknown FairChain', fairchain)
+                continue
+            chain_config = self.get_fairchain_config(fairchain)
+            if listen_jsonrpc:
+                # clients of that FairChain look for the daemon there
+                fd, server = get_fd_or_server(chain_config)
+                if fd is None:
+                    self.print_error('FairChain', fairchain, 'is served by another daemon')
+                    continue
+                self._fairchain_lockfile_fds.append(fd)
+                self._fairchain_lockfiles.append(get_lockfile(chain_config))
+            network = Network(chain_config)
+            network._loop_thread = self._loop_thread
+            network.start()
+            self.networks[fairchain] = network
+        # creating the other configs replaced the singletons
+        set_config(config)
+        set_config_global(config)
+
     def init_server(self, config: SimpleConfig, fd):
         host = config.get('rpchost', '127.0.0.1')
         port = config.get('rpcport', 0)
         rpc_user, rpc_password = get_rpc_credentials(config)
         try:
-            server = VerifyingJSONRPCServer((host, port), logRequests=False,
-                                            rpc_user=rpc_user, rpc_password=rpc_password)
+            if config.get('rpc_async', False):
+                server = AsyncJSONRPCServer(host, port, rpc_user=rpc_user, rpc_password=rpc_password,
+                                            max_workers=config.get('rpc_max_workers', 16))
+                asyncio.run_coroutine_threadsafe(server.start(), self.asyncio_loop).result()
+                sockname = server.getsockname()
+            else:
+                server = VerifyingJSONRPCServer((host, port), logRequests=False,
+                                                rpc_user=rpc_user, rpc_password=rpc_password)
+                server.timeout = 0.1
+                sockname = server.socket.getsockname()
         except Exception as e:
             self.print_error('Warning: cannot initialize RPC server on host', host, e)
             self.server = None
-            os.close(fd)
+            for fd in [fd] + self._fairchain_lockfile_fds:
+                os.close(fd)
             return
-        os.write(fd, bytes(repr((server.socket.getsockname(), time.time())), 'utf8'))
-        os.close(fd)
+        for fd in [fd] + self._fairchain_lockfile_fds:
+            os.write(fd, bytes(repr((sockname, time.time())), 'utf8'))
+            os.close(fd)
         self.server = server
-        server.timeout = 0.1
         server.register_function(self.ping, 'ping')
         server.register_function(self.run_gui, 'gui')
         server.register_function(self.run_daemon, 'daemon')
         self.cmd_runner = Commands(self.config, None, self.network)
-        for cmdname in known_commands:
-            server.register_function(getattr(self.cmd_runner, cmdname), cmdname)
+        for cmdname, cmd in known_commands.items():
+            func = getattr(self.cmd_runner, cmdname)
+            if cmd.modifies_wallet:
+                func = self._with_current_wallet_lock(func)
+            server.register_function(func, cmdname)
         server.register_function(self.run_cmdline, 'run_cmdline')
 
+    def init_metrics_server(self, config: SimpleConfig):
+        port = config.get('metrics_port')
+        if port is None:
+            return
+        host = config.get('metrics_host', '127.0.0.1')
+        server = metrics.PrometheusServer(host, port)
+        try:
+            asyncio.run_coroutine_threadsafe(server.start(), self.asyncio_loop).result()
+        except Exception as e:
+            self.print_error('Warning: cannot initialize metrics server on host', host, e)
+            return
+        self.print_error('serving metrics on', server.getsockname())
+        self.metrics_server = server
+
+    def collect_metrics(self, registry: metrics.MetricsRegistry):
+        registry.gauge('wallets_loaded').set(len(self.wallets))
+        for fairchain, network in list(self.networks.items()):
+            registry.gauge('network_interfaces', fairchain=fairchain).set(len(network.get_interfaces()))
+            registry.gauge('network_height', fairchain=fairchain).set(network.get_local_height())
+            registry.gauge('header_sync_rate', fairchain=fairchain).set(network.get_header_sync_rate())
+        for host, stats in http_session_pool.get_host_stats().items():
+            for key in ['requests', 'errors', 'connections_created', 'connections_reused']:
+                registry.gauge('http_' + key, host=host).set(stats[key])
+
     def ping(self):
         return True
 
+    def get_wallet_lock(self, path) -> threading.Lock:
+        path = standardize_path(path)
+        return self._wallet_locks.setdefault(path, threading.Lock())
+
+    def _with_current_wallet_lock(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            wallet = self.cmd_runner.wallet
+            if wallet is None:
+                return func(*args, **kwargs)
+            with self.get_wallet_lock(wallet.storage.path):
+                return func(*args, **kwargs)
+        return wrapper
+
     def run_daemon(self, config_options):
+        with self._daemon_lock:
+            return self._run_daemon(config_options)
+
+    def _run_daemon(self, config_options):
         asyncio.set_event_loop(self.asyncio_loop)
         config = SimpleConfig(config_options)
         sub = config.get('subcommand')
@@ -214,6 +324,7 @@ class Daemon(DaemonThread):
                                 for k, w in self.wallets.items()},
                     'current_wallet': current_wallet_path,
                     'fee_per_kb': self.config.fee_per_kb(),
+                    'fairchains': sorted(self.networks),
                 }
             else:
                 response = "Daemon offline"
@@ -223,6 +334,10 @@ class Daemon(DaemonThread):
         return response
 
     def run_gui(self, config_options):
+        with self._daemon_lock:
+            return self._run_gui(config_options)
+
+    def _run_gui(self, config_options):
         config = SimpleConfig(config_options)
         if self.gui:
             if hasattr(self.gui, 'new_window'):
@@ -255,6 +370,9 @@ class Daemon(DaemonThread):
             return
         if storage.get_action():
             return
+        if storage.net is not FairChains:
+            self.print_error('cannot load wallet of FairChain', storage.net.FAIRCHAIN)
+            return
         wallet = Wallet(storage)
         wallet.start_network(self.network)
         self.wallets[path] = wallet
@@ -287,9 +405,12 @@ class Daemon(DaemonThread):
         password = config_options.get('password')
         new_password = config_options.get('new_password')
         config = SimpleConfig(config_options)
+        network = self.networks.get(config.net.FAIRCHAIN)
+        if network is None:
+            return {'error': 'FairChain "%s" is not served by this daemon' % config.net.FAIRCHAIN}
         # FIXME this is ugly...
-        config.fee_estimates = self.network.config.fee_estimates.copy()
-        config.mempool_fees  = self.network.config.mempool_fees.copy()
+        config.fee_estimates = network.config.fee_estimates.copy()
+        config.mempool_fees  = network.config.mempool_fees.copy()
         cmdname = config.get('cmd')
         cmd = known_commands[cmdname]
         if cmd.requires_wallet:
@@ -300,6 +421,8 @@ class Daemon(DaemonThread):
                 return {'error': 'Wallet "%s" is not loaded. Use "efc daemon load_wallet"'%os.path.basename(path) }
         else:
             wallet = None
+            if cmdname == 'convert_wallet' and standardize_path(config.get_wallet_path()) in self.wallets:
+                return {'error': 'Close the wallet before converting it'}
         # arguments passed to function
         args = map(lambda x: config.get(x), cmd.params)
         # decode json arguments
@@ -308,23 +431,37 @@ class Daemon(DaemonThread):
         kwargs = {}
         for x in cmd.options:
             kwargs[x] = (config_options.get(x) if x in ['password', 'new_password'] else config.get(x))
-        cmd_runner = Commands(config, wallet, self.network)
+        cmd_runner = Commands(config, wallet, network)
         func = getattr(cmd_runner, cmd.name)
         try:
-            result = func(*args, **kwargs)
+            if cmd.modifies_wallet:
+                with self.get_wallet_lock(path):
+                    result = func(*args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
         except TypeError as e:
             raise Exception("Wrapping TypeError to prevent JSONRPC-Pelix from hiding traceback") from e
         return result
 
     def run(self):
         while self.is_running():
-            self.server.handle_request() if self.server else time.sleep(0.1)
+            if isinstance(self.server, VerifyingJSONRPCServer):
+                self.server.handle_request()
+            else:
+                time.sleep(0.1)
+        if isinstance(self.server, AsyncJSONRPCServer):
+            asyncio.run_coroutine_threadsafe(self.server.stop(), self.asyncio_loop).result()
+        if self.metrics_server:
+            asyncio.run_coroutine_threadsafe(self.metrics_server.stop(), self.asyncio_loop).result()
         # stop network/wallets
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
         if self.network:
             self.print_error("shutting down network")
-            self.network.stop()
+            for network in self.networks.values():
+                network.stop()
+        set_signing_pool(None)
+        concurrent.futures.wait(http_session_pool.reset(), timeout=1)
         # stop event loop
         self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
         self._loop_thread.join(timeout=1)
@@ -335,6 +472,8 @@ class Daemon(DaemonThread):
             self.gui.stop()
         self.print_error("stopping, removing lockfile")
         remove_lockfile(get_lockfile(self.config))
+        for lockfile in self._fairchain_lockfiles:
+            remove_lockfile(lockfile)
         DaemonThread.stop(self)
 
     def init_gui(self, config, plugins):
@@ -354,7 +354,7 @@ class ECPrivkey(ECPubkey):
         self.secret_scalar = secret
 
         point = generator_secp256k1 * secret
-        super().__init__(point_to_ser(point))
+        super().__init__(point_to_ser(point, compressed=False))  # faster than compressed
         self._privkey = ecdsa.ecdsa.Private_key(self._pubkey, secret)
 
     @classmethod
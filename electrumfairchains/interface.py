@@ -26,10 +26,11 @@ import os
 import re
 import ssl
 import sys
+import time
 import traceback
 import asyncio
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional
-from collections import defaultdict
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Dict
+from collections import defaultdict, deque
 
 import aiorpcx
 from aiorpcx import RPCSession, Notification
@@ -37,6 +38,7 @@ import certifi
 
 from .util import PrintError, ignore_exceptions, log_exceptions, bfh, SilentTaskGroup
 from . import util
+from . import metrics
 from . import x509
 from . import pem
 from . import version
@@ -52,6 +54,10 @@ if TYPE_CHECKING:
 ca_path = certifi.where()
 
 
+# requests an interface must have answered before its latency is used
+MIN_LATENCY_SAMPLES = 10
+
+
 class NetworkTimeout:
     # seconds
     class Generic:
@@ -101,15 +107,24 @@ class NotificationSession(RPCSession):
         async with self.in_flight_requests_semaphore:
             msg_id = self._get_and_inc_msg_counter()
             self.maybe_log(f"<-- {args} {kwargs} (id: {msg_id})")
+            t0 = time.monotonic()
             try:
-                response = await asyncio.wait_for(
-                    super().send_request(*args, **kwargs),
-                    timeout)
+                with metrics.timer('server_request_seconds', method=args[0]):
+                    response = await asyncio.wait_for(
+                        super().send_request(*args, **kwargs),
+                        timeout)
             except asyncio.TimeoutError as e:
+                metrics.inc('server_request_errors_total', method=args[0])
                 raise RequestTimedOut(f'request timed out: {args} (id: {msg_id})') from e
+            except Exception:
+                metrics.inc('server_request_errors_total', method=args[0])
+                raise
             else:
                 self.maybe_log(f"--> {response} (id: {msg_id})")
                 return response
+            finally:
+                if self.interface:
+                    self.interface.note_request_latency(time.monotonic() - t0)
 
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
         # note: until the cache is written for the first time,
@@ -123,6 +138,60 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_many(self, method: str, params_list: List[List], queue: asyncio.Queue):
+        """Like subscribe, for many params at once. The requests that
+        are not answered from the cache are sent as one JSON-RPC batch.
+        If the batch fails, none of the subscriptions are kept and
+        nothing is put on the queue, so that the caller can retry them.
+        """
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+        to_send = [params for params, key in zip(params_list, keys) if key not in self.cache]
+        if to_send:
+            try:
+                results = await self.send_batch_request(method, to_send)
+            except BaseException:
+                for key in keys:
+                    self.subscriptions[key].remove(queue)
+                raise
+            for params, result in zip(to_send, results):
+                self.cache[self.get_hashable_key_for_rpc_call(method, params)] = result
+        for params, key in zip(params_list, keys):
+            await queue.put(params + [self.cache[key]])
+
+    async def send_batch_request(self, method: str, params_list: List[List], *,
+                                 timeout=None, raise_errors=True) -> List:
+        """Sends one request per params as a single JSON-RPC batch,
+        and returns the results in order. If raise_errors is False,
+        error responses are returned in place, as RPCError instances.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+
+        async def send():
+            async with self.send_batch() as batch:
+                for params in params_list:
+                    batch.add_request(method, params)
+            return batch.results
+
+        # the batch is one message on the wire, so it takes one slot
+        async with self.in_flight_requests_semaphore:
+            msg_id = self._get_and_inc_msg_counter()
+            self.maybe_log(f"<-- batch of {len(params_list)} {method} (id: {msg_id})")
+            try:
+                with metrics.timer('server_batch_request_seconds', method=method):
+                    results = await asyncio.wait_for(send(), timeout)
+            except asyncio.TimeoutError as e:
+                metrics.inc('server_request_errors_total', method=method)
+                raise RequestTimedOut(f'batch request timed out: {method} (id: {msg_id})') from e
+        if raise_errors:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        self.maybe_log(f"--> batch of {len(results)} results (id: {msg_id})")
+        return list(results)
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -182,6 +251,7 @@ class Interface(PrintError):
         self.port = int(self.port)
         assert network.config.path
         self.cert_path = os.path.join(network.config.path, 'certs', self.host)
+        self.net = network.config.net
         self.blockchain = None
         self._requested_chunks = set()
         self.network = network
@@ -190,6 +260,8 @@ class Interface(PrintError):
 
         self.tip_header = None
         self.tip = 0
+        # round trip times of the recent single requests, in seconds
+        self._latencies = deque(maxlen=200)
 
         # Dump network messages (only for this interface).  Set at runtime from the console.
         self.debug = False
@@ -201,6 +273,17 @@ class Interface(PrintError):
     def diagnostic_name(self):
         return self.host
 
+    def note_request_latency(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def get_latency_percentile(self, p: float) -> Optional[float]:
+        """p-th percentile of the recent request round trips, in seconds.
+        None until there are enough of them to tell."""
+        latencies = sorted(self._latencies)
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
     def _set_proxy(self, proxy: dict):
         if proxy:
             username, pw = proxy.get('user'), proxy.get('password')
@@ -325,9 +408,9 @@ class Interface(PrintError):
             return
 
         assert self.tip_header
-        chain = blockchain.check_header(self.tip_header)
+        chain = blockchain.check_header(self.tip_header, self.net)
         if not chain:
-            self.blockchain = blockchain.get_best_chain()
+            self.blockchain = blockchain.get_best_chain(self.net)
         else:
             self.blockchain = chain
         assert self.blockchain is not None
@@ -393,8 +476,80 @@ class Interface(PrintError):
         conn = self.blockchain.connect_chunk(index, res['hex'])
         if not conn:
             return conn, 0
+        self.network.note_headers_synced(res['count'])
         return conn, res['count']
 
+    def _get_header_sync_sources(self) -> List['Interface']:
+        """Connected interfaces on our blockchain that can serve catch-up
+        chunks. self comes first."""
+        with self.network.interfaces_lock:
+            interfaces = list(self.network.interfaces.values())
+        others = [iface for iface in interfaces
+                  if iface is not self and iface.blockchain is self.blockchain
+                  and iface.ready.done() and not iface.ready.cancelled()
+                  and iface.session and not iface.session.is_closing()]
+        return [self] + others
+
+    async def request_chunks_pipelined(self, height: int, tip: int) -> Tuple[bool, int]:
+        """Catches up from height to tip keeping up to header_sync_window
+        'blockchain.block.headers' requests in flight, spread over the
+        connected interfaces. Chunks are still verified and saved strictly
+        in order. A chunk from another server that does not connect is
+        requested again from our own server.
+        Returns (could_connect, height of the next header to fetch).
+        """
+        window = self.network.get_header_sync_window()
+        sources = self._get_header_sync_sources()
+        first_index, last_index = height // 2016, tip // 2016
+
+        def chunk_size(index):
+            return max(0, min(2016, tip - index * 2016 + 1))
+
+        async def fetch(index, iface):
+            params = [index * 2016, chunk_size(index)]
+            if iface is self:
+                return await self.session.send_request('blockchain.block.headers', params)
+            try:
+                return await iface.session.send_request('blockchain.block.headers', params)
+            except (aiorpcx.jsonrpc.RPCError, RequestTimedOut, OSError, AttributeError) as e:
+                self.print_error(f"chunk {index} from {iface.host} failed: {repr(e)}")
+                return await self.session.send_request('blockchain.block.headers', params)
+
+        def pick_source(index):
+            candidates = [iface for iface in sources if iface.tip >= index * 2016 + chunk_size(index) - 1]
+            return candidates[index % len(candidates)] if candidates else self
+
+        pending = {}  # type: Dict[int, asyncio.Future]
+        next_index = first_index
+        index = first_index
+        try:
+            while index <= last_index:
+                while next_index <= last_index and len(pending) < window:
+                    self._requested_chunks.add(next_index)
+                    pending[next_index] = asyncio.ensure_future(fetch(next_index, pick_source(next_index)))
+                    next_index += 1
+                res = await pending.pop(index)
+                conn = self.blockchain.connect_chunk(index, res['hex'])
+                if not conn:
+                    res = await fetch(index, self)
+                    conn = self.blockchain.connect_chunk(index, res['hex'])
+                if not conn:
+                    return index != first_index, height
+                self._requested_chunks.discard(index)
+                self.network.note_headers_synced(res['count'])
+                self.network.trigger_callback('network_updated')
+                height = index * 2016 + res['count']
+                if res['count'] < chunk_size(index):
+                    break
+                index += 1
+        finally:
+            for fut in pending.values():
+                fut.cancel()
+            await asyncio.gather(*pending.values(), return_exceptions=True)
+            for i in range(first_index, next_index):
+                self._requested_chunks.discard(i)
+        return True, height
+
     async def open_session(self, sslc, exit_early=False):
         async with aiorpcx.Connector(NotificationSession,
                                      host=self.host, port=self.port,
@@ -471,7 +626,11 @@ class Interface(PrintError):
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                if self.network.get_header_sync_window() > 1 and next_height // 2016 > height // 2016:
+                    could_connect, new_height = await self.request_chunks_pipelined(height, next_height)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
+                    new_height = (height // 2016 * 2016) + num_headers
                 if not could_connect:
                     # if height <= constants.net.max_checkpoint():
                     if height <= 0: # fork management skipped in FairChains because of PoC
@@ -479,7 +638,7 @@ class Interface(PrintError):
                     last, height = await self.step(height)
                     continue
                 self.network.trigger_callback('network_updated')
-                height = (height // 2016 * 2016) + num_headers
+                height = new_height
                 assert height <= next_height+1, (height, self.tip)
                 last = 'catchup'
             else:
@@ -492,7 +651,7 @@ class Interface(PrintError):
         if header is None:
             header = await self.get_block_header(height, 'catchup')
 
-        chain = blockchain.check_header(header) if 'mock' not in header else header['mock']['check'](header)
+        chain = blockchain.check_header(header, self.net) if 'mock' not in header else header['mock']['check'](header)
         if chain:
             self.blockchain = chain if isinstance(chain, Blockchain) else self.blockchain
             # note: there is an edge case here that is not handled.
@@ -501,12 +660,12 @@ class Interface(PrintError):
             # this situation resolves itself on the next block
             return 'catchup', height+1
 
-        can_connect = blockchain.can_connect(header) if 'mock' not in header else header['mock']['connect'](height)
+        can_connect = blockchain.can_connect(header, self.net) if 'mock' not in header else header['mock']['connect'](height)
         if not can_connect:
             self.print_error("can't connect", height)
             height, header, bad, bad_header = await self._search_headers_backwards(height, header)
-            chain = blockchain.check_header(header) if 'mock' not in header else header['mock']['check'](header)
-            can_connect = blockchain.can_connect(header) if 'mock' not in header else header['mock']['connect'](height)
+            chain = blockchain.check_header(header, self.net) if 'mock' not in header else header['mock']['check'](header)
+            can_connect = blockchain.can_connect(header, self.net) if 'mock' not in header else header['mock']['connect'](height)
             assert chain or can_connect
         if can_connect:
             self.print_error("could connect", height)
@@ -521,7 +680,7 @@ class Interface(PrintError):
 
     async def _search_headers_binary(self, height, bad, bad_header, chain):
         assert bad == bad_header['block_height']
-        _assert_header_does_not_check_against_any_chain(bad_header)
+        _assert_header_does_not_check_against_any_chain(bad_header, self.net)
 
         self.blockchain = chain if isinstance(chain, Blockchain) else self.blockchain
         good = height
@@ -530,7 +689,7 @@ class Interface(PrintError):
             height = (good + bad) // 2
             self.print_error("binary step. good {}, bad {}, height {}".format(good, bad, height))
             header = await self.get_block_header(height, 'binary')
-            chain = blockchain.check_header(header) if 'mock' not in header else header['mock']['check'](header)
+            chain = blockchain.check_header(header, self.net) if 'mock' not in header else header['mock']['check'](header)
             if chain:
                 self.blockchain = chain if isinstance(chain, Blockchain) else self.blockchain
                 good = height
@@ -544,7 +703,7 @@ class Interface(PrintError):
         real = not mock and self.blockchain.can_connect(bad_header, check_height=False)
         if not real and not mock:
             raise Exception('unexpected bad header during binary: {}'.format(bad_header))
-        _assert_header_does_not_check_against_any_chain(bad_header)
+        _assert_header_does_not_check_against_any_chain(bad_header, self.net)
 
         self.print_error("binary search exited. good {}, bad {}".format(good, bad))
         return good, bad, bad_header
@@ -552,7 +711,7 @@ class Interface(PrintError):
     async def _resolve_potential_chain_fork_given_forkpoint(self, good, bad, bad_header):
         assert good + 1 == bad
         assert bad == bad_header['block_height']
-        _assert_header_does_not_check_against_any_chain(bad_header)
+        _assert_header_does_not_check_against_any_chain(bad_header, self.net)
         # 'good' is the height of a block 'good_header', somewhere in self.blockchain.
         # bad_header connects to good_header; bad_header itself is NOT in self.blockchain.
 
@@ -582,8 +741,8 @@ class Interface(PrintError):
                 height = 0
                 checkp = True
             header = await self.get_block_header(height, 'backward')
-            chain = blockchain.check_header(header) if 'mock' not in header else header['mock']['check'](header)
-            can_connect = blockchain.can_connect(header) if 'mock' not in header else header['mock']['connect'](height)
+            chain = blockchain.check_header(header, self.net) if 'mock' not in header else header['mock']['check'](header)
+            can_connect = blockchain.can_connect(header, self.net) if 'mock' not in header else header['mock']['connect'](height)
             if chain or can_connect:
                 return False
             if checkp:
@@ -591,8 +750,8 @@ class Interface(PrintError):
             return True
 
         bad, bad_header = height, header
-        _assert_header_does_not_check_against_any_chain(bad_header)
-        with blockchain.blockchains_lock: chains = list(blockchain.blockchains.values())
+        _assert_header_does_not_check_against_any_chain(bad_header, self.net)
+        with blockchain.blockchains_lock: chains = list(blockchain.get_blockchains(self.net).values())
         local_max = max([0] + [x.height() for x in chains]) if 'mock' not in header else float('inf')
         height = min(local_max + 1, height - 1)
         while await iterate():
@@ -600,13 +759,13 @@ class Interface(PrintError):
             delta = self.tip - height
             height = self.tip - 2 * delta
 
-        _assert_header_does_not_check_against_any_chain(bad_header)
+        _assert_header_does_not_check_against_any_chain(bad_header, self.net)
         self.print_error("exiting backward mode at", height)
         return height, header, bad, bad_header
 
 
-def _assert_header_does_not_check_against_any_chain(header: dict) -> None:
-    chain_bad = blockchain.check_header(header) if 'mock' not in header else header['mock']['check'](header)
+def _assert_header_does_not_check_against_any_chain(header: dict, net=None) -> None:
+    chain_bad = blockchain.check_header(header, net) if 'mock' not in header else header['mock']['check'](header)
     if chain_bad:
         raise Exception('bad_header must not check!')
 
@@ -28,7 +28,7 @@ import json
 import copy
 import threading
 from collections import defaultdict
-from typing import Dict, Optional
+from typing import Dict, Optional, List, Set, Tuple
 
 from . import util, bitcoin
 from .util import PrintError, profiler, WalletFileException, multisig_type, TxMinedInfo
@@ -42,6 +42,36 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 18     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+# The wallet file is a JSON snapshot, optionally followed by journal records,
+# one per line: ["set", path, value] or ["del", path], where path is a list of
+# one or two keys into the db. The journal is folded into a new snapshot once
+# it grows larger than the snapshot (and at least this many bytes):
+JOURNAL_COMPACT_MIN_BYTES = 64 * 1024
+
+_MISSING = object()
+
+# keys of the wallet history, which the db classes store in their own way
+HISTORY_KEYS = ('txi', 'txo', 'spent_outpoints', 'transactions',
+                'addr_history', 'addr_status', 'verified_tx3', 'tx_fees')
+
+# values of these types are stored and returned without copying
+IMMUTABLE_TYPES = (str, int, float, bool)
+
+
+def modifier(func):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            self._modified = True
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def locked(func):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
 
 class JsonDBJsonEncoder(util.MyEncoder):
     def default(self, obj):
@@ -50,59 +80,64 @@ class JsonDBJsonEncoder(util.MyEncoder):
         return super().default(obj)
 
 
-class JsonDB(PrintError):
+class BaseDB(PrintError):
+    """The wallet db interface used by WalletStorage and the wallet.
+    The small keys (keystore, addresses, labels, ...) live in self.data;
+    the history (HISTORY_KEYS) is up to the subclass to store.
+    """
 
-    def __init__(self, raw, *, manual_upgrades):
+    def __init__(self, *, manual_upgrades):
         self.lock = threading.RLock()
         self.data = {}
         self._modified = False
+        # paths changed since the last commit
+        self._dirty_paths = set()  # type: Set[Tuple[str, ...]]
         self.manual_upgrades = manual_upgrades
-        if raw:
-            self.load_data(raw)
-        else:
-            self.put('seed_version', FINAL_SEED_VERSION)
-        self.load_transactions()
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if not b:
+                self._dirty_paths.clear()
 
     def modified(self):
         return self._modified
 
-    def modifier(func):
-        def wrapper(self, *args, **kwargs):
-            with self.lock:
-                self._modified = True
-                return func(self, *args, **kwargs)
-        return wrapper
-
-    def locked(func):
-        def wrapper(self, *args, **kwargs):
-            with self.lock:
-                return func(self, *args, **kwargs)
-        return wrapper
+    def _touch(self, *path):
+        self._dirty_paths.add(path)
 
     @locked
     def get(self, key, default=None):
         v = self.data.get(key)
         if v is None:
             v = default
-        else:
+        elif not isinstance(v, IMMUTABLE_TYPES):
             v = copy.deepcopy(v)
         return v
 
+    @locked
+    def get_readonly(self, key, default=None):
+        """Like get, but returns the stored value itself instead of a copy.
+        The caller must not modify it; use get/put for that."""
+        v = self.data.get(key)
+        return default if v is None else v
+
     @modifier
     def put(self, key, value):
+        self._touch(key)
         try:
-            json.dumps(key, cls=JsonDBJsonEncoder)
-            json.dumps(value, cls=JsonDBJsonEncoder)
+            if not isinstance(key, str):
+                json.dumps(key, cls=JsonDBJsonEncoder)
+            if not isinstance(value, IMMUTABLE_TYPES):
+                json.dumps(value, cls=JsonDBJsonEncoder)
         except:
             self.print_error(f"json error: cannot save {repr(key)} ({repr(value)})")
             return False
         if value is not None:
             if self.data.get(key) != value:
-                self.data[key] = copy.deepcopy(value)
+                if not isinstance(value, IMMUTABLE_TYPES):
+                    value = copy.deepcopy(value)
+                self.data[key] = value
                 return True
         elif key in self.data:
             # clear current contents in case of references
@@ -115,39 +150,10 @@ class JsonDB(PrintError):
             return True
         return False
 
-    def commit(self):
-        pass
-
     @locked
-    def dump(self):
-        return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
-
-    def load_data(self, s):
-        try:
-            self.data = json.loads(s)
-        except:
-            try:
-                d = ast.literal_eval(s)
-                labels = d.get('labels', {})
-            except Exception as e:
-                raise IOError("Cannot read wallet file")
-            self.data = {}
-            for key, value in d.items():
-                try:
-                    json.dumps(key)
-                    json.dumps(value)
-                except:
-                    self.print_error('Failed to convert label to json format', key)
-                    continue
-                self.data[key] = value
-        if not isinstance(self.data, dict):
-            raise WalletFileException("Malformed wallet file (not dict)")
-
-        if not self.manual_upgrades:
-            if self.requires_split():
-                raise WalletFileException("This wallet has multiple accounts and must be split")
-            if self.requires_upgrade():
-                self.upgrade()
+    def list_keys(self):
+        """Keys of self.data, without the history."""
+        return [key for key in self.data.keys() if key not in HISTORY_KEYS]
 
     def requires_split(self):
         d = self.get('accounts', {})
@@ -196,9 +202,358 @@ class JsonDB(PrintError):
     def requires_upgrade(self):
         return self.get_seed_version() < FINAL_SEED_VERSION
 
+    @locked
+    def get_seed_version(self):
+        seed_version = self.get('seed_version')
+        if not seed_version:
+            seed_version = OLD_SEED_VERSION if len(self.get('master_public_key','')) == 128 else NEW_SEED_VERSION
+        if seed_version > FINAL_SEED_VERSION:
+            raise WalletFileException('This version of ElectrumFairChains is too old to open this wallet.\n'
+                                      '(highest supported storage version: {}, version of this file: {})'
+                                      .format(FINAL_SEED_VERSION, seed_version))
+        if seed_version==14 and self.get('seed_type') == 'segwit':
+            self._raise_unsupported_version(seed_version)
+        if seed_version >=12:
+            return seed_version
+        if seed_version not in [OLD_SEED_VERSION, NEW_SEED_VERSION]:
+            self._raise_unsupported_version(seed_version)
+        return seed_version
+
+    def _raise_unsupported_version(self, seed_version):
+        msg = "Your wallet has an unsupported seed version."
+        if seed_version in [5, 7, 8, 9, 10, 14]:
+            msg += "\n\nTo open this wallet, try 'git checkout seed_v%d'"%seed_version
+        if seed_version == 6:
+            # version 1.9.8 created v6 wallets when an incorrect seed was entered in the restore dialog
+            msg += '\n\nThis file was created because of a bug in version 1.9.8.'
+            if self.get('master_public_keys') is None and self.get('master_private_keys') is None and self.get('imported_keys') is None:
+                # pbkdf2 (at that time an additional dependency) was not included with the binaries, and wallet creation aborted.
+                msg += "\nIt does not contain any keys, and can safely be removed."
+            else:
+                # creation was complete if electrum was run from source
+                msg += "\nPlease open this file with Electrum 1.9.8, and move your coins to a new wallet."
+        raise WalletFileException(msg)
+
+    # wallet history; implemented by the subclasses
+
+    def commit(self):
+        raise NotImplementedError()
+
+    def upgrade(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def get_txi(self, tx_hash):
+        raise NotImplementedError()
+
+    def get_txo(self, tx_hash):
+        raise NotImplementedError()
+
+    def get_txi_addr(self, tx_hash, address):
+        raise NotImplementedError()
+
+    def get_txo_addr(self, tx_hash, address):
+        raise NotImplementedError()
+
+    def add_txi_addr(self, tx_hash, addr, ser, v):
+        raise NotImplementedError()
+
+    def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
+        raise NotImplementedError()
+
+    def list_txi(self):
+        raise NotImplementedError()
+
+    def list_txo(self):
+        raise NotImplementedError()
+
+    def remove_txi(self, tx_hash):
+        raise NotImplementedError()
+
+    def remove_txo(self, tx_hash):
+        raise NotImplementedError()
+
+    def list_spent_outpoints(self):
+        raise NotImplementedError()
+
+    def get_spent_outpoints(self, prevout_hash):
+        raise NotImplementedError()
+
+    def get_spent_outpoint(self, prevout_hash, prevout_n):
+        raise NotImplementedError()
+
+    def remove_spent_outpoint(self, prevout_hash, prevout_n):
+        raise NotImplementedError()
+
+    def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
+        raise NotImplementedError()
+
+    def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
+        raise NotImplementedError()
+
+    def remove_transaction(self, tx_hash) -> Optional[Transaction]:
+        raise NotImplementedError()
+
+    def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
+        raise NotImplementedError()
+
+    def list_transactions(self):
+        raise NotImplementedError()
+
+    def get_history(self):
+        raise NotImplementedError()
+
+    def is_addr_in_history(self, addr):
+        raise NotImplementedError()
+
+    def get_addr_history(self, addr):
+        raise NotImplementedError()
+
+    def set_addr_history(self, addr, hist, status=None):
+        raise NotImplementedError()
+
+    def remove_addr_history(self, addr):
+        raise NotImplementedError()
+
+    def get_addr_status(self, addr) -> Optional[str]:
+        raise NotImplementedError()
+
+    def set_addr_status(self, addr, status: Optional[str]):
+        raise NotImplementedError()
+
+    def list_verified_tx(self):
+        raise NotImplementedError()
+
+    def get_verified_tx(self, txid):
+        raise NotImplementedError()
+
+    def add_verified_tx(self, txid, info):
+        raise NotImplementedError()
+
+    def remove_verified_tx(self, txid):
+        raise NotImplementedError()
+
+    def is_in_verified_tx(self, txid):
+        raise NotImplementedError()
+
+    def update_tx_fees(self, d):
+        raise NotImplementedError()
+
+    def list_tx_fees(self):
+        raise NotImplementedError()
+
+    def get_tx_fee(self, txid):
+        raise NotImplementedError()
+
+    def remove_tx_fee(self, txid):
+        raise NotImplementedError()
+
+    def clear_history(self):
+        raise NotImplementedError()
+
+
+    @locked
+    def get_data_ref(self, name):
+        if name not in self.data:
+            self.data[name] = {}
+        return self.data[name]
+
+    @locked
+    def num_change_addresses(self):
+        return len(self.change_addresses)
+
+    @locked
+    def num_receiving_addresses(self):
+        return len(self.receiving_addresses)
+
+    @locked
+    def get_change_addresses(self):
+        return list(self.change_addresses)
+
+    @locked
+    def get_receiving_addresses(self):
+        return list(self.receiving_addresses)
+
+    @modifier
+    def add_change_address(self, addr):
+        self._touch('addresses', 'change')
+        self._addr_to_addr_index[addr] = (True, len(self.change_addresses))
+        self.change_addresses.append(addr)
+
+    @modifier
+    def add_receiving_address(self, addr):
+        self._touch('addresses', 'receiving')
+        self._addr_to_addr_index[addr] = (False, len(self.receiving_addresses))
+        self.receiving_addresses.append(addr)
+
+    @locked
+    def get_address_index(self, address):
+        return self._addr_to_addr_index.get(address)
+
+    @modifier
+    def add_imported_address(self, addr, d):
+        self._touch('addresses', addr)
+        self.imported_addresses[addr] = d
+
+    @modifier
+    def remove_imported_address(self, addr):
+        self._touch('addresses', addr)
+        self.imported_addresses.pop(addr)
+
+    @locked
+    def has_imported_address(self, addr):
+        return addr in self.imported_addresses
+
+    @locked
+    def get_imported_addresses(self):
+        return list(sorted(self.imported_addresses.keys()))
+
+    @locked
+    def get_imported_address(self, addr):
+        return self.imported_addresses.get(addr)
+
+    def load_addresses(self, wallet_type):
+        """ called from Abstract_Wallet.__init__ """
+        if wallet_type == 'imported':
+            self.imported_addresses = self.get_data_ref('addresses')
+        else:
+            self.get_data_ref('addresses')
+            for name in ['receiving', 'change']:
+                if name not in self.data['addresses']:
+                    self.data['addresses'][name] = []
+            self.change_addresses = self.data['addresses']['change']
+            self.receiving_addresses = self.data['addresses']['receiving']
+            self._addr_to_addr_index = {}  # key: address, value: (is_change, index)
+            for i, addr in enumerate(self.receiving_addresses):
+                self._addr_to_addr_index[addr] = (False, i)
+            for i, addr in enumerate(self.change_addresses):
+                self._addr_to_addr_index[addr] = (True, i)
+
+
+class JsonDB(BaseDB):
+
+    def __init__(self, raw, *, manual_upgrades):
+        BaseDB.__init__(self, manual_upgrades=manual_upgrades)
+        # changes are saved as journal records, see get_journal_records
+        self._needs_snapshot = True
+        self._snapshot_bytes = 0
+        self._journal_bytes = 0
+        if raw:
+            self.load_data(raw)
+        else:
+            self.put('seed_version', FINAL_SEED_VERSION)
+        self.load_transactions()
+
+    def set_modified(self, b):
+        """Setting this from outside means the db changed in a way that
+        is not journaled; the next save writes a full snapshot."""
+        with self.lock:
+            super().set_modified(b)
+            self._needs_snapshot = b
+
+    def _get_path(self, path):
+        d = self.data
+        for key in path[:-1]:
+            d = d.get(key)
+            if not isinstance(d, dict):
+                return _MISSING
+        return d.get(path[-1], _MISSING)
+
+    def get_journal_records(self) -> Optional[List[str]]:
+        """Returns the changes since the last save as journal records,
+        or None if a full snapshot has to be written instead."""
+        with self.lock:
+            if self._needs_snapshot:
+                return None
+            records = []
+            for path in sorted(self._dirty_paths):
+                value = self._get_path(path)
+                if value is _MISSING:
+                    record = ['del', list(path)]
+                else:
+                    record = ['set', list(path), value]
+                records.append(json.dumps(record, cls=JsonDBJsonEncoder))
+            num_bytes = sum(len(r) + 1 for r in records)
+            if self._journal_bytes + num_bytes > max(JOURNAL_COMPACT_MIN_BYTES, self._snapshot_bytes):
+                return None
+            self._journal_bytes += num_bytes
+            self._dirty_paths.clear()
+            return records
+
+    def _replay_journal(self, journal: str) -> bool:
+        """Applies the journal records to the snapshot. Returns whether a
+        truncated last record was dropped."""
+        lines = [line for line in journal.split('\n') if line.strip()]
+        for i, line in enumerate(lines):
+            try:
+                op, path, *value = json.loads(line)
+                d = self.data
+                for key in path[:-1]:
+                    d = d.setdefault(key, {})
+                if op == 'set':
+                    d[path[-1]] = value[0]
+                elif op == 'del':
+                    d.pop(path[-1], None)
+                else:
+                    raise ValueError(op)
+            except (ValueError, TypeError, IndexError, AttributeError) as e:
+                if i == len(lines) - 1:
+                    # interrupted while appending; the record was never complete
+                    self.print_error('ignoring truncated journal record', repr(e))
+                    return True
+                raise WalletFileException("Malformed wallet file (journal record {})".format(i))
+        return False
+
+    def commit(self):
+        with self.lock:
+            self._remove_unreferenced()
+
+    @locked
+    def dump(self):
+        s = json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
+        self._snapshot_bytes = len(s)
+        self._journal_bytes = 0
+        return s
+
+    def load_data(self, s):
+        try:
+            self.data, snapshot_end = json.JSONDecoder().raw_decode(s, len(s) - len(s.lstrip()))
+            self._snapshot_bytes = snapshot_end
+            self._journal_bytes = len(s) - snapshot_end
+            truncated = self._replay_journal(s[snapshot_end:])
+            # records appended after a truncated one would follow it on
+            # the same line; write a snapshot instead, which drops it
+            self._needs_snapshot = truncated
+        except json.JSONDecodeError:
+            try:
+                d = ast.literal_eval(s)
+                labels = d.get('labels', {})
+            except Exception as e:
+                raise IOError("Cannot read wallet file")
+            self.data = {}
+            for key, value in d.items():
+                try:
+                    json.dumps(key)
+                    json.dumps(value)
+                except:
+                    self.print_error('Failed to convert label to json format', key)
+                    continue
+                self.data[key] = value
+        if not isinstance(self.data, dict):
+            raise WalletFileException("Malformed wallet file (not dict)")
+
+        if not self.manual_upgrades:
+            if self.requires_split():
+                raise WalletFileException("This wallet has multiple accounts and must be split")
+            if self.requires_upgrade():
+                self.upgrade()
+
     @profiler
     def upgrade(self):
         self.print_error('upgrading wallet format')
+        self._needs_snapshot = True
         self._convert_imported()
         self._convert_wallet_type()
         self._convert_account()
@@ -408,6 +763,9 @@ class JsonDB(PrintError):
         transactions = self.get('transactions', {})  # txid -> Transaction
         spent_outpoints = defaultdict(dict)
         for txid, tx in transactions.items():
+            if isinstance(tx, str):
+                # raw hex as loaded from the file
+                tx = Transaction(tx)
             for txin in tx.inputs():
                 if txin['type'] == 'coinbase':
                     continue
@@ -475,38 +833,6 @@ class JsonDB(PrintError):
         else:
             return True
 
-    @locked
-    def get_seed_version(self):
-        seed_version = self.get('seed_version')
-        if not seed_version:
-            seed_version = OLD_SEED_VERSION if len(self.get('master_public_key','')) == 128 else NEW_SEED_VERSION
-        if seed_version > FINAL_SEED_VERSION:
-            raise WalletFileException('This version of ElectrumFairChains is too old to open this wallet.\n'
-                                      '(highest supported storage version: {}, version of this file: {})'
-                                      .format(FINAL_SEED_VERSION, seed_version))
-        if seed_version==14 and self.get('seed_type') == 'segwit':
-            self._raise_unsupported_version(seed_version)
-        if seed_version >=12:
-            return seed_version
-        if seed_version not in [OLD_SEED_VERSION, NEW_SEED_VERSION]:
-            self._raise_unsupported_version(seed_version)
-        return seed_version
-
-    def _raise_unsupported_version(self, seed_version):
-        msg = "Your wallet has an unsupported seed version."
-        if seed_version in [5, 7, 8, 9, 10, 14]:
-            msg += "\n\nTo open this wallet, try 'git checkout seed_v%d'"%seed_version
-        if seed_version == 6:
-            # version 1.9.8 created v6 wallets when an incorrect seed was entered in the restore dialog
-            msg += '\n\nThis file was created because of a bug in version 1.9.8.'
-            if self.get('master_public_keys') is None and self.get('master_private_keys') is None and self.get('imported_keys') is None:
-                # pbkdf2 (at that time an additional dependency) was not included with the binaries, and wallet creation aborted.
-                msg += "\nIt does not contain any keys, and can safely be removed."
-            else:
-                # creation was complete if electrum was run from source
-                msg += "\nPlease open this file with Electrum 1.9.8, and move your coins to a new wallet."
-        raise WalletFileException(msg)
-
     @locked
     def get_txi(self, tx_hash):
         return list(self.txi.get(tx_hash, {}).keys())
@@ -515,33 +841,45 @@ class JsonDB(PrintError):
     def get_txo(self, tx_hash):
         return list(self.txo.get(tx_hash, {}).keys())
 
+    @staticmethod
+    def _get_addr_set(d, addr):
+        # lists loaded from the file are converted to sets when first used
+        s = d[addr]
+        if isinstance(s, list):
+            s = d[addr] = set(tuple(x) for x in s)
+        return s
+
     @locked
     def get_txi_addr(self, tx_hash, address):
-        return self.txi.get(tx_hash, {}).get(address, [])
+        d = self.txi.get(tx_hash, {})
+        return self._get_addr_set(d, address) if address in d else []
 
     @locked
     def get_txo_addr(self, tx_hash, address):
-        return self.txo.get(tx_hash, {}).get(address, [])
+        d = self.txo.get(tx_hash, {})
+        return self._get_addr_set(d, address) if address in d else []
 
     @modifier
     def add_txi_addr(self, tx_hash, addr, ser, v):
+        self._touch('txi', tx_hash)
         if tx_hash not in self.txi:
             self.txi[tx_hash] = {}
         d = self.txi[tx_hash]
         if addr not in d:
             # note that as this is a set, we can ignore "duplicates"
             d[addr] = set()
-        d[addr].add((ser, v))
+        self._get_addr_set(d, addr).add((ser, v))
 
     @modifier
     def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
+        self._touch('txo', tx_hash)
         if tx_hash not in self.txo:
             self.txo[tx_hash] = {}
         d = self.txo[tx_hash]
         if addr not in d:
             # note that as this is a set, we can ignore "duplicates"
             d[addr] = set()
-        d[addr].add((n, v, is_coinbase))
+        self._get_addr_set(d, addr).add((n, v, is_coinbase))
 
     @locked
     def list_txi(self):
@@ -553,14 +891,17 @@ class JsonDB(PrintError):
 
     @modifier
     def remove_txi(self, tx_hash):
+        self._touch('txi', tx_hash)
         self.txi.pop(tx_hash, None)
 
     @modifier
     def remove_txo(self, tx_hash):
+        self._touch('txo', tx_hash)
         self.txo.pop(tx_hash, None)
 
     @locked
     def list_spent_outpoints(self):
+        self._remove_unreferenced()
         return [(h, n)
                 for h in self.spent_outpoints.keys()
                 for n in self.get_spent_outpoints(h)
@@ -568,20 +909,24 @@ class JsonDB(PrintError):
 
     @locked
     def get_spent_outpoints(self, prevout_hash):
+        self._remove_unreferenced()
         return list(self.spent_outpoints.get(prevout_hash, {}).keys())
 
     @locked
     def get_spent_outpoint(self, prevout_hash, prevout_n):
+        self._remove_unreferenced()
         return self.spent_outpoints.get(prevout_hash, {}).get(str(prevout_n))
 
     @modifier
     def remove_spent_outpoint(self, prevout_hash, prevout_n):
-        self.spent_outpoints[prevout_hash].pop(prevout_n, None)  # FIXME
+        self._touch('spent_outpoints', prevout_hash)
+        self.spent_outpoints[prevout_hash].pop(str(prevout_n), None)
         if not self.spent_outpoints[prevout_hash]:
             self.spent_outpoints.pop(prevout_hash)
 
     @modifier
     def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
+        self._touch('spent_outpoints', prevout_hash)
         if prevout_hash not in self.spent_outpoints:
             self.spent_outpoints[prevout_hash] = {}
         self.spent_outpoints[prevout_hash][str(prevout_n)] = tx_hash
@@ -589,18 +934,28 @@ class JsonDB(PrintError):
     @modifier
     def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
         assert isinstance(tx, Transaction)
+        self._touch('transactions', tx_hash)
         self.transactions[tx_hash] = tx
 
     @modifier
     def remove_transaction(self, tx_hash) -> Optional[Transaction]:
-        return self.transactions.pop(tx_hash, None)
+        self._touch('transactions', tx_hash)
+        tx = self.transactions.pop(tx_hash, None)
+        if isinstance(tx, str):
+            tx = Transaction(tx)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
-        return self.transactions.get(tx_hash)
+        tx = self.transactions.get(tx_hash)
+        if isinstance(tx, str):
+            # raw hex as loaded from the file
+            tx = self.transactions[tx_hash] = Transaction(tx)
+        return tx
 
     @locked
     def list_transactions(self):
+        self._remove_unreferenced()
         return list(self.transactions.keys())
 
     @locked
@@ -616,12 +971,31 @@ class JsonDB(PrintError):
         return self.history.get(addr, [])
 
     @modifier
-    def set_addr_history(self, addr, hist):
+    def set_addr_history(self, addr, hist, status=None):
+        """status is the electrum status hash of hist, if known."""
+        self._touch('addr_history', addr)
         self.history[addr] = hist
+        self.set_addr_status(addr, status)
 
     @modifier
     def remove_addr_history(self, addr):
+        self._touch('addr_history', addr)
         self.history.pop(addr, None)
+        self.set_addr_status(addr, None)
+
+    @locked
+    def get_addr_status(self, addr) -> Optional[str]:
+        return self.addr_status.get(addr)
+
+    @modifier
+    def set_addr_status(self, addr, status: Optional[str]):
+        if self.addr_status.get(addr) == status:
+            return
+        self._touch('addr_status', addr)
+        if status is None:
+            self.addr_status.pop(addr, None)
+        else:
+            self.addr_status[addr] = status
 
     @locked
     def list_verified_tx(self):
@@ -640,10 +1014,12 @@ class JsonDB(PrintError):
 
     @modifier
     def add_verified_tx(self, txid, info):
+        self._touch('verified_tx3', txid)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
 
     @modifier
     def remove_verified_tx(self, txid):
+        self._touch('verified_tx3', txid)
         self.verified_tx.pop(txid, None)
 
     def is_in_verified_tx(self, txid):
@@ -651,89 +1027,23 @@ class JsonDB(PrintError):
 
     @modifier
     def update_tx_fees(self, d):
+        for txid in d:
+            self._touch('tx_fees', txid)
         return self.tx_fees.update(d)
 
+    @locked
+    def list_tx_fees(self):
+        return list(self.tx_fees.keys())
+
     @locked
     def get_tx_fee(self, txid):
         return self.tx_fees.get(txid)
 
     @modifier
     def remove_tx_fee(self, txid):
+        self._touch('tx_fees', txid)
         self.tx_fees.pop(txid, None)
 
-    @locked
-    def get_data_ref(self, name):
-        if name not in self.data:
-            self.data[name] = {}
-        return self.data[name]
-
-    @locked
-    def num_change_addresses(self):
-        return len(self.change_addresses)
-
-    @locked
-    def num_receiving_addresses(self):
-        return len(self.receiving_addresses)
-
-    @locked
-    def get_change_addresses(self):
-        return list(self.change_addresses)
-
-    @locked
-    def get_receiving_addresses(self):
-        return list(self.receiving_addresses)
-
-    @modifier
-    def add_change_address(self, addr):
-        self._addr_to_addr_index[addr] = (True, len(self.change_addresses))
-        self.change_addresses.append(addr)
-
-    @modifier
-    def add_receiving_address(self, addr):
-        self._addr_to_addr_index[addr] = (False, len(self.receiving_addresses))
-        self.receiving_addresses.append(addr)
-
-    @locked
-    def get_address_index(self, address):
-        return self._addr_to_addr_index.get(address)
-
-    @modifier
-    def add_imported_address(self, addr, d):
-        self.imported_addresses[addr] = d
-
-    @modifier
-    def remove_imported_address(self, addr):
-        self.imported_addresses.pop(addr)
-
-    @locked
-    def has_imported_address(self, addr):
-        return addr in self.imported_addresses
-
-    @locked
-    def get_imported_addresses(self):
-        return list(sorted(self.imported_addresses.keys()))
-
-    @locked
-    def get_imported_address(self, addr):
-        return self.imported_addresses.get(addr)
-
-    def load_addresses(self, wallet_type):
-        """ called from Abstract_Wallet.__init__ """
-        if wallet_type == 'imported':
-            self.imported_addresses = self.get_data_ref('addresses')
-        else:
-            self.get_data_ref('addresses')
-            for name in ['receiving', 'change']:
-                if name not in self.data['addresses']:
-                    self.data['addresses'][name] = []
-            self.change_addresses = self.data['addresses']['change']
-            self.receiving_addresses = self.data['addresses']['receiving']
-            self._addr_to_addr_index = {}  # key: address, value: (is_change, index)
-            for i, addr in enumerate(self.receiving_addresses):
-                self._addr_to_addr_index[addr] = (False, i)
-            for i, addr in enumerate(self.change_addresses):
-                self._addr_to_addr_index[addr] = (True, i)
-
     @profiler
     def load_transactions(self):
         # references in self.data
@@ -742,21 +1052,23 @@ class JsonDB(PrintError):
         self.transactions = self.get_data_ref('transactions')   # type: Dict[str, Transaction]
         self.spent_outpoints = self.get_data_ref('spent_outpoints')
         self.history = self.get_data_ref('addr_history')  # address -> list of (txid, height)
+        self.addr_status = self.get_data_ref('addr_status')  # address -> status hash of its history
         self.verified_tx = self.get_data_ref('verified_tx3')  # txid -> (height, timestamp, txpos, header_hash)
         self.tx_fees = self.get_data_ref('tx_fees')
-        # convert raw hex transactions to Transaction objects
-        for tx_hash, raw_tx in self.transactions.items():
-            self.transactions[tx_hash] = Transaction(raw_tx)
-        # convert list to set
-        for t in self.txi, self.txo:
-            for d in t.values():
-                for addr, lst in d.items():
-                    d[addr] = set([tuple(x) for x in lst])
+        # Transactions stay raw hex and txi/txo entries stay lists until
+        # they are used; unreferenced entries are removed on first access.
+        self._unreferenced_removed = False
+
+    def _remove_unreferenced(self):
+        if self._unreferenced_removed:
+            return
+        self._unreferenced_removed = True
         # remove unreferenced tx
         for tx_hash in list(self.transactions.keys()):
             if not self.get_txi(tx_hash) and not self.get_txo(tx_hash):
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
+                self._touch('transactions', tx_hash)
         # remove unreferenced outpoints
         for prevout_hash in self.spent_outpoints.keys():
             d = self.spent_outpoints[prevout_hash]
@@ -764,13 +1076,17 @@ class JsonDB(PrintError):
                 if spending_txid not in self.transactions:
                     self.print_error("removing unreferenced spent outpoint")
                     d.pop(prevout_n)
+                    self._touch('spent_outpoints', prevout_hash)
 
     @modifier
     def clear_history(self):
+        for name in HISTORY_KEYS:
+            self._touch(name)
         self.txi.clear()
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
         self.history.clear()
+        self.addr_status.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
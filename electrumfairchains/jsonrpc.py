@@ -23,9 +23,14 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from base64 import b64decode
+import asyncio
+import json
 import time
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
+from aiohttp import web
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 
 from . import util
@@ -46,6 +51,29 @@ class RPCAuthUnsupportedType(Exception):
         return 'Authentication failed (only basic auth is supported)'
 
 
+def check_credentials(headers, rpc_user, rpc_password):
+    '''Raises if the basic auth credentials in headers do not match.
+    Callers should delay their response to bad credentials.'''
+    if rpc_password == '':
+        # RPC authentication is disabled
+        return
+
+    auth_string = headers.get('Authorization', None)
+    if auth_string is None:
+        raise RPCAuthCredentialsMissing()
+
+    (basic, _, encoded) = auth_string.partition(' ')
+    if basic != 'Basic':
+        raise RPCAuthUnsupportedType()
+
+    encoded = util.to_bytes(encoded, 'utf8')
+    credentials = util.to_string(b64decode(encoded), 'utf8')
+    (username, _, password) = credentials.partition(':')
+    if not (util.constant_time_compare(username, rpc_user)
+            and util.constant_time_compare(password, rpc_password)):
+        raise RPCAuthCredentialsInvalid()
+
+
 # based on http://acooke.org/cute/BasicHTTPA0.html by andrew cooke
 class VerifyingJSONRPCServer(SimpleJSONRPCServer):
 
@@ -78,22 +106,112 @@ class VerifyingJSONRPCServer(SimpleJSONRPCServer):
             self, requestHandler=VerifyingRequestHandler, *args, **kargs)
 
     def authenticate(self, headers):
-        if self.rpc_password == '':
-            # RPC authentication is disabled
-            return
-
-        auth_string = headers.get('Authorization', None)
-        if auth_string is None:
-            raise RPCAuthCredentialsMissing()
-
-        (basic, _, encoded) = auth_string.partition(' ')
-        if basic != 'Basic':
-            raise RPCAuthUnsupportedType()
-
-        encoded = util.to_bytes(encoded, 'utf8')
-        credentials = util.to_string(b64decode(encoded), 'utf8')
-        (username, _, password) = credentials.partition(':')
-        if not (util.constant_time_compare(username, self.rpc_user)
-                and util.constant_time_compare(password, self.rpc_password)):
+        try:
+            check_credentials(headers, self.rpc_user, self.rpc_password)
+        except RPCAuthCredentialsInvalid:
             time.sleep(0.050)
-            raise RPCAuthCredentialsInvalid()
+            raise
+
+
+class AsyncJSONRPCServer(util.PrintError):
+    '''JSON-RPC over HTTP, served by aiohttp on an existing event loop.
+
+    Registered functions are blocking; they are run in a thread pool so
+    that a slow call does not hold up other clients. Functions that must
+    not run concurrently have to take their own locks. Batch requests
+    are dispatched concurrently as well.'''
+
+    def __init__(self, host, port, *, rpc_user, rpc_password, max_workers=16):
+        self.host = host
+        self.port = port
+        self.rpc_user = rpc_user
+        self.rpc_password = rpc_password
+        self.funcs = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix='RPC')
+        self.runner = None
+
+    def register_function(self, func, name):
+        self.funcs[name] = func
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/{tail:.*}', self.handle_request)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+    def getsockname(self):
+        return self.runner.addresses[0][:2]
+
+    async def stop(self):
+        await self.runner.cleanup()
+        self.executor.shutdown(wait=False)
+
+    async def handle_request(self, request):
+        try:
+            check_credentials(request.headers, self.rpc_user, self.rpc_password)
+        except RPCAuthCredentialsInvalid as e:
+            await asyncio.sleep(0.050)
+            return web.Response(status=401, text=str(e))
+        except (RPCAuthCredentialsMissing, RPCAuthUnsupportedType) as e:
+            return web.Response(status=401, text=str(e))
+        except Exception as e:
+            return web.Response(status=500, text=str(e))
+        try:
+            data = json.loads(await request.text())
+        except ValueError as e:
+            return self._json_response(self._error(None, -32700, 'Parse error: {}'.format(e)))
+        if isinstance(data, list):
+            if not data:
+                return self._json_response(self._error(None, -32600, 'Invalid Request'))
+            responses = await asyncio.gather(*[self._handle_call(call) for call in data])
+            responses = [r for r in responses if r is not None]
+        else:
+            responses = await self._handle_call(data)
+        if not responses:
+            # notifications only
+            return web.Response(status=204)
+        return self._json_response(responses)
+
+    async def _handle_call(self, call):
+        if not isinstance(call, dict) or not isinstance(call.get('method'), str):
+            return self._error(None, -32600, 'Invalid Request')
+        call_id = call.get('id')
+        method = call['method']
+        params = call.get('params', [])
+        func = self.funcs.get(method)
+        if func is None:
+            response = self._error(call_id, -32601, 'Method not found: {}'.format(method))
+        elif not isinstance(params, (list, dict)):
+            response = self._error(call_id, -32602, 'Invalid params')
+        else:
+            if isinstance(params, dict):
+                func = partial(func, **params)
+            else:
+                func = partial(func, *params)
+            loop = asyncio.get_event_loop()
+            try:
+                result = await loop.run_in_executor(self.executor, func)
+            except Exception as e:
+                self.print_error('error calling {}: {!r}'.format(method, e))
+                response = self._error(call_id, -32603, 'Server error: {}: {}'.format(type(e).__name__, e))
+            else:
+                response = {'jsonrpc': '2.0', 'result': result, 'id': call_id}
+        if call_id is None:
+            # notification
+            return None
+        return response
+
+    @classmethod
+    def _error(cls, call_id, code, message):
+        return {'jsonrpc': '2.0', 'error': {'code': code, 'message': message}, 'id': call_id}
+
+    @classmethod
+    def _json_response(cls, data):
+        try:
+            text = json.dumps(data, cls=util.MyEncoder)
+        except (TypeError, ValueError) as e:
+            text = json.dumps(cls._error(None, -32603, 'Server error: {}'.format(e)))
+        return web.Response(text=text, content_type='application/json')
@@ -26,13 +26,13 @@
 
 from unicodedata import normalize
 import hashlib
-from typing import Tuple
+from typing import Tuple, List, Dict
 
 from . import bitcoin, ecc, bip32
 from .bitcoin import (deserialize_privkey, serialize_privkey,
                       public_key_to_p2pkh)
 from .bip32 import (convert_bip32_path_to_list_of_uint32, BIP32_PRIME,
-                    is_xpub, is_xprv, BIP32Node)
+                    is_xpub, is_xprv, BIP32Node, derive_child_pubkeys)
 from .ecc import string_to_number, number_to_string
 from .crypto import (pw_decode, pw_encode, sha256, sha256d, PW_HASH_VERSION_LATEST,
                      SUPPORTED_PW_HASH_VERSIONS, UnsupportedPasswordHashVersion)
@@ -258,20 +258,37 @@ class Xpub:
         self.xpub = None
         self.xpub_receive = None
         self.xpub_change = None
+        # for_change -> decoded (pubkey, chaincode) of that branch
+        self._branch_nodes = {}  # type: Dict[int, Tuple[ecc.ECPubkey, bytes]]
 
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            rootnode = BIP32Node.from_xkey(self.xpub)
-            xpub = rootnode.subkey_at_public_derivation((for_change,)).to_xpub()
-            if for_change:
-                self.xpub_change = xpub
+    def _get_branch_node(self, for_change) -> Tuple[ecc.ECPubkey, bytes]:
+        for_change = int(for_change)
+        node = self._branch_nodes.get(for_change)
+        if node is None:
+            xpub = self.xpub_change if for_change else self.xpub_receive
+            if xpub is None:
+                rootnode = BIP32Node.from_xkey(self.xpub)
+                branch = rootnode.subkey_at_public_derivation((for_change,))
+                xpub = branch.to_xpub()
+                if for_change:
+                    self.xpub_change = xpub
+                else:
+                    self.xpub_receive = xpub
             else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+                branch = BIP32Node.from_xkey(xpub)
+            node = self._branch_nodes[for_change] = (branch.eckey, branch.chaincode)
+        return node
+
+    def derive_pubkey(self, for_change, n):
+        return self.derive_pubkeys(for_change, n, 1)[0]
+
+    def derive_pubkeys(self, for_change, start, count) -> List[str]:
+        eckey, chaincode = self._get_branch_node(for_change)
+        pubkeys = derive_child_pubkeys(eckey, chaincode, range(start, start + count))
+        return [bh2u(pubkey) for pubkey in pubkeys]
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -445,6 +462,15 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, start, count) -> List[str]:
+        master_public_key = ecc.ECPubkey(bfh('04'+self.mpk))
+        pubkeys = []
+        for n in range(start, start + count):
+            z = self.get_sequence(self.mpk, for_change, n)
+            public_key = master_public_key + z*ecc.generator()
+            pubkeys.append(public_key.get_public_key_hex(compressed=False))
+        return pubkeys
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % ecc.CURVE_ORDER
         pk = number_to_string(secexp, ecc.CURVE_ORDER)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2019 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# In-process metrics: counters, gauges and latency summaries, exposed by
+# the 'getmetrics' command and, optionally, as Prometheus text on the
+# daemon. Collection is disabled unless the 'metrics' config option is
+# set; the module-level helpers then return right away.
+
+import math
+import threading
+import time
+from collections import deque
+from typing import Optional, Dict, Tuple, Callable, List
+
+from aiohttp import web
+
+
+QUANTILES = (0.5, 0.9, 0.99)
+# summaries compute their quantiles over this many recent observations
+DEFAULT_WINDOW = 1024
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    '''Count, sum and max of all observations. Quantiles are computed
+    over the last DEFAULT_WINDOW observations.'''
+    kind = 'summary'
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        self._window = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+            self._window.append(value)
+
+    def quantiles(self, qs=QUANTILES) -> List[float]:
+        with self._lock:
+            values = sorted(self._window)
+        if not values:
+            return [0.] * len(qs)
+        return [values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+                for q in qs]
+
+    def snapshot(self):
+        d = {'count': self.count,
+             'sum': self.sum,
+             'avg': self.sum / self.count if self.count else 0.,
+             'max': self.max}
+        for q, v in zip(QUANTILES, self.quantiles()):
+            d['p%g' % (100 * q)] = v
+        return d
+
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: LabelsKey) -> str:
+    if not labels:
+        return ''
+    def escape(v):
+        return v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (k, escape(v)) for k, v in labels) + '}'
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = {}  # type: Dict[Tuple[str, LabelsKey], object]
+        self._collectors = []  # type: List[Callable[[MetricsRegistry], None]]
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, cls())
+        if not isinstance(metric, cls):
+            raise TypeError('metric {} is a {}'.format(name, metric.kind))
+        return metric
+
+    def counter(self, name, **labels) -> Counter:
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels) -> Gauge:
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, **labels) -> Histogram:
+        return self._get(Histogram, name, labels)
+
+    def add_collector(self, func: Callable[['MetricsRegistry'], None]):
+        '''func is called with the registry before each snapshot, to set
+        gauges that are cheaper to read on demand than to keep updated.'''
+        self._collectors.append(func)
+
+    def _collect(self):
+        for func in list(self._collectors):
+            try:
+                func(self)
+            except Exception as e:
+                from .util import print_error
+                print_error('[metrics] collector failed:', repr(e))
+        with self._lock:
+            return sorted(self._metrics.items(), key=lambda x: x[0])
+
+    def snapshot(self) -> dict:
+        return {name + _format_labels(labels): metric.snapshot()
+                for (name, labels), metric in self._collect()}
+
+    def to_prometheus(self) -> str:
+        lines = []
+        last_name = None
+        for (name, labels), metric in self._collect():
+            if name != last_name:
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+                last_name = name
+            if isinstance(metric, Histogram):
+                for q, v in zip(QUANTILES, metric.quantiles()):
+                    lines.append('{}{} {!r}'.format(name, _format_labels(labels + (('quantile', str(q)),)), v))
+                lines.append('{}_sum{} {!r}'.format(name, _format_labels(labels), metric.sum))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels), metric.count))
+            else:
+                lines.append('{}{} {!r}'.format(name, _format_labels(labels), metric.value))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    __slots__ = ('histogram', 't0')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.t0 = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.t0)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+_registry = None  # type: Optional[MetricsRegistry]
+
+
+def get_registry() -> Optional[MetricsRegistry]:
+    return _registry
+
+
+def set_registry(registry: Optional[MetricsRegistry]) -> None:
+    global _registry
+    _registry = registry
+
+
+def init_metrics(config) -> None:
+    if not config.get('metrics', False):
+        set_registry(None)
+    elif _registry is None:
+        set_registry(MetricsRegistry())
+
+
+def is_enabled() -> bool:
+    return _registry is not None
+
+
+def inc(name, amount=1, **labels) -> None:
+    if _registry is None:
+        return
+    _registry.counter(name, **labels).inc(amount)
+
+
+def set_gauge(name, value, **labels) -> None:
+    if _registry is None:
+        return
+    _registry.gauge(name, **labels).set(value)
+
+
+def observe(name, value, **labels) -> None:
+    if _registry is None:
+        return
+    _registry.histogram(name, **labels).observe(value)
+
+
+def timer(name, **labels):
+    '''Context manager that observes the time spent in its block, in seconds.'''
+    if _registry is None:
+        return _NULL_TIMER
+    return _Timer(_registry.histogram(name, **labels))
+
+
+class PrometheusServer:
+    '''Serves the registry as Prometheus text on GET /metrics.'''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_request)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+    def getsockname(self):
+        return self.runner.addresses[0][:2]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle_request(self, request):
+        registry = get_registry()
+        text = registry.to_prometheus() if registry else ''
+        return web.Response(text=text, content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
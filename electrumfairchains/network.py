@@ -25,15 +25,16 @@ import queue
 import os
 import random
 import re
-from collections import defaultdict
+from collections import defaultdict, deque
 import threading
 import socket
 import json
 import sys
 import ipaddress
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple
+from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, Union
 import traceback
+from functools import partial
 
 import dns
 import dns.resolver
@@ -42,9 +43,10 @@ from aiorpcx import TaskGroup
 from aiohttp import ClientResponse
 
 from . import util
+from . import metrics
 from .util import (PrintError, print_error, log_exceptions, ignore_exceptions,
                    bfh, SilentTaskGroup, make_aiohttp_session, send_exception_to_crash_reporter,
-                   is_hash256_str, is_non_negative_integer)
+                   is_hash256_str, is_non_negative_integer, http_session_pool)
 
 from .bitcoin import COIN
 # from . import constants
@@ -59,10 +61,15 @@ from .i18n import _
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# seconds before a request is hedged while the latency of the main
+# interface is unknown, and the lower bound once it is known
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_HEDGE_DELAY = 0.05
 
 
-def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
+def parse_servers(result: Sequence[Tuple[str, str, List[str]]], *, net=None) -> Dict[str, dict]:
     """ parse servers list into dict format"""
+    if net is None: net = FairChains
     servers = {}
     for item in result:
         host = item[1]
@@ -73,7 +80,7 @@ def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dic
             for v in item[2]:
                 if re.match(r"[st]\d*", v):
                     protocol, port = v[0], v[1:]
-                    if port == '': port = FairChains.DEFAULT_PORTS[protocol]
+                    if port == '': port = net.DEFAULT_PORTS[protocol]
                     out[protocol] = port
                 elif re.match("v(.?)+", v):
                     version = v[1:]
@@ -111,9 +118,10 @@ def filter_protocol(hostmap, protocol='s'):
     return eligible
 
 
-def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
+def pick_random_server(hostmap = None, protocol = 's', exclude_set = set(), *, net=None):
+    if net is None: net = FairChains
     if hostmap is None:
-        hostmap = FairChains.DEFAULT_SERVERS
+        hostmap = net.DEFAULT_SERVERS
     eligible = list(set(filter_protocol(hostmap, protocol)) - exclude_set)
     return random.choice(eligible) if eligible else None
 
@@ -218,7 +226,6 @@ class Network(PrintError):
 
     def __init__(self, config: SimpleConfig=None):
         global INSTANCE
-        INSTANCE = self
 
         self.asyncio_loop = asyncio.get_event_loop()
         assert self.asyncio_loop.is_running(), "event loop not running"
@@ -227,10 +234,15 @@ class Network(PrintError):
         if config is None:
             config = {}  # Do not use mutables as default values!
         self.config = SimpleConfig(config) if isinstance(config, dict) else config  # type: SimpleConfig
+        self.net = self.config.net
+        # other FairChains served by the same process do not replace
+        # the instance of the default one
+        if INSTANCE is None or self.net is FairChains:
+            INSTANCE = self
         blockchain.read_blockchains(self.config)
-        self.print_error("blockchains", list(map(lambda b: b.forkpoint, blockchain.blockchains.values())))
+        self.print_error("blockchains", list(map(lambda b: b.forkpoint, blockchain.get_blockchains(self.net).values())))
         self._blockchain_preferred_block = self.config.get('blockchain_preferred_block', None)  # type: Optional[Dict]
-        self._blockchain = blockchain.get_best_chain()
+        self._blockchain = blockchain.get_best_chain(self.net)
         # Server for addresses and transactions
         self.default_server = self.config.get('server', None)
         # Sanitize default server
@@ -241,7 +253,7 @@ class Network(PrintError):
                 self.print_error('Warning: failed to parse server-string; falling back to random.')
                 self.default_server = None
         if not self.default_server:
-            self.default_server = pick_random_server()
+            self.default_server = pick_random_server(net=self.net)
 
         self.main_taskgroup = None  # type: TaskGroup
 
@@ -260,6 +272,7 @@ class Network(PrintError):
         self.relay_fee = None  # type: Optional[int]
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)      # note: needs self.callback_lock
+        self.register_callback(self._on_proxy_set, ['proxy_set'])
 
         dir_path = os.path.join(self.config.path, 'certs')
         util.make_dir(dir_path)
@@ -276,6 +289,9 @@ class Network(PrintError):
         self.server_queue = None
         self.proxy = None
 
+        # (timestamp, num_headers) of recently connected catch-up chunks
+        self._header_sync_samples = deque(maxlen=32)
+
         # Dump network messages (all interfaces).  Set at runtime from the console.
         self.debug = False
 
@@ -375,13 +391,13 @@ class Network(PrintError):
             self.notify('banner')
         async def get_donation_address():
             addr = await session.send_request('server.donation_address')
-            if not bitcoin.is_address(addr):
+            if not bitcoin.is_address(addr, net=self.net):
                 if addr:  # ignore empty string
                     self.print_error(f"invalid donation address from server: {repr(addr)}")
                 addr = ''
             self.donation_address = addr
         async def get_server_peers():
-            self.server_peers = parse_servers(await session.send_request('server.peers.subscribe'))
+            self.server_peers = parse_servers(await session.send_request('server.peers.subscribe'), net=self.net)
             self.notify('servers')
         async def get_relay_fee():
             relayfee = await session.send_request('blockchain.relayfee')
@@ -430,6 +446,8 @@ class Network(PrintError):
             value = self.config.mempool_fees
         elif key == 'servers':
             value = self.get_servers()
+        elif key == 'header_sync_rate':
+            value = self.get_header_sync_rate()
         else:
             raise Exception('unexpected trigger key {}'.format(key))
         return value
@@ -461,7 +479,7 @@ class Network(PrintError):
     @with_recent_servers_lock
     def get_servers(self):
         # start with hardcoded servers
-        out = dict(FairChains.DEFAULT_SERVERS)  # copy
+        out = dict(self.net.DEFAULT_SERVERS)  # copy
         # add recent servers
         for s in self.recent_servers:
             try:
@@ -514,6 +532,10 @@ class Network(PrintError):
                 socket.getaddrinfo = socket._getaddrinfo
         self.trigger_callback('proxy_set', self.proxy)
 
+    def _on_proxy_set(self, event, proxy):
+        # pooled http sessions must not keep using the old proxy
+        http_session_pool.reset()
+
     @staticmethod
     def _fast_getaddrinfo(host, *args, **kwargs):
         def needs_dns_resolving(host):
@@ -715,6 +737,24 @@ class Network(PrintError):
         await self._close_interface(interface)
         self.trigger_callback('network_updated')
 
+    def get_header_sync_window(self) -> int:
+        """Max number of header chunk requests in flight during catch-up."""
+        return max(1, int(self.config.get('header_sync_window', 4)))
+
+    def note_headers_synced(self, num_headers: int) -> None:
+        self._header_sync_samples.append((time.monotonic(), num_headers))
+        metrics.inc('headers_synced_total', num_headers)
+
+    def get_header_sync_rate(self) -> float:
+        """Headers per second during the current catch-up, 0 when idle."""
+        samples = list(self._header_sync_samples)
+        if len(samples) < 2 or time.monotonic() - samples[-1][0] > 60:
+            return 0.
+        elapsed = samples[-1][0] - samples[0][0]
+        if elapsed <= 0:
+            return 0.
+        return sum(n for t, n in samples[1:]) / elapsed
+
     def get_network_timeout_seconds(self, request_type=NetworkTimeout.Generic) -> int:
         if self.oneserver and not self.auto_connect:
             return request_type.MOST_RELAXED
@@ -749,10 +789,11 @@ class Network(PrintError):
         self.trigger_callback('network_updated')
 
     async def _init_headers_file(self):
-        b = blockchain.get_best_chain()
+        b = blockchain.get_best_chain(self.net)
         filename = b.path()
-        length = HEADER_SIZE * len(FairChains.CHECKPOINTS) * 2016
+        length = HEADER_SIZE * len(self.net.CHECKPOINTS) * 2016
         if not os.path.exists(filename) or os.path.getsize(filename) < length:
+            b.reset_header_store()
             with open(filename, 'wb') as f:
                 if length > 0:
                     f.seek(length-1)
@@ -761,7 +802,12 @@ class Network(PrintError):
         with b.lock:
             b.update_size()
 
-    def best_effort_reliable(func):
+    def best_effort_reliable(func, *, hedge=False):
+        """Runs func on the main interface, which is passed to it as the
+        'interface' keyword argument, and tries again on disconnects and
+        timeouts. If hedge is set and the 'request_hedging' config option
+        is enabled, slow requests are also sent to another interface.
+        """
         async def make_reliable_wrapper(self, *args, **kwargs):
             for i in range(10):
                 iface = self.interface
@@ -777,8 +823,13 @@ class Network(PrintError):
                     await asyncio.sleep(0.1)
                     continue  # try again
                 # try actual request
-                success_fut = asyncio.ensure_future(func(self, *args, **kwargs))
+                if hedge and self.config.get('request_hedging', False):
+                    success_fut = asyncio.ensure_future(self._hedged_request(func, iface, args, kwargs))
+                else:
+                    success_fut = asyncio.ensure_future(func(self, *args, interface=iface, **kwargs))
                 await asyncio.wait([success_fut, iface_disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if not success_fut.done():
+                    success_fut.cancel()
                 if success_fut.done() and not success_fut.cancelled():
                     if success_fut.exception():
                         try:
@@ -792,6 +843,59 @@ class Network(PrintError):
             raise BestEffortRequestFailed('no interface to do request on... gave up.')
         return make_reliable_wrapper
 
+    # for idempotent requests whose answers the client can check, or
+    # tolerate from any server
+    hedged_best_effort_reliable = partial(best_effort_reliable, hedge=True)
+
+    def get_hedge_interfaces(self, iface: Interface) -> List[Interface]:
+        """Usable interfaces on the blockchain of iface, other than
+        iface, fastest first. Interfaces with too few answers yet to
+        measure their latency come last."""
+        with self.interfaces_lock:
+            interfaces = list(self.interfaces.values())
+        others = [(other.get_latency_percentile(50), other) for other in interfaces
+                  if other is not iface and other.blockchain is iface.blockchain
+                  and other.ready.done() and not other.ready.cancelled()
+                  and other.session and not other.session.is_closing()]
+        others.sort(key=lambda x: (x[0] is None, x[0] or 0))
+        return [other for latency, other in others]
+
+    def get_hedge_delay(self, iface: Interface) -> float:
+        percentile = self.config.get('request_hedge_percentile', 95)
+        delay = iface.get_latency_percentile(percentile)
+        if delay is None:
+            return DEFAULT_HEDGE_DELAY
+        return max(delay, MIN_HEDGE_DELAY)
+
+    async def _hedged_request(self, func, iface: Interface, args, kwargs):
+        """Runs func on iface. If iface has not answered within its usual
+        latency, func is also run on the fastest other interface, and the
+        first answer wins. If both fail, the error of iface is raised.
+        """
+        main_fut = asyncio.ensure_future(func(self, *args, interface=iface, **kwargs))
+        pending = {main_fut}
+        try:
+            await asyncio.wait([main_fut], timeout=self.get_hedge_delay(iface))
+            others = self.get_hedge_interfaces(iface) if not main_fut.done() else []
+            if not others:
+                return await main_fut
+            metrics.inc('hedged_requests_total')
+            hedge_fut = asyncio.ensure_future(func(self, *args, interface=others[0], **kwargs))
+            pending = {main_fut, hedge_fut}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    if not fut.cancelled() and fut.exception() is None:
+                        if fut is hedge_fut:
+                            metrics.inc('hedged_requests_won_total')
+                        return fut.result()
+            if hedge_fut.done() and not hedge_fut.cancelled():
+                self.print_error(f"hedged request to {others[0].host} failed: {repr(hedge_fut.exception())}")
+            return main_fut.result()
+        finally:
+            for fut in pending:
+                fut.cancel()
+
     def catch_server_exceptions(func):
         async def wrapper(self, *args, **kwargs):
             try:
@@ -800,21 +904,49 @@ class Network(PrintError):
                 raise UntrustedServerReturnedError(original_exception=e) from e
         return wrapper
 
-    @best_effort_reliable
+    @hedged_best_effort_reliable
     @catch_server_exceptions
-    async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
+    async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int, *, interface: Interface) -> dict:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
         if not is_non_negative_integer(tx_height):
             raise Exception(f"{repr(tx_height)} is not a block height")
-        return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
+        return await interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
 
     @best_effort_reliable
+    @catch_server_exceptions
+    async def get_merkles_for_transactions(self, txs: Sequence[Tuple[str, int]], *,
+                                           interface: Interface) -> List[Union[dict, UntrustedServerReturnedError]]:
+        """Like get_merkle_for_transaction, for (tx_hash, tx_height) pairs,
+        in one batch request. Server errors are returned in place.
+        """
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await interface.session.send_batch_request(
+            'blockchain.transaction.get_merkle', [[tx_hash, tx_height] for tx_hash, tx_height in txs],
+            raise_errors=False)
+        return [UntrustedServerReturnedError(original_exception=r) if isinstance(r, Exception) else r
+                for r in results]
+
     async def broadcast_transaction(self, tx, *, timeout=None) -> None:
         if timeout is None:
             timeout = self.get_network_timeout_seconds(NetworkTimeout.Urgent)
+        # the answer of the main server decides; the others only help propagation.
+        # they are sent the tx once, not again on every retry of the main server
+        num_others = self.config.get('broadcast_servers', 1) - 1
+        interface = self.interface
+        if num_others > 0 and interface:
+            for other in self.get_hedge_interfaces(interface)[:num_others]:
+                await self.main_taskgroup.spawn(self._broadcast_to_other_interface(tx, other, timeout))
+        await self._broadcast_transaction(tx, timeout=timeout)
+
+    @best_effort_reliable
+    async def _broadcast_transaction(self, tx, *, timeout, interface: Interface) -> None:
         try:
-            out = await self.interface.session.send_request('blockchain.transaction.broadcast', [str(tx)], timeout=timeout)
+            out = await interface.session.send_request('blockchain.transaction.broadcast', [str(tx)], timeout=timeout)
             # note: both 'out' and exception messages are untrusted input from the server
         except (RequestTimedOut, asyncio.CancelledError, asyncio.TimeoutError):
             raise  # pass-through
@@ -829,6 +961,17 @@ class Network(PrintError):
             self.print_error(f"unexpected txid for broadcast_transaction: {out} != {tx.txid()}")
             raise TxBroadcastHashMismatch(_("Server returned unexpected transaction ID."))
 
+    @ignore_exceptions  # do not kill main_taskgroup
+    @log_exceptions
+    async def _broadcast_to_other_interface(self, tx, iface: Interface, timeout) -> None:
+        try:
+            out = await iface.session.send_request('blockchain.transaction.broadcast', [str(tx)], timeout=timeout)
+        except (aiorpcx.jsonrpc.CodeMessageError, RequestTimedOut) as e:
+            self.print_error(f"broadcast_transaction to {iface.host} failed: {repr(e)}")
+            return
+        if out != tx.txid():
+            self.print_error(f"unexpected txid for broadcast_transaction from {iface.host}: {out} != {tx.txid()}")
+
     @staticmethod
     def sanitize_tx_broadcast_response(server_msg) -> str:
         # Unfortunately, bitcoind and hence the Electrum protocol doesn't return a useful error code.
@@ -965,39 +1108,55 @@ class Network(PrintError):
 
     @best_effort_reliable
     @catch_server_exceptions
-    async def request_chunk(self, height: int, tip=None, *, can_return_early=False):
+    async def request_chunk(self, height: int, tip=None, *, can_return_early=False, interface: Interface):
         if not is_non_negative_integer(height):
             raise Exception(f"{repr(height)} is not a block height")
-        return await self.interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
+        return await interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
 
-    @best_effort_reliable
+    @hedged_best_effort_reliable
     @catch_server_exceptions
-    async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
+    async def get_transaction(self, tx_hash: str, *, timeout=None, interface: Interface) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
-        return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash],
-                                                         timeout=timeout)
+        return await interface.session.send_request('blockchain.transaction.get', [tx_hash],
+                                                    timeout=timeout)
 
     @best_effort_reliable
     @catch_server_exceptions
-    async def get_history_for_scripthash(self, sh: str) -> List[dict]:
+    async def get_transactions(self, tx_hashes: Sequence[str], *, timeout=None,
+                               interface: Interface) -> List[Union[str, UntrustedServerReturnedError]]:
+        """Fetches several transactions in one batch request. The server
+        error for a tx it does not find is returned in its place.
+        """
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        results = await interface.session.send_batch_request(
+            'blockchain.transaction.get', [[tx_hash] for tx_hash in tx_hashes],
+            timeout=timeout, raise_errors=False)
+        return [UntrustedServerReturnedError(original_exception=r) if isinstance(r, Exception) else r
+                for r in results]
+
+    @hedged_best_effort_reliable
+    @catch_server_exceptions
+    async def get_history_for_scripthash(self, sh: str, *, interface: Interface) -> List[dict]:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
-        return await self.interface.session.send_request('blockchain.scripthash.get_history', [sh])
+        return await interface.session.send_request('blockchain.scripthash.get_history', [sh])
 
     @best_effort_reliable
     @catch_server_exceptions
-    async def listunspent_for_scripthash(self, sh: str) -> List[dict]:
+    async def listunspent_for_scripthash(self, sh: str, *, interface: Interface) -> List[dict]:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
-        return await self.interface.session.send_request('blockchain.scripthash.listunspent', [sh])
+        return await interface.session.send_request('blockchain.scripthash.listunspent', [sh])
 
     @best_effort_reliable
     @catch_server_exceptions
-    async def get_balance_for_scripthash(self, sh: str) -> dict:
+    async def get_balance_for_scripthash(self, sh: str, *, interface: Interface) -> dict:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
-        return await self.interface.session.send_request('blockchain.scripthash.get_balance', [sh])
+        return await interface.session.send_request('blockchain.scripthash.get_balance', [sh])
 
     def blockchain(self) -> Blockchain:
         interface = self.interface
@@ -1007,7 +1166,7 @@ class Network(PrintError):
 
     def get_blockchains(self):
         out = {}  # blockchain_id -> list(interfaces)
-        with blockchain.blockchains_lock: blockchain_items = list(blockchain.blockchains.items())
+        with blockchain.blockchains_lock: blockchain_items = list(blockchain.get_blockchains(self.net).items())
         with self.interfaces_lock: interfaces_values = list(self.interfaces.values())
         for chain_id, bc in blockchain_items:
             r = list(filter(lambda i: i.blockchain==bc, interfaces_values))
@@ -1025,7 +1184,7 @@ class Network(PrintError):
         self.config.set_key('blockchain_preferred_block', self._blockchain_preferred_block)
 
     async def follow_chain_given_id(self, chain_id: str) -> None:
-        bc = blockchain.blockchains.get(chain_id)
+        bc = blockchain.get_blockchains(self.net).get(chain_id)
         if not bc:
             raise Exception('blockchain {} not found'.format(chain_id))
         self._set_preferred_chain(bc)
@@ -1106,6 +1265,7 @@ class Network(PrintError):
         self.interface = None  # type: Interface
         self.interfaces = {}  # type: Dict[str, Interface]
         self.connecting.clear()
+        blockchain.flush_blockchains(net=self.net)
         self.server_queue = None
         if not full_shutdown:
             self.trigger_callback('network_updated')
@@ -1157,6 +1317,7 @@ class Network(PrintError):
                 await launch_already_queued_up_new_interfaces()
                 await maybe_queue_new_interfaces_to_be_launched_later()
                 await maintain_main_interface()
+                blockchain.flush_blockchains(force=False, net=self.net)
             except asyncio.CancelledError:
                 # suppress spurious cancellations
                 group = self.main_taskgroup
@@ -1209,7 +1370,7 @@ class Network(PrintError):
         while not self.is_connected():
             await asyncio.sleep(1)
         session = self.interface.session
-        return parse_servers(await session.send_request('server.peers.subscribe'))
+        return parse_servers(await session.send_request('server.peers.subscribe'), net=self.net)
 
     async def send_multiple_requests(self, servers: List[str], method: str, params: Sequence):
         responses = dict()
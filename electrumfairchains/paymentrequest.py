@@ -460,7 +460,7 @@ class InvoiceStore(object):
         self.storage = storage
         self.invoices = {}
         self.paid = {}
-        d = self.storage.get('invoices', {})
+        d = self.storage.get_readonly('invoices', {})
         self.load(d)
 
     def set_paid(self, pr, txid):
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Compares the coin choosers on synthetic sets of p2pkh coins.
+# usage: coinchooser_benchmark.py [num_coins ...]
+
+import sys
+import time
+import hashlib
+import random
+
+from electrumfairchains import bitcoin
+from electrumfairchains.coinchooser import COIN_CHOOSERS
+from electrumfairchains.transaction import TxOutput
+
+
+FEE_PER_BYTE = 10
+DUST_THRESHOLD = 546
+
+
+def make_coins(num_coins, rng):
+    coins = []
+    for k in range(num_coins):
+        # about two coins per address; the pubkeys need not be valid points
+        pubkey = '02' + hashlib.sha256(b'coinchooser_benchmark %d' % (k // 2)).hexdigest()
+        coins.append({
+            'type': 'p2pkh',
+            'address': bitcoin.pubkey_to_address('p2pkh', pubkey),
+            'prevout_hash': hashlib.sha256(b'prevout %d' % k).hexdigest(),
+            'prevout_n': 0,
+            'x_pubkeys': [pubkey],
+            'pubkeys': [pubkey],
+            'signatures': [None],
+            'num_sig': 1,
+            'value': int(rng.lognormvariate(15, 2)) + DUST_THRESHOLD,
+            'height': rng.randint(1, 1000),
+            'coinbase': False,
+        })
+    return coins
+
+
+def run(name, coins, amount):
+    chooser = COIN_CHOOSERS[name]()
+    outputs = [TxOutput(bitcoin.TYPE_ADDRESS, coins[0]['address'], amount)]
+    change_addrs = [coins[1]['address']]
+    t0 = time.time()
+    tx = chooser.make_tx(coins, [], outputs, change_addrs,
+                         lambda size: FEE_PER_BYTE * size, DUST_THRESHOLD)
+    dt = time.time() - t0
+    has_change = len(tx.outputs()) > 1
+    return dt, len(tx.inputs()), tx.get_fee(), has_change
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 5000, 20000, 50000]
+    rng = random.Random(0)
+    for num_coins in sizes:
+        coins = make_coins(num_coins, rng)
+        total = sum(c['value'] for c in coins)
+        # the last two amounts can be paid exactly by one or three
+        # address buckets, minus roughly the fee; the latter costs
+        # more in fees than a smaller selection with change
+        exact1 = coins[2]['value'] + coins[3]['value'] - FEE_PER_BYTE * 350
+        exact3 = sum(c['value'] for c in coins[4:10]) - FEE_PER_BYTE * 950
+        for amount in [total // 1000, total // 100, exact1, exact3]:
+            for name in sorted(COIN_CHOOSERS):
+                dt, num_inputs, fee, has_change = run(name, coins, amount)
+                print("{} coins, amount {}: {:>14} {:.2f}s, {} inputs, fee {}, {}".format(
+                    num_coins, amount, name, dt, num_inputs, fee,
+                    'change' if has_change else 'no change'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Compares RawTxParser with the BCDataStream based deserializer it replaced,
+# on the transactions of a wallet file or on a file with one raw tx per line.
+# usage: rawtx_benchmark.py <wallet_file | raw_tx_file> [rounds]
+
+import os
+import sys
+import time
+import traceback
+import contextlib
+
+from electrumfairchains.bitcoin import hash_encode, COIN, TOTAL_COIN_SUPPLY_LIMIT_IN_BTC
+from electrumfairchains.storage import WalletStorage
+from electrumfairchains.transaction import (BCDataStream, RawTxParser, SerializationError, deserialize,
+                                             parse_scriptSig, parse_witness, get_address_from_output_script,
+                                             PARTIAL_TXN_HEADER_MAGIC)
+from electrumfairchains.util import bh2u, bfh, print_error
+
+
+# the deserializer as it was before RawTxParser
+
+def old_parse_input(vds, full_parse: bool):
+    d = {}
+    prevout_hash = hash_encode(vds.read_bytes(32))
+    prevout_n = vds.read_uint32()
+    scriptSig = vds.read_bytes(vds.read_compact_size())
+    sequence = vds.read_uint32()
+    d['prevout_hash'] = prevout_hash
+    d['prevout_n'] = prevout_n
+    d['scriptSig'] = bh2u(scriptSig)
+    d['sequence'] = sequence
+    d['type'] = 'unknown' if prevout_hash != '00'*32 else 'coinbase'
+    d['address'] = None
+    d['num_sig'] = 0
+    if not full_parse:
+        return d
+    d['x_pubkeys'] = []
+    d['pubkeys'] = []
+    d['signatures'] = {}
+    if d['type'] != 'coinbase' and scriptSig:
+        try:
+            parse_scriptSig(d, scriptSig)
+        except BaseException:
+            traceback.print_exc(file=sys.stderr)
+            print_error('failed to parse scriptSig', bh2u(scriptSig))
+    return d
+
+
+def old_parse_output(vds, i):
+    d = {}
+    d['value'] = vds.read_int64()
+    if d['value'] > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
+        raise SerializationError('invalid output amount (too large)')
+    if d['value'] < 0:
+        raise SerializationError('invalid output amount (negative)')
+    scriptPubKey = vds.read_bytes(vds.read_compact_size())
+    d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
+    d['scriptPubKey'] = bh2u(scriptPubKey)
+    d['prevout_n'] = i
+    return d
+
+
+def old_deserialize(raw: str, force_full_parse=False) -> dict:
+    raw_bytes = bfh(raw)
+    d = {}
+    if raw_bytes[:5] == PARTIAL_TXN_HEADER_MAGIC:
+        d['partial'] = is_partial = True
+        partial_format_version = raw_bytes[5]
+        if partial_format_version != 0:
+            raise SerializationError('unknown tx partial serialization format version: {}'
+                                     .format(partial_format_version))
+        raw_bytes = raw_bytes[6:]
+    else:
+        d['partial'] = is_partial = False
+    full_parse = force_full_parse or is_partial
+    vds = BCDataStream()
+    vds.write(raw_bytes)
+    d['version'] = vds.read_int32()
+    n_vin = vds.read_compact_size()
+    is_segwit = (n_vin == 0)
+    if is_segwit:
+        marker = vds.read_bytes(1)
+        if marker != b'\x01':
+            raise ValueError('invalid txn marker byte: {}'.format(marker))
+        n_vin = vds.read_compact_size()
+    d['segwit_ser'] = is_segwit
+    d['inputs'] = [old_parse_input(vds, full_parse=full_parse) for i in range(n_vin)]
+    n_vout = vds.read_compact_size()
+    d['outputs'] = [old_parse_output(vds, i) for i in range(n_vout)]
+    if is_segwit:
+        for i in range(n_vin):
+            txin = d['inputs'][i]
+            parse_witness(vds, txin, full_parse=full_parse)
+    d['lockTime'] = vds.read_uint32()
+    if vds.can_read_more():
+        raise SerializationError('extra junk at the end')
+    return d
+
+
+def is_wallet_file(path):
+    with open(path, 'rb') as f:
+        start = f.read(16)
+    return start.startswith(b'{') or start.startswith(b'SQLite format 3')
+
+
+def load_raw_txs(path):
+    if not is_wallet_file(path):
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    storage = WalletStorage(path, manual_upgrades=True)
+    if storage.is_encrypted():
+        sys.exit("wallet file is encrypted")
+    if storage.requires_upgrade():
+        sys.exit("wallet file must be upgraded first")
+    return [str(storage.db.get_transaction(tx_hash)) for tx_hash in storage.db.list_transactions()]
+
+
+CASES = [
+    ('full deserialize',
+     lambda raw: old_deserialize(raw, True),
+     lambda raw: deserialize(raw, True)),
+    ('deserialize',
+     lambda raw: old_deserialize(raw),
+     lambda raw: deserialize(raw)),
+    ('outpoints only',
+     lambda raw: [(txin['prevout_hash'], txin['prevout_n']) for txin in old_deserialize(raw)['inputs']],
+     lambda raw: RawTxParser(bfh(raw)).outpoints()),
+    ('outputs only',
+     lambda raw: [(o['type'], o['address'], o['value']) for o in old_deserialize(raw)['outputs']],
+     lambda raw: [tuple(o) for o in RawTxParser(bfh(raw)).outputs()]),
+]
+
+
+def timed(funcs, raw_txs, rounds):
+    """Best time of each of funcs over all raw_txs. The funcs take turns
+    in every round, so that they see the same machine load."""
+    best = [None] * len(funcs)
+    for _ in range(rounds):
+        for i, func in enumerate(funcs):
+            t0 = time.perf_counter()
+            for raw in raw_txs:
+                func(raw)
+            dt = time.perf_counter() - t0
+            best[i] = dt if best[i] is None else min(best[i], dt)
+    return best
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit("usage: rawtx_benchmark.py <wallet_file | raw_tx_file> [rounds]")
+    path = sys.argv[1]
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    raw_txs = load_raw_txs(path)
+    if not raw_txs:
+        sys.exit("no transactions found")
+    size = sum(len(raw) // 2 for raw in raw_txs)
+    print("{} transactions, {} bytes, best of {} rounds".format(len(raw_txs), size, rounds))
+    for name, old, new in CASES:
+        # both parsers print the scriptSigs they cannot parse
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+            for raw in raw_txs:
+                assert old(raw) == new(raw), raw
+            dt_old, dt_new = timed([old, new], raw_txs, rounds)
+        print("{:<18} old {:8.2f} us/tx   RawTxParser {:8.2f} us/tx   {:5.2f}x".format(
+            name, dt_old / len(raw_txs) * 1e6, dt_new / len(raw_txs) * 1e6, dt_old / dt_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Compares request latency of the polling and the asyncio JSON-RPC
+# servers under many concurrent clients. Commands are simulated: most
+# are quick reads, some are slow reads, and some modify the wallet and
+# are serialized behind a lock, as the daemon does.
+# usage: rpc_loadtest.py [num_clients] [requests_per_client]
+
+import sys
+import time
+import base64
+import random
+import asyncio
+import threading
+
+import aiohttp
+
+from electrumfairchains.jsonrpc import VerifyingJSONRPCServer, AsyncJSONRPCServer
+
+
+RPC_USER = 'user'
+RPC_PASSWORD = 'password'
+
+wallet_lock = threading.Lock()
+
+
+def getbalance():
+    time.sleep(0.001)
+    return '1.0'
+
+
+def history():
+    time.sleep(0.050)
+    return []
+
+
+def setlabel(key, label):
+    with wallet_lock:
+        time.sleep(0.005)
+        return True
+
+
+def register_functions(server):
+    server.register_function(getbalance, 'getbalance')
+    server.register_function(history, 'history')
+    server.register_function(setlabel, 'setlabel')
+
+
+def random_call(rng, k):
+    r = rng.random()
+    if r < 0.8:
+        return {'jsonrpc': '2.0', 'id': k, 'method': 'getbalance', 'params': []}
+    elif r < 0.9:
+        return {'jsonrpc': '2.0', 'id': k, 'method': 'history', 'params': []}
+    else:
+        return {'jsonrpc': '2.0', 'id': k, 'method': 'setlabel', 'params': ['key', 'label']}
+
+
+async def client(url, num_requests, seed, latencies):
+    rng = random.Random(seed)
+    credentials = base64.b64encode(('%s:%s' % (RPC_USER, RPC_PASSWORD)).encode('utf8'))
+    headers = {'Authorization': 'Basic ' + credentials.decode('ascii')}
+    async with aiohttp.ClientSession(headers=headers) as session:
+        for k in range(num_requests):
+            t0 = time.time()
+            async with session.post(url, json=random_call(rng, k)) as resp:
+                response = await resp.json(content_type=None)
+            assert 'result' in response, response
+            latencies.append(time.time() - t0)
+
+
+async def run_clients(url, num_clients, num_requests):
+    latencies = []
+    t0 = time.time()
+    await asyncio.gather(*[client(url, num_requests, seed, latencies)
+                           for seed in range(num_clients)])
+    return time.time() - t0, sorted(latencies)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, total_time, latencies):
+    print("{:>8}: {} requests in {:.2f}s, p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+        name, len(latencies), total_time,
+        1000 * percentile(latencies, 50), 1000 * percentile(latencies, 99),
+        1000 * latencies[-1]))
+
+
+def bench_polling(num_clients, num_requests):
+    server = VerifyingJSONRPCServer(('127.0.0.1', 0), logRequests=False,
+                                    rpc_user=RPC_USER, rpc_password=RPC_PASSWORD)
+    server.timeout = 0.1
+    register_functions(server)
+    running = True
+    def serve():
+        while running:
+            server.handle_request()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    host, port = server.socket.getsockname()
+    try:
+        url = 'http://%s:%d/' % (host, port)
+        return asyncio.run(run_clients(url, num_clients, num_requests))
+    finally:
+        running = False
+        thread.join()
+        server.server_close()
+
+
+def bench_asyncio(num_clients, num_requests):
+    async def run():
+        server = AsyncJSONRPCServer('127.0.0.1', 0, rpc_user=RPC_USER, rpc_password=RPC_PASSWORD)
+        register_functions(server)
+        await server.start()
+        try:
+            url = 'http://%s:%d/' % server.getsockname()
+            return await run_clients(url, num_clients, num_requests)
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+
+def main():
+    num_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print("{} clients, {} requests each".format(num_clients, num_requests))
+    report('polling', *bench_polling(num_clients, num_requests))
+    report('asyncio', *bench_asyncio(num_clients, num_requests))
+
+
+if __name__ == '__main__':
+    main()
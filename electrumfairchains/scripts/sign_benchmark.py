@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Compares serial and parallel signing of a p2pkh transaction with many
+# inputs, with and without libsecp256k1.
+# usage: sign_benchmark.py [num_inputs] [num_workers]
+
+import sys
+import time
+import hashlib
+import multiprocessing
+
+from electrumfairchains import bitcoin, ecc, ecc_fast
+from electrumfairchains.transaction import Transaction, TxOutput
+from electrumfairchains.signing_pool import SigningPool, set_signing_pool
+
+
+def make_tx(num_inputs):
+    keypairs = {}
+    inputs = []
+    for k in range(num_inputs):
+        secret = hashlib.sha256(b'sign_benchmark %d' % k).digest()
+        pubkey = ecc.ECPrivkey(secret).get_public_key_hex(compressed=True)
+        keypairs[pubkey] = (secret, True)
+        inputs.append({
+            'type': 'p2pkh',
+            'address': bitcoin.pubkey_to_address('p2pkh', pubkey),
+            'prevout_hash': hashlib.sha256(b'prevout %d' % k).hexdigest(),
+            'prevout_n': 0,
+            'x_pubkeys': [pubkey],
+            'pubkeys': [pubkey],
+            'signatures': [None],
+            'num_sig': 1,
+            'value': 100000,
+        })
+    outputs = [TxOutput(bitcoin.TYPE_ADDRESS, inputs[0]['address'], 100000 * num_inputs - 10000)]
+    return Transaction.from_io(inputs, outputs), keypairs
+
+
+def run(num_inputs, pool):
+    set_signing_pool(pool)
+    tx, keypairs = make_tx(num_inputs)
+    if pool:
+        # start all workers before timing
+        secret = next(iter(keypairs.values()))[0]
+        pool.sign_hashes([(bytes(32), secret)] * pool.num_workers * 4)
+    t0 = time.time()
+    tx.sign(keypairs)
+    dt = time.time() - t0
+    assert tx.is_complete()
+    set_signing_pool(None)
+    return dt, tx.txid()
+
+
+def main():
+    num_inputs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    modes = [False]
+    if ecc_fast._libsecp256k1:
+        modes.append(True)
+    else:
+        print("libsecp256k1 not available, benchmarking python-ecdsa only")
+    for fast_ecc in modes:
+        if fast_ecc:
+            ecc_fast.do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+        else:
+            ecc_fast.undo_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+        name = 'libsecp256k1' if fast_ecc else 'python-ecdsa'
+        serial, txid1 = run(num_inputs, None)
+        parallel, txid2 = run(num_inputs, SigningPool(num_workers, min_signatures=0))
+        assert txid1 == txid2
+        print("{}: {} inputs, serial {:.2f}s, {} workers {:.2f}s".format(
+            name, num_inputs, serial, num_workers, parallel))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2019 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Opt-in process pool that signs the inputs of large transactions in
+# parallel. It is disabled unless the 'sign_workers' config option is set.
+# Secrets are passed to the workers through the pool's pipes only, as
+# bytearrays that are zeroed once the signature has been made.
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence, Tuple, List
+
+from . import ecc, ecc_fast
+from .util import PrintError, bh2u
+
+
+# below this many signatures, Transaction.sign stays serial
+DEFAULT_MIN_SIGNATURES = 32
+
+
+def _init_worker(use_fast_ecc: bool):
+    # workers follow the ecc implementation of the parent process
+    if not use_fast_ecc:
+        ecc_fast.undo_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
+
+
+def _sign_batch(jobs: Sequence[Tuple[bytes, bytearray]]) -> List[str]:
+    sigs = []
+    try:
+        for pre_hash, secret in jobs:
+            privkey = ecc.ECPrivkey(bytes(secret))
+            sigs.append(bh2u(privkey.sign_transaction(pre_hash)) + '01')
+    finally:
+        for pre_hash, secret in jobs:
+            secret[:] = bytes(len(secret))
+    return sigs
+
+
+class SigningPool(PrintError):
+
+    def __init__(self, num_workers: int, min_signatures: int = DEFAULT_MIN_SIGNATURES):
+        self.num_workers = num_workers
+        self.min_signatures = min_signatures
+        self.lock = threading.Lock()
+        self._executor = None  # type: Optional[ProcessPoolExecutor]
+        self._executor_fast_ecc = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        use_fast_ecc = ecc_fast.is_using_fast_ecc()
+        with self.lock:
+            if self._executor is not None and self._executor_fast_ecc != use_fast_ecc:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._executor is None:
+                self.print_error("starting {} workers".format(self.num_workers))
+                # spawn, not fork: the daemon has network and GUI threads
+                self._executor = ProcessPoolExecutor(max_workers=self.num_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_init_worker,
+                                                     initargs=(use_fast_ecc,))
+                self._executor_fast_ecc = use_fast_ecc
+            return self._executor
+
+    def sign_hashes(self, jobs: Sequence[Tuple[bytes, bytes]]) -> List[str]:
+        """Signs each (hashed preimage, secret) pair and returns the
+        signatures as hex with SIGHASH_ALL appended, in order.
+        """
+        executor = self._get_executor()
+        secrets = [bytearray(secret) for pre_hash, secret in jobs]
+        try:
+            items = [(pre_hash, secret) for (pre_hash, _), secret in zip(jobs, secrets)]
+            # a few batches per worker, so that slow workers do not stall the others
+            n = max(1, -(-len(items) // (self.num_workers * 4)))
+            batches = [items[k:k+n] for k in range(0, len(items), n)]
+            sigs = []
+            for batch_sigs in executor.map(_sign_batch, batches):
+                sigs.extend(batch_sigs)
+            return sigs
+        finally:
+            for secret in secrets:
+                secret[:] = bytes(len(secret))
+
+    def shutdown(self):
+        with self.lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+_signing_pool = None  # type: Optional[SigningPool]
+
+
+def get_signing_pool() -> Optional[SigningPool]:
+    return _signing_pool
+
+
+def set_signing_pool(pool: Optional[SigningPool]) -> None:
+    global _signing_pool
+    if _signing_pool is not None and _signing_pool is not pool:
+        _signing_pool.shutdown()
+    _signing_pool = pool
+
+
+def init_signing_pool(config) -> None:
+    num_workers = config.get('sign_workers', 0)
+    if num_workers == -1:
+        num_workers = multiprocessing.cpu_count()
+    if num_workers > 0:
+        min_signatures = config.get('sign_workers_min_signatures', DEFAULT_MIN_SIGNATURES)
+        set_signing_pool(SigningPool(num_workers, min_signatures))
+    else:
+        set_signing_pool(None)
@@ -138,6 +138,11 @@ class SimpleConfig(PrintError):
         make_dir(path, allow_symlink=False)
         return path
 
+    @property
+    def net(self) -> 'FairChain':
+        '''Parameters of the FairChain this config is for.'''
+        return get_fairchain(self.get_global('selected_fairchain'))
+
     def efc_path_global(self):
         # Read efc_path from command line
         # Otherwise use the user's default data directory.
@@ -658,10 +663,9 @@ def read_json(filename, default):
 def inv_dict(d):
     return {v: k for k, v in d.items()}
 
-class FairChains():
+class FairChain():
 
-    def __init__(self):
-        fairchain = SimpleConfig().get_global('selected_fairchain')
+    def __init__(self, fairchain):
         FCs=read_json('fairchains.json',[])
         if not fairchain in FCs:
             fairchain=FCs[0]
@@ -669,6 +673,7 @@ class FairChains():
         FC =read_json(fairchain+'.json', {})
         FCx=read_json(fairchain+'.electrumx.json', {})
 
+        self.FAIRCHAIN = fairchain
         self.TESTNET = False
         self.NAME            = FC['data']['currencyName']
         self.SHORTNAME       = FC['data']['currencySymbol']
@@ -716,4 +721,16 @@ class FairChains():
         self.base_units_list = [ self.SHORTNAME, 'm'+self.SHORTNAME, 'u'+self.SHORTNAME, 'sat']  # list(dict) does not guarantee order
         self.DECIMAL_POINT_DEFAULT = 8
 
-FairChains=FairChains()
+
+_fairchains = {}
+_fairchains_lock = threading.Lock()
+
+def get_fairchain(fairchain) -> FairChain:
+    with _fairchains_lock:
+        net = _fairchains.get(fairchain)
+        if net is None:
+            net = _fairchains[fairchain] = FairChain(fairchain)
+        return net
+
+# parameters of the selected FairChain, used wherever no net is passed
+FairChains = get_fairchain(SimpleConfig().get_global('selected_fairchain'))
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2019 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import json
+import sqlite3
+from collections import OrderedDict
+from typing import Optional
+
+from .util import TxMinedInfo
+from .transaction import Transaction
+from .json_db import BaseDB, JsonDBJsonEncoder, FINAL_SEED_VERSION, locked, modifier
+
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# number of deserialized transactions kept in memory
+TX_CACHE_SIZE = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS txi (tx_hash TEXT NOT NULL, addr TEXT NOT NULL,
+    prevout TEXT NOT NULL, value INTEGER NOT NULL,
+    PRIMARY KEY (tx_hash, addr, prevout));
+CREATE TABLE IF NOT EXISTS txo (tx_hash TEXT NOT NULL, addr TEXT NOT NULL,
+    n INTEGER NOT NULL, value INTEGER NOT NULL, is_coinbase INTEGER NOT NULL,
+    PRIMARY KEY (tx_hash, addr, n));
+CREATE INDEX IF NOT EXISTS txo_addr ON txo (addr);
+CREATE TABLE IF NOT EXISTS transactions (tx_hash TEXT PRIMARY KEY, raw TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS spent_outpoints (prevout_hash TEXT NOT NULL,
+    prevout_n TEXT NOT NULL, tx_hash TEXT NOT NULL,
+    PRIMARY KEY (prevout_hash, prevout_n));
+CREATE TABLE IF NOT EXISTS addr_history (addr TEXT PRIMARY KEY, history TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS addr_status (addr TEXT PRIMARY KEY, status TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS verified_tx (txid TEXT PRIMARY KEY, height INTEGER,
+    timestamp INTEGER, txpos INTEGER, header_hash TEXT);
+CREATE TABLE IF NOT EXISTS tx_fees (txid TEXT PRIMARY KEY, fee TEXT NOT NULL);
+'''
+
+
+def is_sqlite_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+class SqliteDB(BaseDB):
+    """Wallet db with the history tables (txi, txo, transactions, ...) kept
+    in an sqlite file instead of memory. The remaining keys are small; they
+    are loaded into self.data as usual and written back to the kv table.
+
+    Changes become durable on commit(), i.e. when the storage is written.
+    """
+
+    def __init__(self, path, *, manual_upgrades):
+        BaseDB.__init__(self, manual_upgrades=manual_upgrades)
+        self._tx_cache = OrderedDict()  # type: OrderedDict[str, Transaction]
+        # all access is serialised by self.lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        for key, value in self.conn.execute('SELECT key, value FROM kv'):
+            self.data[key] = json.loads(value)
+        if not self.data:
+            self.put('seed_version', FINAL_SEED_VERSION)
+        elif not manual_upgrades and self.requires_upgrade():
+            self.upgrade()
+
+    @locked
+    def commit(self):
+        for path in self._dirty_paths:
+            key = path[0]
+            if key not in self.data:
+                self.conn.execute('DELETE FROM kv WHERE key=?', (key,))
+            else:
+                value = json.dumps(self.data[key], cls=JsonDBJsonEncoder)
+                self.conn.execute('REPLACE INTO kv (key, value) VALUES (?, ?)', (key, value))
+        self._dirty_paths.clear()
+        self.conn.commit()
+
+    @locked
+    def close(self):
+        self.conn.close()
+
+    def upgrade(self):
+        # sqlite wallets are created at FINAL_SEED_VERSION, the older
+        # formats only exist as json files
+        self.put('seed_version', FINAL_SEED_VERSION)
+
+    # txi / txo
+
+    @locked
+    def get_txi(self, tx_hash):
+        c = self.conn.execute('SELECT DISTINCT addr FROM txi WHERE tx_hash=?', (tx_hash,))
+        return [row[0] for row in c]
+
+    @locked
+    def get_txo(self, tx_hash):
+        c = self.conn.execute('SELECT DISTINCT addr FROM txo WHERE tx_hash=?', (tx_hash,))
+        return [row[0] for row in c]
+
+    @locked
+    def get_txi_addr(self, tx_hash, address):
+        c = self.conn.execute('SELECT prevout, value FROM txi WHERE tx_hash=? AND addr=?',
+                              (tx_hash, address))
+        return set(c)
+
+    @locked
+    def get_txo_addr(self, tx_hash, address):
+        c = self.conn.execute('SELECT n, value, is_coinbase FROM txo WHERE tx_hash=? AND addr=?',
+                              (tx_hash, address))
+        return set((n, v, bool(is_coinbase)) for n, v, is_coinbase in c)
+
+    @modifier
+    def add_txi_addr(self, tx_hash, addr, ser, v):
+        self.conn.execute('REPLACE INTO txi (tx_hash, addr, prevout, value) VALUES (?, ?, ?, ?)',
+                          (tx_hash, addr, ser, v))
+
+    @modifier
+    def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
+        self.conn.execute('REPLACE INTO txo (tx_hash, addr, n, value, is_coinbase) VALUES (?, ?, ?, ?, ?)',
+                          (tx_hash, addr, n, v, bool(is_coinbase)))
+
+    @locked
+    def list_txi(self):
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT tx_hash FROM txi')]
+
+    @locked
+    def list_txo(self):
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT tx_hash FROM txo')]
+
+    @modifier
+    def remove_txi(self, tx_hash):
+        self.conn.execute('DELETE FROM txi WHERE tx_hash=?', (tx_hash,))
+
+    @modifier
+    def remove_txo(self, tx_hash):
+        self.conn.execute('DELETE FROM txo WHERE tx_hash=?', (tx_hash,))
+
+    # spent outpoints
+
+    @locked
+    def list_spent_outpoints(self):
+        return list(self.conn.execute('SELECT prevout_hash, prevout_n FROM spent_outpoints'))
+
+    @locked
+    def get_spent_outpoints(self, prevout_hash):
+        c = self.conn.execute('SELECT prevout_n FROM spent_outpoints WHERE prevout_hash=?',
+                              (prevout_hash,))
+        return [row[0] for row in c]
+
+    @locked
+    def get_spent_outpoint(self, prevout_hash, prevout_n):
+        row = self.conn.execute('SELECT tx_hash FROM spent_outpoints WHERE prevout_hash=? AND prevout_n=?',
+                                (prevout_hash, str(prevout_n))).fetchone()
+        return row[0] if row else None
+
+    @modifier
+    def remove_spent_outpoint(self, prevout_hash, prevout_n):
+        self.conn.execute('DELETE FROM spent_outpoints WHERE prevout_hash=? AND prevout_n=?',
+                          (prevout_hash, str(prevout_n)))
+
+    @modifier
+    def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
+        self.conn.execute('REPLACE INTO spent_outpoints (prevout_hash, prevout_n, tx_hash) VALUES (?, ?, ?)',
+                          (prevout_hash, str(prevout_n), tx_hash))
+
+    # transactions
+
+    def _cache_tx(self, tx_hash, tx):
+        self._tx_cache[tx_hash] = tx
+        self._tx_cache.move_to_end(tx_hash)
+        if len(self._tx_cache) > TX_CACHE_SIZE:
+            self._tx_cache.popitem(last=False)
+
+    @modifier
+    def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
+        assert isinstance(tx, Transaction)
+        self.conn.execute('REPLACE INTO transactions (tx_hash, raw) VALUES (?, ?)', (tx_hash, str(tx)))
+        self._cache_tx(tx_hash, tx)
+
+    @modifier
+    def remove_transaction(self, tx_hash) -> Optional[Transaction]:
+        tx = self.get_transaction(tx_hash)
+        self.conn.execute('DELETE FROM transactions WHERE tx_hash=?', (tx_hash,))
+        self._tx_cache.pop(tx_hash, None)
+        return tx
+
+    @locked
+    def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
+        tx = self._tx_cache.get(tx_hash)
+        if tx is not None:
+            self._tx_cache.move_to_end(tx_hash)
+            return tx
+        row = self.conn.execute('SELECT raw FROM transactions WHERE tx_hash=?', (tx_hash,)).fetchone()
+        if row is None:
+            return None
+        tx = Transaction(row[0])
+        self._cache_tx(tx_hash, tx)
+        return tx
+
+    @locked
+    def list_transactions(self):
+        return [row[0] for row in self.conn.execute('SELECT tx_hash FROM transactions')]
+
+    # history
+
+    @locked
+    def get_history(self):
+        return [row[0] for row in self.conn.execute('SELECT addr FROM addr_history')]
+
+    @locked
+    def is_addr_in_history(self, addr):
+        # does not mean history is non-empty!
+        c = self.conn.execute('SELECT 1 FROM addr_history WHERE addr=?', (addr,))
+        return c.fetchone() is not None
+
+    @locked
+    def get_addr_history(self, addr):
+        row = self.conn.execute('SELECT history FROM addr_history WHERE addr=?', (addr,)).fetchone()
+        return [tuple(x) for x in json.loads(row[0])] if row else []
+
+    @modifier
+    def set_addr_history(self, addr, hist, status=None):
+        self.conn.execute('REPLACE INTO addr_history (addr, history) VALUES (?, ?)',
+                          (addr, json.dumps(hist)))
+        self.set_addr_status(addr, status)
+
+    @modifier
+    def remove_addr_history(self, addr):
+        self.conn.execute('DELETE FROM addr_history WHERE addr=?', (addr,))
+        self.set_addr_status(addr, None)
+
+    @locked
+    def get_addr_status(self, addr):
+        row = self.conn.execute('SELECT status FROM addr_status WHERE addr=?', (addr,)).fetchone()
+        return row[0] if row else None
+
+    @modifier
+    def set_addr_status(self, addr, status):
+        if status is None:
+            self.conn.execute('DELETE FROM addr_status WHERE addr=?', (addr,))
+        else:
+            self.conn.execute('REPLACE INTO addr_status (addr, status) VALUES (?, ?)', (addr, status))
+
+    # verified tx
+
+    @locked
+    def list_verified_tx(self):
+        return [row[0] for row in self.conn.execute('SELECT txid FROM verified_tx')]
+
+    @locked
+    def get_verified_tx(self, txid):
+        row = self.conn.execute('SELECT height, timestamp, txpos, header_hash FROM verified_tx WHERE txid=?',
+                                (txid,)).fetchone()
+        if row is None:
+            return None
+        height, timestamp, txpos, header_hash = row
+        return TxMinedInfo(height=height,
+                           conf=None,
+                           timestamp=timestamp,
+                           txpos=txpos,
+                           header_hash=header_hash)
+
+    @modifier
+    def add_verified_tx(self, txid, info):
+        self.conn.execute('REPLACE INTO verified_tx (txid, height, timestamp, txpos, header_hash) VALUES (?, ?, ?, ?, ?)',
+                          (txid, info.height, info.timestamp, info.txpos, info.header_hash))
+
+    @modifier
+    def remove_verified_tx(self, txid):
+        self.conn.execute('DELETE FROM verified_tx WHERE txid=?', (txid,))
+
+    @locked
+    def is_in_verified_tx(self, txid):
+        c = self.conn.execute('SELECT 1 FROM verified_tx WHERE txid=?', (txid,))
+        return c.fetchone() is not None
+
+    # fees
+
+    @modifier
+    def update_tx_fees(self, d):
+        self.conn.executemany('REPLACE INTO tx_fees (txid, fee) VALUES (?, ?)',
+                              [(txid, json.dumps(fee)) for txid, fee in d.items()])
+
+    @locked
+    def list_tx_fees(self):
+        return [row[0] for row in self.conn.execute('SELECT txid FROM tx_fees')]
+
+    @locked
+    def get_tx_fee(self, txid):
+        row = self.conn.execute('SELECT fee FROM tx_fees WHERE txid=?', (txid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @modifier
+    def remove_tx_fee(self, txid):
+        self.conn.execute('DELETE FROM tx_fees WHERE txid=?', (txid,))
+
+    @modifier
+    def clear_history(self):
+        for table in ['txi', 'txo', 'spent_outpoints', 'transactions',
+                      'addr_history', 'addr_status', 'verified_tx', 'tx_fees']:
+            self.conn.execute('DELETE FROM {}'.format(table))
+        self._tx_cache.clear()
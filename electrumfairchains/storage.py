@@ -30,10 +30,13 @@ import base64
 import zlib
 
 from . import ecc
+from . import metrics
 from .util import PrintError, profiler, InvalidPassword, WalletFileException, bfh, standardize_path
 from .plugin import run_hook, plugin_loaders
+from .simple_config import FairChains, get_fairchain
 
-from .json_db import JsonDB
+from .json_db import JsonDB, BaseDB
+from .sqlite_db import SqliteDB, is_sqlite_file
 
 
 def get_derivation_used_for_hw_device_encryption():
@@ -48,7 +51,9 @@ STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
 class WalletStorage(PrintError):
 
-    def __init__(self, path, *, manual_upgrades=False):
+    def __init__(self, path, *, manual_upgrades=False, db_type='json'):
+        """db_type selects the format of new wallet files: 'json', or 'sqlite'
+        for wallets with a very large history. Existing files keep theirs."""
         self.lock = threading.RLock()
         self.path = standardize_path(path)
         self._file_exists = self.path and os.path.exists(self.path)
@@ -56,13 +61,21 @@ class WalletStorage(PrintError):
         DB_Class = JsonDB
         self.print_error("wallet path", self.path)
         self.pubkey = None
-        if self.file_exists():
+        if self.file_exists() and is_sqlite_file(self.path):
+            self.raw = ''
+            self._encryption_version = STO_EV_PLAINTEXT
+            self.db = SqliteDB(self.path, manual_upgrades=manual_upgrades)
+            self.load_plugins()
+        elif self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
             self._encryption_version = self._init_encryption_version()
             if not self.is_encrypted():
                 self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades)
                 self.load_plugins()
+        elif db_type == 'sqlite':
+            self._encryption_version = STO_EV_PLAINTEXT
+            self.db = SqliteDB(self.path, manual_upgrades=False)
         else:
             self._encryption_version = STO_EV_PLAINTEXT
             # avoid new wallets getting 'upgraded'
@@ -80,9 +93,19 @@ class WalletStorage(PrintError):
     def get(self, key, default=None):
         return self.db.get(key, default)
 
+    def get_readonly(self, key, default=None):
+        return self.db.get_readonly(key, default)
+
+    @property
+    def net(self):
+        '''Parameters of the FairChain the wallet belongs to. Wallets
+        that predate this record belong to the selected FairChain.'''
+        fairchain = self.get_readonly('fairchain')
+        return get_fairchain(fairchain) if fairchain else FairChains
+
     @profiler
     def write(self):
-        with self.lock:
+        with self.lock, metrics.timer('wallet_save_seconds'):
             self._write()
 
     def _write(self):
@@ -92,6 +115,16 @@ class WalletStorage(PrintError):
         if not self.db.modified():
             return
         self.db.commit()
+        if isinstance(self.db, SqliteDB):
+            if not self.file_exists():
+                os.chmod(self.path, stat.S_IREAD | stat.S_IWRITE)
+                self._file_exists = True
+            self.db.set_modified(False)
+            return
+        records = self.db.get_journal_records() if self.file_exists() else None
+        if records is not None:
+            self._append_records(records)
+            return
         s = self.encrypt_before_writing(self.db.dump())
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
@@ -108,6 +141,18 @@ class WalletStorage(PrintError):
         self.print_error("saved", self.path)
         self.db.set_modified(False)
 
+    def _append_records(self, records):
+        """Appends journal records to the wallet file, one per line.
+        Encrypted wallets encrypt each record separately."""
+        if records:
+            s = ''.join('\n' + self.encrypt_before_writing(r) for r in records)
+            with open(self.path, "a", encoding='utf-8') as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
+            self.print_error("appended {} records to".format(len(records)), self.path)
+        self.db.set_modified(False)
+
     def file_exists(self):
         return self._file_exists
 
@@ -146,7 +191,8 @@ class WalletStorage(PrintError):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            # only the snapshot; journal records follow on later lines
+            magic = base64.b64decode(self.raw.split('\n', 1)[0])[0:4]
             if magic == b'BIE1':
                 return STO_EV_USER_PW
             elif magic == b'BIE2':
@@ -173,14 +219,29 @@ class WalletStorage(PrintError):
 
     def decrypt(self, password):
         ec_key = self.get_eckey_from_password(password)
+        truncated = False
         if self.raw:
             enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
+            lines = self.raw.split('\n')
+            parts = [zlib.decompress(ec_key.decrypt_message(lines[0], enc_magic))]
+            for i, line in enumerate(lines[1:], 1):
+                try:
+                    parts.append(zlib.decompress(ec_key.decrypt_message(line, enc_magic)))
+                except Exception as e:
+                    if i < len(lines) - 1:
+                        raise WalletFileException("Malformed wallet file (journal record {})".format(i - 1)) from e
+                    # interrupted while appending; the record was never complete
+                    self.print_error('ignoring truncated journal record', repr(e))
+                    truncated = True
+            s = b'\n'.join(parts)
         else:
             s = None
         self.pubkey = ec_key.get_public_key_hex()
         s = s.decode('utf8')
         self.db = JsonDB(s, manual_upgrades=True)
+        if truncated:
+            # the next save writes a snapshot, which drops the truncated record
+            self.db.set_modified(True)
         self.load_plugins()
 
     def encrypt_before_writing(self, plaintext: str) -> str:
@@ -209,6 +270,8 @@ class WalletStorage(PrintError):
         if enc_version is None:
             enc_version = self._encryption_version
         if password and enc_version != STO_EV_PLAINTEXT:
+            if isinstance(self.db, SqliteDB):
+                raise WalletFileException('storage encryption is not supported for sqlite wallets')
             ec_key = self.get_eckey_from_password(password)
             self.pubkey = ec_key.get_public_key_hex()
             self._encryption_version = enc_version
@@ -245,3 +308,58 @@ class WalletStorage(PrintError):
     def get_action(self):
         action = run_hook('get_action', self)
         return action
+
+
+DB_TYPES = ('json', 'sqlite')
+
+
+def copy_wallet_db(src: BaseDB, dst: BaseDB) -> None:
+    """Copies the keys and the history of src into the empty db dst."""
+    for key in src.list_keys():
+        dst.put(key, src.get(key))
+    for tx_hash in src.list_txi():
+        for addr in src.get_txi(tx_hash):
+            for ser, v in src.get_txi_addr(tx_hash, addr):
+                dst.add_txi_addr(tx_hash, addr, ser, v)
+    for tx_hash in src.list_txo():
+        for addr in src.get_txo(tx_hash):
+            for n, v, is_coinbase in src.get_txo_addr(tx_hash, addr):
+                dst.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
+    for tx_hash in src.list_transactions():
+        dst.add_transaction(tx_hash, src.get_transaction(tx_hash))
+    for prevout_hash, prevout_n in src.list_spent_outpoints():
+        dst.set_spent_outpoint(prevout_hash, prevout_n, src.get_spent_outpoint(prevout_hash, prevout_n))
+    for addr in src.get_history():
+        hist = [tuple(x) for x in src.get_addr_history(addr)]
+        dst.set_addr_history(addr, hist, src.get_addr_status(addr))
+    for txid in src.list_verified_tx():
+        dst.add_verified_tx(txid, src.get_verified_tx(txid))
+    dst.update_tx_fees({txid: src.get_tx_fee(txid) for txid in src.list_tx_fees()})
+
+
+def convert_wallet_file(path: str, db_type: str) -> str:
+    """Rewrites the wallet file at path in the db_type format, 'json' or
+    'sqlite'. The original file is kept; its new path is returned."""
+    if db_type not in DB_TYPES:
+        raise WalletFileException('Unknown wallet format: {}'.format(db_type))
+    storage = WalletStorage(path)
+    if not storage.file_exists():
+        raise WalletFileException('Wallet file not found: {}'.format(path))
+    if storage.is_encrypted():
+        raise WalletFileException('Remove the wallet file encryption before converting it')
+    if db_type == ('sqlite' if isinstance(storage.db, SqliteDB) else 'json'):
+        raise WalletFileException('The wallet is already in {} format'.format(db_type))
+    backup_path = storage.path + '.bak'
+    if os.path.exists(backup_path):
+        raise WalletFileException('Remove {} first'.format(backup_path))
+    temp_path = "%s.tmp.%s" % (storage.path, os.getpid())
+    new_storage = WalletStorage(temp_path, db_type=db_type)
+    try:
+        copy_wallet_db(storage.db, new_storage.db)
+        new_storage.write()
+    finally:
+        new_storage.db.close()
+        storage.db.close()
+    os.replace(storage.path, backup_path)
+    os.replace(temp_path, storage.path)
+    return backup_path
@@ -27,10 +27,11 @@ import hashlib
 from typing import Dict, List, TYPE_CHECKING
 from collections import defaultdict
 
-from aiorpcx import TaskGroup, run_in_thread
+from aiorpcx import TaskGroup, run_in_thread, ProtocolError
 
 from .transaction import Transaction
 from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer
+from . import metrics
 from .bitcoin import address_to_scripthash, is_address
 from .network import UntrustedServerReturnedError
 
@@ -54,14 +55,23 @@ def history_status(h):
 class SynchronizerBase(NetworkJobOnDefaultServer):
     """Subscribe over the network to a set of addresses, and monitor their statuses.
     Every time a status changes, run a coroutine provided by the subclass.
+
+    Queued addresses are subscribed to in batches of up to
+    'subscription_batch_size', each sent as one JSON-RPC batch request,
+    with at most 'subscription_max_in_flight' subscriptions outstanding.
     """
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
+        config = network.config
+        self.batch_size = max(1, config.get('subscription_batch_size', 100))
+        self.max_in_flight = max(self.batch_size, config.get('subscription_max_in_flight', 500))
         NetworkJobOnDefaultServer.__init__(self, network)
 
     def _reset(self):
         super()._reset()
         self.requested_addrs = set()
+        self.in_flight_semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._server_supports_batches = self.batch_size > 1
         self.scripthash_to_address = {}
         self._processed_some_notifications = False  # so that we don't miss them
         # Queues
@@ -82,25 +92,50 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         asyncio.run_coroutine_threadsafe(self._add_address(addr), self.asyncio_loop)
 
     async def _add_address(self, addr: str):
-        if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
+        if not is_address(addr, net=self.network.net): raise ValueError(f"invalid bitcoin address {addr}")
         if addr in self.requested_addrs: return
         self.requested_addrs.add(addr)
         await self.add_queue.put(addr)
 
+    def _get_scripthash(self, addr: str) -> str:
+        return address_to_scripthash(addr, net=self.network.net)
+
     async def _on_address_status(self, addr, status):
         """Handle the change of the status of an address."""
         raise NotImplementedError()  # implemented by subclasses
 
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            self.requested_addrs.remove(addr)
+        async def subscribe_to_addresses(addrs):
+            try:
+                hashes = [self._get_scripthash(addr) for addr in addrs]
+                for h, addr in zip(hashes, addrs):
+                    self.scripthash_to_address[h] = addr
+                method = 'blockchain.scripthash.subscribe'
+                if len(addrs) > 1 and self._server_supports_batches:
+                    try:
+                        await self.session.subscribe_many(method, [[h] for h in hashes], self.status_queue)
+                    except ProtocolError as e:
+                        self.print_error("server rejected batch request, subscribing one by one:", repr(e))
+                        self._server_supports_batches = False
+                if len(addrs) == 1 or not self._server_supports_batches:
+                    async with TaskGroup() as group:
+                        for h in hashes:
+                            await group.spawn(self.session.subscribe(method, [h], self.status_queue))
+                for addr in addrs:
+                    self.requested_addrs.remove(addr)
+            finally:
+                for _ in addrs:
+                    self.in_flight_semaphore.release()
 
         while True:
-            addr = await self.add_queue.get()
-            await self.group.spawn(subscribe_to_address, addr)
+            addrs = [await self.add_queue.get()]
+            while len(addrs) < self.batch_size and not self.add_queue.empty():
+                addrs.append(self.add_queue.get_nowait())
+            # acquired here, in order, so that the queue backs up while
+            # we are at the limit, and the next batch is a full one
+            for _ in addrs:
+                await self.in_flight_semaphore.acquire()
+            await self.group.spawn(subscribe_to_addresses, addrs)
 
     async def handle_status(self):
         while True:
@@ -120,33 +155,46 @@ class Synchronizer(SynchronizerBase):
     when necessary, requests the transaction history of any addresses
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
+
+    Missing transactions go through one wallet-wide queue, newest
+    first. They are fetched in batches of up to 'tx_fetch_batch_size',
+    with at most 'tx_fetch_concurrency' batches in flight.
     '''
     def __init__(self, wallet: 'AddressSynchronizer'):
         self.wallet = wallet
+        config = wallet.network.config
+        self.tx_batch_size = max(1, config.get('tx_fetch_batch_size', 20))
+        self.tx_concurrency = max(1, config.get('tx_fetch_concurrency', 4))
         SynchronizerBase.__init__(self, wallet.network)
 
     def _reset(self):
         super()._reset()
         self.requested_tx = {}
         self.requested_histories = {}
+        # (priority, seq, tx_hash, allow_server_not_finding_tx)
+        self.tx_queue = asyncio.PriorityQueue()
+        self._tx_queue_seq = 0
+        self.tx_fetch_semaphore = asyncio.Semaphore(self.tx_concurrency)
 
     def diagnostic_name(self):
         return '{}:{}'.format(self.__class__.__name__, self.wallet.diagnostic_name())
 
+    def _get_scripthash(self, addr: str) -> str:
+        return self.wallet.get_scripthash(addr)
+
     def is_up_to_date(self):
         return (not self.requested_addrs
                 and not self.requested_histories
                 and not self.requested_tx)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
+        if self.wallet.get_address_status(addr) == status:
             return
         if addr in self.requested_histories:
             return
         # request address history
         self.requested_histories[addr] = status
-        h = address_to_scripthash(addr)
+        h = self._get_scripthash(addr)
         result = await self.network.get_history_for_scripthash(h)
         self.print_error("receiving history", addr, len(result))
         hashes = set(map(lambda item: item['tx_hash'], result))
@@ -162,7 +210,7 @@ class Synchronizer(SynchronizerBase):
             self.print_error("error: status mismatch: %s" % addr)
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, status)
             # Request transactions we don't have
             await self._request_missing_txs(hist)
 
@@ -171,50 +219,94 @@ class Synchronizer(SynchronizerBase):
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
-        transaction_hashes = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if self.wallet.db.get_transaction(tx_hash):
                 continue
-            transaction_hashes.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
+            # newest first: mempool, then by decreasing height
+            priority = (0, 0) if tx_height <= 0 else (1, -tx_height)
+            self._tx_queue_seq += 1
+            await self.tx_queue.put((priority, self._tx_queue_seq, tx_hash, allow_server_not_finding_tx))
 
-        if not transaction_hashes: return
-        async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
-
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        try:
-            result = await self.network.get_transaction(tx_hash)
-        except UntrustedServerReturnedError as e:
-            # most likely, "No such mempool or blockchain transaction"
-            if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
-        tx = Transaction(result)
+    async def _fetch_transactions(self):
+        while True:
+            # wait for a free fetch first: while all fetches are busy, the
+            # queue fills up and gets re-sorted, and the batch taken next
+            # is the newest txs
+            await self.tx_fetch_semaphore.acquire()
+            items = [await self.tx_queue.get()]
+            while len(items) < self.tx_batch_size and not self.tx_queue.empty():
+                items.append(self.tx_queue.get_nowait())
+            await self.group.spawn(self._get_transactions, items)
+
+    async def _get_transactions(self, items):
         try:
-            tx.deserialize()  # see if raises
-        except Exception as e:
-            # possible scenarios:
-            # 1: server is sending garbage
-            # 2: there is a bug in the deserialization code
-            # 3: there was a segwit-like upgrade that changed the tx structure
-            #    that we don't know about
-            raise SynchronizerFailure(f"cannot deserialize transaction {tx_hash}") from e
-        if tx_hash != tx.txid():
-            raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
-        tx_height = self.requested_tx.pop(tx_hash)
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.print_error(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.raw)}")
-        # callbacks
-        self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
+            tx_hashes = [tx_hash for _, _, tx_hash, _ in items]
+            with metrics.timer('tx_fetch_seconds'):
+                results = await self._get_raw_transactions(tx_hashes)
+        finally:
+            self.tx_fetch_semaphore.release()
+        received = []
+        for (_, _, tx_hash, allow_server_not_finding_tx), result in zip(items, results):
+            if isinstance(result, UntrustedServerReturnedError):
+                # most likely, "No such mempool or blockchain transaction"
+                if allow_server_not_finding_tx:
+                    self.requested_tx.pop(tx_hash)
+                    continue
+                raise result
+            received.append((tx_hash, result))
+        txs = await run_in_thread(self._deserialize_transactions, received)
+        metrics.inc('tx_fetched_total', len(txs))
+        for tx_hash, tx in txs:
+            tx_height = self.requested_tx.pop(tx_hash)
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+            self.print_error(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.raw)}")
+            # callbacks
+            self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
+
+    async def _get_raw_transactions(self, tx_hashes):
+        if len(tx_hashes) > 1 and self._server_supports_batches:
+            try:
+                return await self.network.get_transactions(tx_hashes)
+            except UntrustedServerReturnedError as e:
+                if not isinstance(e.original_exception, ProtocolError):
+                    raise
+                self.print_error("server rejected batch request, fetching one by one:", repr(e))
+                self._server_supports_batches = False
+        results = []
+        for tx_hash in tx_hashes:
+            try:
+                results.append(await self.network.get_transaction(tx_hash))
+            except UntrustedServerReturnedError as e:
+                results.append(e)
+        return results
+
+    @staticmethod
+    def _deserialize_transactions(received):
+        txs = []
+        for tx_hash, raw in received:
+            tx = Transaction(raw)
+            try:
+                # see if raises; the structure of the whole tx is checked,
+                # the inputs are deserialized later only if needed
+                tx.outputs()
+            except Exception as e:
+                # possible scenarios:
+                # 1: server is sending garbage
+                # 2: there is a bug in the deserialization code
+                # 3: there was a segwit-like upgrade that changed the tx structure
+                #    that we don't know about
+                raise SynchronizerFailure(f"cannot deserialize transaction {tx_hash}") from e
+            if tx_hash != tx.txid():
+                raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
+            txs.append((tx_hash, tx))
+        return txs
 
     async def main(self):
         self.wallet.set_up_to_date(False)
+        await self.group.spawn(self._fetch_transactions)
         # request missing txns, if any
         for addr in self.wallet.db.get_history():
             history = self.wallet.db.get_addr_history(addr)
@@ -223,7 +315,9 @@ class Synchronizer(SynchronizerBase):
             if history == ['*']: continue
             await self._request_missing_txs(history, allow_server_not_finding_tx=True)
         # add addresses to bootstrap
-        for addr in self.wallet.get_addresses():
+        addrs = self.wallet.get_addresses()
+        await run_in_thread(lambda: [self.wallet.get_scripthash(addr) for addr in addrs])
+        for addr in addrs:
             await self._add_address(addr)
         # main loop
         while True:
@@ -0,0 +1,252 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+
+from ... import bitcoin
+from ...commands import Commands
+from ...address_synchronizer import TX_HEIGHT_LOCAL
+from ...transaction import Transaction
+from ...util import TxMinedInfo
+from ...wallet import restore_wallet_from_text
+
+from . import SequentialTestCase
+
+
+ADDRESSES = ['bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw', 'bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c']
+EXTERNAL = 'bc1qqqqsyqcyq5rqwzqfpg9scrgwpugpzysn4v0345'
+
+
+def external_outpoint(label):
+    return hashlib.sha256(label.encode()).hexdigest(), 0
+
+
+def make_tx(inputs, outputs):
+    """Serialized tx spending the (prevout_hash, prevout_n) inputs, with
+    empty scriptSigs, to the (address, value) outputs."""
+    s = struct.pack('<i', 2) + bytes([len(inputs)])
+    for prevout_hash, prevout_n in inputs:
+        s += bytes.fromhex(prevout_hash)[::-1] + struct.pack('<I', prevout_n) + b'\x00' + b'\xff' * 4
+    s += bytes([len(outputs)])
+    for addr, value in outputs:
+        script = bytes.fromhex(bitcoin.address_to_script(addr))
+        s += struct.pack('<q', value) + bytes([len(script)]) + script
+    s += struct.pack('<I', 0)
+    return Transaction(s.hex())
+
+
+class MockBlockchain:
+    """A chain that reorged above the given height."""
+    def __init__(self, height):
+        self.height = height
+    def read_header(self, height):
+        return None if height > self.height else {}
+
+
+class MockNetwork:
+    def get_local_height(self):
+        return 110
+    def trigger_callback(self, event, *args):
+        pass
+
+
+class WalletEventsTestCase(SequentialTestCase):
+    """Runs a wallet of imported addresses through adding, verifying,
+    removing and reorging transactions, and calls check() after each."""
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        d = restore_wallet_from_text(' '.join(ADDRESSES), network=None,
+                                     path=os.path.join(self.user_dir, 'somewallet'))
+        self.wallet = d['wallet']
+        self.wallet.network = MockNetwork()
+        self.a1, self.a2 = ADDRESSES
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.user_dir)
+
+    def check(self, event):
+        raise NotImplementedError()
+
+    def receive(self, tx, height):
+        self.wallet.receive_tx_callback(tx.txid(), tx, height)
+
+    def verify(self, tx, height, txpos):
+        self.wallet.add_verified_tx(tx.txid(), TxMinedInfo(height=height, timestamp=1500000000 + height,
+                                                           txpos=txpos, header_hash='00' * 32))
+
+    def run_events(self):
+        wallet, a1, a2 = self.wallet, self.a1, self.a2
+        f1 = make_tx([external_outpoint('f1')], [(a1, 1000), (a2, 2000)])
+        self.receive(f1, 0)
+        self.check('unconfirmed funding tx added')
+        f2 = make_tx([external_outpoint('f2')], [(a1, 5000)])
+        self.receive(f2, 100)
+        self.check('mined funding tx added')
+        self.verify(f2, 100, 3)
+        self.check('funding tx verified')
+        s1 = make_tx([(f1.txid(), 0), (f2.txid(), 0)], [(EXTERNAL, 4000), (a2, 1900)])
+        wallet.add_transaction(s1.txid(), s1)
+        self.check('local spending tx added')
+        s2 = make_tx([(s1.txid(), 1)], [(a1, 1800)])
+        wallet.add_transaction(s2.txid(), s2)
+        self.check('local child tx added')
+        self.assertEqual(TX_HEIGHT_LOCAL, wallet.get_tx_height(s1.txid()).height)
+        Commands(config=None, wallet=wallet, network=None).removelocaltx(s1.txid())
+        self.assertIsNone(wallet.db.get_transaction(s2.txid()))
+        self.check('local tx and its child removed')
+        # s1 is mined after all, after a new funding tx in the same block
+        f3 = make_tx([external_outpoint('f3')], [(a2, 700)])
+        self.receive(f3, 101)
+        self.receive(s1, 101)
+        self.verify(s1, 101, 2)
+        self.verify(f3, 101, 1)
+        self.check('txs mined in the same block')
+        # the block is reorged away. f3 is double spent on the new chain,
+        # s1 is mined again one block later
+        self.assertEqual({s1.txid(), f3.txid()}, wallet.undo_verifications(MockBlockchain(100), 100))
+        self.check('reorg undid verifications')
+        wallet.receive_history_callback(a2, [(f1.txid(), 0), (s1.txid(), 102)], {})
+        self.assertEqual(TX_HEIGHT_LOCAL, wallet.get_tx_height(f3.txid()).height)
+        self.check('reorged tx became local')
+        f3b = make_tx([external_outpoint('f3')], [(a1, 600)])
+        self.receive(f3b, 102)
+        self.assertIsNone(wallet.db.get_transaction(f3.txid()))
+        self.check('double spend of reorged tx added')
+        self.verify(f3b, 102, 1)
+        self.verify(s1, 102, 2)
+        self.check('txs mined on the new chain')
+
+
+class TestAddTransaction(WalletEventsTestCase):
+
+    def test_network_tx_inputs_are_not_deserialized(self):
+        f1 = make_tx([external_outpoint('f1')], [(self.a1, 1000)])
+        s1 = make_tx([(f1.txid(), 0)], [(EXTERNAL, 900)])
+        for tx, height in [(f1, 100), (s1, 0)]:
+            tx = Transaction(tx.raw)
+            self.receive(tx, height)
+            self.assertIsNone(tx._inputs)
+        self.assertEqual({f1.txid(), s1.txid()}, set(self.wallet.db.list_transactions()))
+        self.assertEqual((1000, -1000, 0), self.wallet.get_balance())
+
+
+class TestCoinIndex(WalletEventsTestCase):
+
+    def unindexed_addr_io(self, addr):
+        """get_addr_io computed from db.txi and db.txo"""
+        db = self.wallet.db
+        received, sent = {}, {}
+        for txid in db.list_txo():
+            height = self.wallet.get_tx_height(txid).height
+            for n, v, is_cb in db.get_txo_addr(txid, addr):
+                received[txid + ':%d' % n] = (height, v, is_cb)
+        for txid in db.list_txi():
+            height = self.wallet.get_tx_height(txid).height
+            for ser, v in db.get_txi_addr(txid, addr):
+                sent[ser] = height
+        return received, sent
+
+    def unindexed_utxos(self, addr):
+        received, sent = self.unindexed_addr_io(addr)
+        return {ser: (height, v, is_cb) for ser, (height, v, is_cb) in received.items()
+                if ser not in sent}
+
+    def unindexed_balance(self, addr):
+        received, sent = self.unindexed_addr_io(addr)
+        c = u = 0
+        for ser, (height, v, is_cb) in received.items():
+            if height > 0:
+                c += v
+            else:
+                u += v
+            if ser in sent:
+                if sent[ser] > 0:
+                    c -= v
+                else:
+                    u -= v
+        return c, u, 0
+
+    def index(self):
+        return [{addr: dict(d) for addr, d in index.items() if d}
+                for index in (self.wallet._addr_received, self.wallet._addr_sent, self.wallet._addr_utxos)]
+
+    def check(self, event):
+        wallet = self.wallet
+        total = [0, 0, 0]
+        for addr in ADDRESSES:
+            self.assertEqual(self.unindexed_addr_io(addr), wallet.get_addr_io(addr), event)
+            utxos = {ser: (x['height'], x['value'], x['coinbase'])
+                     for ser, x in wallet.get_addr_utxo(addr).items()}
+            self.assertEqual(self.unindexed_utxos(addr), utxos, event)
+            balance = self.unindexed_balance(addr)
+            self.assertEqual(balance, wallet.get_addr_balance(addr), event)
+            total = [t + b for t, b in zip(total, balance)]
+        self.assertEqual(tuple(total), wallet.get_balance(), event)
+        # the index kept up to date matches one built from scratch
+        index = self.index()
+        wallet._load_coin_index()
+        self.assertEqual(index, self.index(), event)
+
+    def test_index_is_consistent_with_db(self):
+        self.run_events()
+        self.assertEqual((1500, 3000, 0), self.wallet.get_balance())
+
+
+class TestHistoryIndex(WalletEventsTestCase):
+
+    def assertSameHistory(self, expected, history, event):
+        """Txs at the same position (e.g. local txs) may come in any order;
+        the balance after each group of them must be the same."""
+        def groups(h):
+            result = []
+            for txid, status, delta, balance in h:
+                txpos = self.wallet.get_txpos(txid)
+                if not result or result[-1][0] != txpos:
+                    result.append((txpos, set(), None))
+                result[-1][1].add((txid, status, delta))
+                result[-1] = result[-1][:2] + (balance,)
+            return result
+        self.assertEqual(groups(expected), groups(history), event)
+        balance = 0
+        for txid, status, delta, running_balance in history:
+            balance += delta
+            self.assertEqual(balance, running_balance, event)
+
+    def check(self, event):
+        wallet = self.wallet
+        full = wallet.get_history(domain=wallet.get_addresses())
+        history = wallet.get_history()
+        self.assertSameHistory(full, history, event)
+        self.assertEqual(len(set(wallet.db.list_txi()) | set(wallet.db.list_txo())), len(history), event)
+        for limit in range(1, len(history) + 2):
+            self.assertEqual(history[-limit:], wallet.get_history(limit=limit), event)
+            self.assertEqual(full[-limit:], wallet.get_history(domain=wallet.get_addresses(), limit=limit), event)
+
+    def test_index_is_consistent_with_full_history(self):
+        self.run_events()
+        history = self.wallet.get_history()
+        self.assertEqual(4, len(history))
+        # oldest first, ending with the wallet balance
+        self.assertEqual(sum(self.wallet.get_balance()), history[-1][3])
+        self.assertEqual(sum(delta for txid, status, delta, balance in history), history[-1][3])
+
+    def test_single_tx_updates_on_long_history(self):
+        # few dirty txs are moved in the sorted history instead of resorting it
+        wallet, a1 = self.wallet, self.a1
+        txs = [make_tx([external_outpoint('f%d' % i)], [(a1, 1000 + i)]) for i in range(20)]
+        for i, tx in enumerate(txs):
+            self.receive(tx, 100 + i % 5)
+        self.check('funding txs added')
+        for i, tx in enumerate(txs[:5]):
+            self.verify(tx, 100 + i % 5, 20 - i)
+            self.check('funding tx verified')
+        spend = make_tx([(txs[3].txid(), 0)], [(EXTERNAL, 1003)])
+        wallet.add_transaction(spend.txid(), spend)
+        self.check('local spending tx added')
+        Commands(config=None, wallet=wallet, network=None).removelocaltx(spend.txid())
+        self.check('local spending tx removed')
+        self.assertEqual(20, len(wallet.get_history()))
@@ -12,7 +12,7 @@ from ...bitcoin import (public_key_to_p2pkh, address_from_private_key,
 from ...bip32 import (BIP32Node, convert_bip32_intpath_to_strpath,
                             xpub_from_xprv, xpub_type, is_xprv, is_bip32_derivation,
                             is_xpub, convert_bip32_path_to_list_of_uint32,
-                            normalize_bip32_derivation)
+                            normalize_bip32_derivation, derive_child_pubkeys, BIP32_PRIME)
 from ...crypto import sha256d, SUPPORTED_PW_HASH_VERSIONS
 from electrumfairchains import ecc, crypto, constants
 from ...ecc import number_to_string, string_to_number
@@ -432,6 +432,15 @@ class Test_xprv_xpub(SequentialTestCase):
         self.assertEqual("xpub6FnCn6nSzZAw5Tw7cgR9bi15UV96gLZhjDstkXXxvCLsUXBGXPdSnLFbdpq8p9HmGsApME5hQTZ3emM2rnY5agb9rXpVGyy3bdW6EEgAtqt", xpub)
         self.assertEqual("xprvA2nrNbFZABcdryreWet9Ea4LvTJcGsqrMzxHx98MMrotbir7yrKCEXw7nadnHM8Dq38EGfSh6dqA9QWTyefMLEcBYJUuekgW4BYPJcr9E7j", xprv)
 
+    @needs_test_with_all_ecc_implementations
+    def test_derive_child_pubkeys(self):
+        node = BIP32Node.from_xkey(self.xprv_xpub[0]['xpub'])
+        pubkeys = derive_child_pubkeys(node.eckey, node.chaincode, range(5, 9))
+        self.assertEqual([node.subkey_at_public_derivation([n]).eckey.get_public_key_bytes() for n in range(5, 9)],
+                         pubkeys)
+        with self.assertRaises(Exception):
+            derive_child_pubkeys(node.eckey, node.chaincode, [BIP32_PRIME])
+
     @needs_test_with_all_ecc_implementations
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
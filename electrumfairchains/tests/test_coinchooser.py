@@ -0,0 +1,96 @@
+from ...coinchooser import branch_and_bound, Bucket, SelectionCosts, PRNG, CoinChooserBranchAndBound
+from ...util import NotEnoughFunds
+
+from . import SequentialTestCase
+
+
+class TestBranchAndBound(SequentialTestCase):
+
+    def test_exact_match(self):
+        values = [50, 40, 30, 20, 10]
+        found = branch_and_bound(values, [1] * 5, 60, 0, max_waste=10, max_tries=1000)
+        # 50+10 and 40+20 pay less fees than 30+20+10
+        self.assertEqual([0, 4], found)
+
+    def test_match_within_cost_of_change(self):
+        values = [50, 40, 30]
+        found = branch_and_bound(values, [1] * 3, 65, 6, max_waste=10, max_tries=1000)
+        # only 40+30 is between 65 and 65 + 6
+        self.assertEqual([1, 2], found)
+        self.assertIsNone(branch_and_bound(values, [1] * 3, 65, 4, max_waste=10, max_tries=1000))
+
+    def test_least_waste_is_chosen(self):
+        values = [60, 31, 30]
+        # 60 has an excess of 1 and 31+30 of 2, and it pays one fee instead of two
+        self.assertEqual([0], branch_and_bound(values, [1, 1, 1], 59, 2, max_waste=10, max_tries=1000))
+        # unless that fee is larger
+        self.assertEqual([1, 2], branch_and_bound(values, [5, 1, 1], 59, 2, max_waste=10, max_tries=1000))
+
+    def test_no_match(self):
+        self.assertIsNone(branch_and_bound([50, 40], [1, 1], 45, 2, max_waste=10, max_tries=1000))
+        # not enough funds
+        self.assertIsNone(branch_and_bound([50, 40], [1, 1], 100, 20, max_waste=10, max_tries=1000))
+
+    def test_max_waste(self):
+        self.assertEqual([0], branch_and_bound([50], [1], 48, 5, max_waste=4, max_tries=1000))
+        # excess 2 plus fee 1 is not below 3
+        self.assertIsNone(branch_and_bound([50], [1], 48, 5, max_waste=3, max_tries=1000))
+
+    def test_max_tries(self):
+        # the only match is the smallest values, found after trying all the others
+        values = [1000 + i for i in reversed(range(12))] + [7, 5, 3]
+        target = 15
+        self.assertEqual([12, 13, 14], branch_and_bound(values, [0] * 15, target, 0, max_waste=1, max_tries=100000))
+        self.assertIsNone(branch_and_bound(values, [0] * 15, target, 0, max_waste=1, max_tries=10))
+
+
+def make_bucket(desc, value, weight=400, min_height=100):
+    return Bucket(desc, weight, value, [{'address': desc, 'value': value}], min_height, False)
+
+
+class TestCoinChooserBranchAndBound(SequentialTestCase):
+
+    def choose(self, buckets, target, fee_per_weight, cost_of_change, max_tries=None):
+        """Chooses buckets to pay target plus fee_per_weight for their weight."""
+        chooser = CoinChooserBranchAndBound()
+        if max_tries is not None:
+            chooser.max_tries = max_tries
+        chooser.p = PRNG('seed')
+        chooser.costs = SelectionCosts(target, fee_per_weight, cost_of_change)
+        def sufficient_funds(bkts):
+            return sum(bkt.value - int(bkt.weight * fee_per_weight) for bkt in bkts) >= target
+        penalty_func = lambda bkts: len(bkts)
+        winner = chooser.choose_buckets(buckets, sufficient_funds, penalty_func)
+        self.assertTrue(sufficient_funds(winner))
+        return sorted(bkt.desc for bkt in winner)
+
+    def test_exact_match_is_found(self):
+        buckets = [make_bucket('a', 50000), make_bucket('b', 30400), make_bucket('c', 20400),
+                   make_bucket('d', 70000)]
+        # b and c pay 50000 and their fees of 400 each exactly
+        self.assertEqual(['b', 'c'], self.choose(buckets, 50000, 1, 1000))
+
+    def test_no_match_falls_back_to_privacy(self):
+        buckets = [make_bucket('a', 90000), make_bucket('b', 70000)]
+        self.assertEqual(['a'], self.choose(buckets, 50000, 1, 1000))
+
+    def test_max_tries_falls_back_to_privacy(self):
+        buckets = [make_bucket('x%d' % i, 100000 + 1000 * i) for i in range(12)]
+        # a, b and c pay 10000 and their small fees exactly, found last
+        buckets += [make_bucket('a', 5004, weight=4), make_bucket('b', 3004, weight=4),
+                    make_bucket('c', 2004, weight=4)]
+        self.assertEqual(['a', 'b', 'c'], self.choose(buckets, 10000, 1, 100))
+        winner = self.choose(buckets, 10000, 1, 100, max_tries=10)
+        self.assertNotEqual(['a', 'b', 'c'], winner)
+
+    def test_confirmed_coins_are_preferred(self):
+        buckets = [make_bucket('a', 50400, min_height=0), make_bucket('b', 30400), make_bucket('c', 20400)]
+        self.assertEqual(['b', 'c'], self.choose(buckets, 50000, 1, 1000))
+
+    def test_zero_fee_rate(self):
+        buckets = [make_bucket('a', 50000), make_bucket('b', 30000), make_bucket('c', 20000)]
+        for target in [20000, 50000, 60000, 100000]:
+            winner = self.choose(buckets, target, 0, 0)
+            self.assertTrue(winner)
+        with self.assertRaises(NotEnoughFunds):
+            self.choose(buckets, 100001, 0, 0)
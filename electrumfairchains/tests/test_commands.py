@@ -2,6 +2,7 @@ import unittest
 from decimal import Decimal
 
 from ...commands import Commands, eval_bool
+from ... import metrics
 
 from . import TestCaseForTestnet
 
@@ -62,6 +63,33 @@ class TestCommands(unittest.TestCase):
             for xkey2, xtype2 in xprvs:
                 self.assertEqual(xkey2, cmds.convert_xkey(xkey1, xtype2))
 
+    def test_getmetrics(self):
+        cmds = Commands(config=None, wallet=None, network=None)
+        metrics.set_registry(None)
+        with metrics.timer('server_request_seconds', method='server.ping'):
+            pass
+        with self.assertRaises(Exception):
+            cmds.getmetrics()
+        metrics.set_registry(metrics.MetricsRegistry())
+        try:
+            for k in range(100):
+                metrics.observe('server_request_seconds', k / 1000, method='server.ping')
+            metrics.inc('tx_fetched_total', 3)
+            snapshot = cmds.getmetrics()
+            self.assertEqual(3, snapshot['tx_fetched_total'])
+            latency = snapshot['server_request_seconds{method="server.ping"}']
+            self.assertEqual(100, latency['count'])
+            self.assertAlmostEqual(0.049, latency['p50'])
+            self.assertAlmostEqual(0.098, latency['p99'])
+            self.assertAlmostEqual(0.099, latency['max'])
+            text = metrics.get_registry().to_prometheus()
+            self.assertIn('# TYPE server_request_seconds summary\n', text)
+            self.assertIn('server_request_seconds{method="server.ping",quantile="0.99"} 0.098\n', text)
+            self.assertIn('server_request_seconds_count{method="server.ping"} 100\n', text)
+            self.assertIn('tx_fetched_total 3\n', text)
+        finally:
+            metrics.set_registry(None)
+
 
 class TestCommandsTestnet(TestCaseForTestnet):
 
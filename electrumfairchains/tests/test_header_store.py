@@ -0,0 +1,176 @@
+import shutil
+import tempfile
+import os
+from unittest import mock
+
+from electrumfairchains import blockchain
+from ...simple_config import SimpleConfig
+from ...blockchain import Blockchain, HeaderStore, HEADER_SIZE, hash_raw_header
+from ...util import bh2u, make_dir
+
+from . import SequentialTestCase
+
+
+class TestHeaderStore(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, 'blockchain_headers')
+        self.raw_headers = [bytes([i + 1]) * HEADER_SIZE for i in range(4)]
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.data_dir)
+
+    def _write(self, data: bytes, offset: int):
+        with open(self.path, 'rb+' if os.path.exists(self.path) else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+
+    def test_read_and_hash(self):
+        self._write(b''.join(self.raw_headers[:2]), 0)
+        store = HeaderStore(self.path)
+        self.assertEqual(self.raw_headers[1], store.read(1))
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[0])), bh2u(store.get_hash(0)))
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[1])), bh2u(store.get_hash(1)))
+        with self.assertRaises(Exception):
+            store.read(2)
+        store.close()
+
+    def test_mapping_grows_with_file(self):
+        self._write(self.raw_headers[0], 0)
+        store = HeaderStore(self.path)
+        store.get_hash(0)
+        store.close()
+        self._write(b''.join(self.raw_headers[1:]), HEADER_SIZE)
+        self.assertEqual(self.raw_headers[3], store.read(3))
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[3])), bh2u(store.get_hash(3)))
+        store.close()
+
+    def test_null_header_has_no_hash(self):
+        self._write(bytes(HEADER_SIZE) + self.raw_headers[1], 0)
+        store = HeaderStore(self.path)
+        self.assertIsNone(store.get_hash(0))
+        self.assertIsNotNone(store.get_hash(1))
+        store.close()
+
+    def test_invalidate_drops_stale_hashes(self):
+        self._write(b''.join(self.raw_headers[:3]), 0)
+        store = HeaderStore(self.path)
+        for i in range(3):
+            store.get_hash(i)
+        store.invalidate(1)
+        self._write(self.raw_headers[3], HEADER_SIZE)
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[0])), bh2u(store.get_hash(0)))
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[3])), bh2u(store.get_hash(1)))
+        with self.assertRaises(Exception):
+            store.get_hash(2)
+        store.close()
+
+    def test_set_hash_primes_index(self):
+        self._write(b''.join(self.raw_headers[:3]), 0)
+        store = HeaderStore(self.path)
+        known_hash = bytes(range(32))
+        store.set_hash(2, known_hash)
+        self.assertEqual(known_hash, store.get_hash(2))
+        store.close()
+
+    def test_appended_headers_are_readable_before_flush(self):
+        self._write(self.raw_headers[0], 0)
+        store = HeaderStore(self.path)
+        store.append(b''.join(self.raw_headers[1:3]), HEADER_SIZE)
+        self.assertEqual(HEADER_SIZE, os.path.getsize(self.path))
+        self.assertEqual(self.raw_headers[2], store.read(2))
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[2])), bh2u(store.get_hash(2)))
+        store.append(self.raw_headers[3], 3 * HEADER_SIZE)
+        store.flush()
+        self.assertEqual(0, store.pending_size())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b''.join(self.raw_headers), f.read())
+        self.assertEqual(self.raw_headers[3], store.read(3))
+        store.close()
+
+    def test_flush_if_due_waits_for_interval(self):
+        self._write(self.raw_headers[0], 0)
+        store = HeaderStore(self.path)
+        with mock.patch.object(blockchain.time, 'monotonic', return_value=100):
+            store.append(self.raw_headers[1], HEADER_SIZE)
+        with mock.patch.object(blockchain.time, 'monotonic',
+                               return_value=100 + blockchain.HEADERS_FLUSH_INTERVAL - 1):
+            store.append(self.raw_headers[2], 2 * HEADER_SIZE)
+            store.flush_if_due()
+        self.assertEqual(2 * HEADER_SIZE, store.pending_size())
+        self.assertEqual(HEADER_SIZE, os.path.getsize(self.path))
+        # the interval counts from the oldest pending header
+        with mock.patch.object(blockchain.time, 'monotonic',
+                               return_value=100 + blockchain.HEADERS_FLUSH_INTERVAL):
+            store.flush_if_due()
+        self.assertEqual(0, store.pending_size())
+        self.assertEqual(3 * HEADER_SIZE, os.path.getsize(self.path))
+        store.close()
+
+    def test_append_flushes_at_size_threshold(self):
+        self._write(self.raw_headers[0], 0)
+        store = HeaderStore(self.path)
+        with mock.patch.object(blockchain, 'HEADERS_FLUSH_BYTES', 2 * HEADER_SIZE):
+            store.append(self.raw_headers[1], HEADER_SIZE)
+            self.assertEqual(HEADER_SIZE, store.pending_size())
+            store.append(self.raw_headers[2], 2 * HEADER_SIZE)
+            self.assertEqual(0, store.pending_size())
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b''.join(self.raw_headers[:3]), f.read())
+        store.close()
+
+    def test_append_must_extend_pending_headers(self):
+        self._write(self.raw_headers[0], 0)
+        store = HeaderStore(self.path)
+        store.append(self.raw_headers[1], HEADER_SIZE)
+        with self.assertRaises(AssertionError):
+            store.append(self.raw_headers[2], 3 * HEADER_SIZE)
+        store.close()
+
+
+class TestChainWriteBehind(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.config = SimpleConfig({'efc_path': self.data_dir})
+        self._saved_blockchains = blockchain.blockchains
+        blockchain.blockchains = {}
+        self.chain = Blockchain(config=self.config,
+                                forkpoint=0,
+                                parent=None,
+                                forkpoint_hash=self.config.net.GENESIS,
+                                prev_hash=None)
+        make_dir(os.path.dirname(self.chain.path()))
+        open(self.chain.path(), 'wb').close()
+        blockchain.blockchains[self.config.net.GENESIS] = self.chain
+        self.raw_headers = [bytes([i + 1]) * HEADER_SIZE for i in range(4)]
+
+    def tearDown(self):
+        super().tearDown()
+        self.chain.reset_header_store()
+        blockchain.blockchains = self._saved_blockchains
+        shutil.rmtree(self.data_dir)
+
+    def test_appends_are_buffered(self):
+        self.chain.write(b''.join(self.raw_headers[:2]), 0)
+        self.assertEqual(2, self.chain.size())
+        self.assertEqual(0, os.path.getsize(self.chain.path()))
+        blockchain.flush_blockchains(force=False)
+        self.assertEqual(0, os.path.getsize(self.chain.path()))
+        blockchain.flush_blockchains()
+        self.assertEqual(2 * HEADER_SIZE, os.path.getsize(self.chain.path()))
+        self.assertEqual(2, self.chain.size())
+
+    def test_overwrite_flushes_pending_headers_first(self):
+        self.chain.write(b''.join(self.raw_headers[:3]), 0)
+        self.chain.write(self.raw_headers[3], HEADER_SIZE)
+        self.assertEqual(2, self.chain.size())
+        with open(self.chain.path(), 'rb') as f:
+            self.assertEqual(self.raw_headers[0] + self.raw_headers[3], f.read())
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[3])),
+                         bh2u(self.chain._store.get_hash(1)))
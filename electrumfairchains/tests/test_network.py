@@ -1,11 +1,16 @@
 import asyncio
 import tempfile
+import threading
 import unittest
+from concurrent.futures import Future
+
+import aiorpcx
 
 from electrumfairchains import constants
 from ...simple_config import SimpleConfig
 from electrumfairchains import blockchain
-from ...interface import Interface
+from ...interface import Interface, RequestTimedOut
+from ...network import Network
 from ...crypto import sha256
 from ...util import bh2u
 
@@ -117,3 +122,310 @@ class TestNetwork(unittest.TestCase):
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
+
+
+class MockHedgeInterface:
+    def __init__(self, host, delay, error=None):
+        self.host = host
+        self.delay = delay
+        self.error = error
+        self.requests = 0
+        self.cancelled = False
+
+class MockHedgeNetwork:
+    def __init__(self, others):
+        self.others = others
+    def get_hedge_delay(self, iface):
+        return 0.05
+    def get_hedge_interfaces(self, iface):
+        return self.others
+    def print_error(self, *msg):
+        pass
+
+async def mock_request(network, x, *, interface):
+    interface.requests += 1
+    try:
+        await asyncio.sleep(interface.delay)
+    except asyncio.CancelledError:
+        interface.cancelled = True
+        raise
+    if interface.error:
+        raise interface.error
+    return interface.host, x
+
+class TestHedgedRequests(unittest.TestCase):
+
+    def hedged_request(self, main, others):
+        network = MockHedgeNetwork(others)
+        coro = Network._hedged_request(network, mock_request, main, (1,), {})
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_fast_main_interface_is_not_hedged(self):
+        main, other = MockHedgeInterface('main', 0), MockHedgeInterface('other', 0)
+        self.assertEqual(('main', 1), self.hedged_request(main, [other]))
+        self.assertEqual(0, other.requests)
+
+    def test_slow_main_interface_is_hedged(self):
+        main, other = MockHedgeInterface('main', 10), MockHedgeInterface('other', 0)
+        self.assertEqual(('other', 1), self.hedged_request(main, [other]))
+        self.assertEqual(1, main.requests)
+
+    def test_failed_hedge_waits_for_main_interface(self):
+        main = MockHedgeInterface('main', 0.2)
+        other = MockHedgeInterface('other', 0, error=Exception('other'))
+        self.assertEqual(('main', 1), self.hedged_request(main, [other]))
+
+    def test_error_of_main_interface_is_raised(self):
+        main = MockHedgeInterface('main', 0.1, error=ValueError('main'))
+        other = MockHedgeInterface('other', 0, error=Exception('other'))
+        with self.assertRaises(ValueError):
+            self.hedged_request(main, [other])
+
+    def cancel_hedged_request(self, main, others, after):
+        network = MockHedgeNetwork(others)
+        async def f():
+            task = asyncio.ensure_future(Network._hedged_request(network, mock_request, main, (1,), {}))
+            await asyncio.sleep(after)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(f())
+        finally:
+            loop.close()
+
+    def test_cancelled_before_hedging_cancels_main_request(self):
+        main, other = MockHedgeInterface('main', 10), MockHedgeInterface('other', 10)
+        self.cancel_hedged_request(main, [other], after=0.01)
+        self.assertTrue(main.cancelled)
+        self.assertEqual(0, other.requests)
+
+    def test_cancelled_while_hedging_cancels_both_requests(self):
+        main, other = MockHedgeInterface('main', 10), MockHedgeInterface('other', 10)
+        self.cancel_hedged_request(main, [other], after=0.1)
+        self.assertTrue(main.cancelled)
+        self.assertTrue(other.cancelled)
+
+
+class MockChunkSession:
+    def __init__(self, host, responses):
+        self.host = host
+        self.responses = responses  # chunk index -> (delay, hex or exception, count)
+        self.requests = []
+    def is_closing(self):
+        return False
+    async def send_request(self, method, params):
+        assert method == 'blockchain.block.headers', method
+        index = params[0] // 2016
+        self.requests.append(index)
+        delay, result, count = self.responses.get(index, (0, 'ok', None))
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return {'hex': '%s %s' % (result, self.host), 'count': params[1] if count is None else count}
+
+class MockChunkBlockchain:
+    def __init__(self):
+        self.connected = []
+    def connect_chunk(self, index, hexdata):
+        if not hexdata.startswith('ok'):
+            return False
+        self.connected.append((index, hexdata))
+        return True
+
+class MockChunkNetwork:
+    def __init__(self):
+        self.interfaces_lock = threading.Lock()
+        self.interfaces = {}
+        self.synced = 0
+    def get_header_sync_window(self):
+        return 2
+    def note_headers_synced(self, count):
+        self.synced += count
+    def trigger_callback(self, event):
+        pass
+
+class MockChunkInterface(Interface):
+    def __init__(self, network, host, chain, tip, responses=None):
+        self.network = network
+        self.host = host
+        self.blockchain = chain
+        self.tip = tip
+        self.session = MockChunkSession(host, responses or {})
+        self._requested_chunks = set()
+        self.ready = Future()
+        self.ready.set_result(1)
+        network.interfaces[host] = self
+
+
+class TestPipelinedChunks(unittest.TestCase):
+
+    TIP = 3 * 2016 + 99
+
+    def setUp(self):
+        self.network = MockChunkNetwork()
+        self.chain = MockChunkBlockchain()
+
+    def interface(self, host, *, chain=None, tip=TIP, responses=None):
+        return MockChunkInterface(self.network, host, chain or self.chain, tip, responses)
+
+    def request_chunks(self, iface, height=0):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(iface.request_chunks_pipelined(height, self.TIP))
+        finally:
+            loop.close()
+
+    def test_chunks_connect_in_order(self):
+        # the first chunk arrives last
+        main = self.interface('main', responses={0: (0.1, 'ok', None)})
+        other = self.interface('other')
+        self.assertEqual((True, self.TIP + 1), self.request_chunks(main))
+        self.assertEqual([0, 1, 2, 3], [index for index, hexdata in self.chain.connected])
+        self.assertEqual([0, 2], main.session.requests)
+        self.assertEqual([1, 3], other.session.requests)
+        self.assertEqual(self.TIP + 1, self.network.synced)
+        self.assertEqual(set(), main._requested_chunks)
+
+    def test_short_last_chunk(self):
+        main = self.interface('main', responses={1: (0, 'ok', 10)})
+        self.assertEqual((True, 2016 + 10), self.request_chunks(main))
+        self.assertEqual([0, 1], [index for index, hexdata in self.chain.connected])
+        self.assertEqual(set(), main._requested_chunks)
+
+    def test_failed_source_falls_back_to_own_server(self):
+        main = self.interface('main')
+        self.interface('other', responses={1: (0, aiorpcx.jsonrpc.RPCError(1, 'error'), None)})
+        self.assertEqual((True, self.TIP + 1), self.request_chunks(main))
+        self.assertEqual([(0, 'ok main'), (1, 'ok main'), (2, 'ok main'), (3, 'ok other')],
+                         self.chain.connected)
+
+    def test_chunk_that_does_not_connect_is_fetched_again(self):
+        main = self.interface('main')
+        self.interface('other', responses={1: (0, 'bad', None)})
+        self.assertEqual((True, self.TIP + 1), self.request_chunks(main))
+        self.assertEqual([(0, 'ok main'), (1, 'ok main'), (2, 'ok main'), (3, 'ok other')],
+                         self.chain.connected)
+
+    def test_chunk_from_own_server_that_does_not_connect(self):
+        main = self.interface('main', responses={1: (0, 'bad', None)})
+        self.assertEqual((True, 2016), self.request_chunks(main))
+        self.assertEqual([0], [index for index, hexdata in self.chain.connected])
+        self.assertEqual(set(), main._requested_chunks)
+
+    def test_only_sources_on_our_blockchain_and_tip_are_used(self):
+        main = self.interface('main')
+        forked = self.interface('forked', chain=MockChunkBlockchain())
+        behind = self.interface('behind', tip=2 * 2016)
+        self.assertEqual((True, self.TIP + 1), self.request_chunks(main))
+        self.assertEqual([], forked.session.requests)
+        self.assertEqual([1], behind.session.requests)
+        self.assertEqual([0, 2, 3], main.session.requests)
+
+
+class MockBroadcastSession:
+    def __init__(self, host, network, error=None):
+        self.host = host
+        self.network = network
+        self.error = error
+        self.broadcasts = 0
+    async def send_request(self, method, params, timeout=None):
+        assert method == 'blockchain.transaction.broadcast', method
+        self.broadcasts += 1
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        return self.network.txid
+
+class MockBroadcastInterface:
+    def __init__(self, host, network, error=None):
+        self.host = host
+        self.network = network
+        self.session = MockBroadcastSession(host, network, error)
+        self.ready = asyncio.Future()
+        self.ready.set_result(1)
+        self.got_disconnected = asyncio.Future()
+    async def close(self):
+        # the network switches to the next server
+        self.got_disconnected.set_result(1)
+        self.network.interface = self.network.next_interface
+
+class MockBroadcastTaskGroup:
+    def __init__(self):
+        self.tasks = []
+    async def spawn(self, coro):
+        self.tasks.append(asyncio.ensure_future(coro))
+
+class MockBroadcastNetwork:
+    broadcast_transaction = Network.broadcast_transaction
+    _broadcast_transaction = Network._broadcast_transaction
+    _broadcast_to_other_interface = Network._broadcast_to_other_interface
+    def __init__(self, config, txid):
+        self.config = config
+        self.txid = txid
+        self.main_taskgroup = MockBroadcastTaskGroup()
+        self.interface = self.next_interface = None
+        self.others = []
+    def get_network_timeout_seconds(self, timeout):
+        return 1
+    def get_hedge_interfaces(self, iface):
+        return [other for other in self.others if other is not iface]
+    def print_error(self, *msg):
+        pass
+
+class TestBroadcastTransaction(unittest.TestCase):
+
+    TXID = 'ab' * 32
+
+    class MockTx:
+        def txid(self):
+            return TestBroadcastTransaction.TXID
+        def __str__(self):
+            return '00'
+
+    def make_network(self, broadcast_servers, main_error=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        network = MockBroadcastNetwork({'broadcast_servers': broadcast_servers}, self.TXID)
+        network.interface = MockBroadcastInterface('main', network, error=main_error)
+        network.next_interface = MockBroadcastInterface('next', network)
+        network.others = [MockBroadcastInterface('other%d' % i, network) for i in range(3)]
+        return network, loop
+
+    def run_broadcast(self, network, loop):
+        async def f():
+            await network.broadcast_transaction(self.MockTx())
+            await asyncio.gather(*network.main_taskgroup.tasks)
+        try:
+            loop.run_until_complete(f())
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    def test_broadcast_to_other_servers(self):
+        network, loop = self.make_network(3)
+        main = network.interface
+        self.run_broadcast(network, loop)
+        self.assertEqual(1, main.session.broadcasts)
+        self.assertEqual([1, 1, 0], [other.session.broadcasts for other in network.others])
+
+    def test_no_other_servers_by_default(self):
+        network, loop = self.make_network(1)
+        self.run_broadcast(network, loop)
+        self.assertEqual([0, 0, 0], [other.session.broadcasts for other in network.others])
+        self.assertEqual([], network.main_taskgroup.tasks)
+
+    def test_retry_does_not_broadcast_to_other_servers_again(self):
+        network, loop = self.make_network(3, main_error=RequestTimedOut())
+        main, next_main = network.interface, network.next_interface
+        self.run_broadcast(network, loop)
+        # the main server timed out, and the broadcast was retried on the next one
+        self.assertEqual(1, main.session.broadcasts)
+        self.assertEqual(1, next_main.session.broadcasts)
+        self.assertEqual([1, 1, 0], [other.session.broadcasts for other in network.others])
@@ -5,7 +5,7 @@ import tempfile
 import shutil
 
 from io import StringIO
-from ...simple_config import (SimpleConfig, read_user_config)
+from ...simple_config import (SimpleConfig, read_user_config, get_fairchain)
 
 from . import SequentialTestCase
 
@@ -109,6 +109,22 @@ class Test_SimpleConfig(SequentialTestCase):
         result.pop('config_version', None)
         self.assertEqual({"something": "a"}, result)
 
+    def test_net_follows_selected_fairchain(self):
+        """Each FairChain has its own directory and chain parameters."""
+        read_user_dir = lambda : self.user_dir
+        configs = {}
+        for fairchain in ['FairCoin', 'FairCoinX']:
+            configs[fairchain] = SimpleConfig(options={'selected_fairchain': fairchain},
+                                              read_user_config_function=lambda _: {},
+                                              read_user_dir_function=read_user_dir)
+            self.addCleanup(shutil.rmtree, configs[fairchain].path)
+        fair, fcx = configs['FairCoin'], configs['FairCoinX']
+        self.assertEqual('FairCoin', fair.net.FAIRCHAIN)
+        self.assertEqual('FairCoinX', fcx.net.FAIRCHAIN)
+        self.assertIs(get_fairchain('FairCoinX'), fcx.net)
+        self.assertNotEqual(fair.net.GENESIS, fcx.net.GENESIS)
+        self.assertNotEqual(fair.path, fcx.path)
+
     def test_depth_target_to_fee(self):
         config = SimpleConfig(self.options)
         config.mempool_fees = [[49, 100110], [10, 121301], [6, 153731], [5, 125872], [1, 36488810]]
@@ -0,0 +1,388 @@
+import asyncio
+from collections import defaultdict
+
+from aiorpcx import ProtocolError, RPCError, Notification
+
+from ...interface import NotificationSession
+from ...network import UntrustedServerReturnedError
+from ...synchronizer import SynchronizerBase, Synchronizer
+
+from . import SequentialTestCase
+from .test_address_synchronizer import make_tx, external_outpoint, ADDRESSES
+
+
+METHOD = 'blockchain.scripthash.subscribe'
+
+
+class MockSession(NotificationSession):
+    """NotificationSession without a connection. Batches are rejected
+    while batch_error is set."""
+
+    def __init__(self, batch_error=None):
+        self.subscriptions = defaultdict(list)
+        self.cache = {}
+        self.batch_error = batch_error
+        self.batches = []
+        self.requests = []
+        self.interface = None
+
+    async def send_batch_request(self, method, params_list, **kwargs):
+        assert method == METHOD, method
+        self.batches.append([params[0] for params in params_list])
+        if self.batch_error:
+            raise self.batch_error
+        return ['status_' + params[0] for params in params_list]
+
+    async def send_request(self, method, params, **kwargs):
+        assert method == METHOD, method
+        self.requests.append(params[0])
+        return 'status_' + params[0]
+
+    def notify(self, h):
+        """Delivers a status notification for h, as the server would."""
+        return self.handle_request(Notification(METHOD, [h, 'new_status_' + h]))
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+class TestSubscribeMany(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        super().tearDown()
+        self.loop.close()
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def subscribe_many(self, session, hashes):
+        async def f():
+            queue = asyncio.Queue()
+            await session.subscribe_many(METHOD, [[h] for h in hashes], queue)
+            return queue
+        return self.run_coro(f())
+
+    def test_batch_path(self):
+        session = MockSession()
+        session.cache[session.get_hashable_key_for_rpc_call(METHOD, ['h1'])] = 'cached_h1'
+        queue = self.subscribe_many(session, ['h1', 'h2', 'h3'])
+        # only the uncached subscriptions are sent, as one batch
+        self.assertEqual([['h2', 'h3']], session.batches)
+        self.assertEqual([['h1', 'cached_h1'], ['h2', 'status_h2'], ['h3', 'status_h3']], drain(queue))
+        for h in ['h1', 'h2', 'h3']:
+            key = session.get_hashable_key_for_rpc_call(METHOD, [h])
+            self.assertEqual([queue], session.subscriptions[key])
+        self.run_coro(session.notify('h2'))
+        self.assertEqual([['h2', 'new_status_h2']], drain(queue))
+
+    def test_fully_cached_batch_is_not_sent(self):
+        session = MockSession()
+        session.cache[session.get_hashable_key_for_rpc_call(METHOD, ['h1'])] = 'cached_h1'
+        queue = self.subscribe_many(session, ['h1'])
+        self.assertEqual([], session.batches)
+        self.assertEqual([['h1', 'cached_h1']], drain(queue))
+
+    def test_failed_batch_keeps_no_subscriptions(self):
+        session = MockSession(batch_error=ProtocolError(-32600, 'batches not supported'))
+        session.cache[session.get_hashable_key_for_rpc_call(METHOD, ['h1'])] = 'cached_h1'
+        async def f():
+            queue = asyncio.Queue()
+            with self.assertRaises(ProtocolError):
+                await session.subscribe_many(METHOD, [['h1'], ['h2']], queue)
+            return queue
+        queue = self.run_coro(f())
+        self.assertEqual([], drain(queue))
+        self.assertFalse(any(session.subscriptions.values()))
+
+
+class MockTaskGroup:
+    def __init__(self):
+        self.tasks = []
+    async def spawn(self, func, *args):
+        self.tasks.append(asyncio.ensure_future(func(*args)))
+
+
+class MockInterface:
+    def __init__(self, session):
+        self.session = session
+
+
+class MockSynchronizer(SynchronizerBase):
+    """Only the subscription sending parts of SynchronizerBase."""
+
+    def __init__(self, session, batch_size):
+        self.interface = MockInterface(session)
+        self.group = MockTaskGroup()
+        self.batch_size = batch_size
+        self.max_in_flight = 500
+        self.requested_addrs = set()
+        self.in_flight_semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._server_supports_batches = batch_size > 1
+        self.scripthash_to_address = {}
+        self.add_queue = asyncio.Queue()
+        self.status_queue = asyncio.Queue()
+
+    def _get_scripthash(self, addr):
+        return 'hash_' + addr
+
+    def print_error(self, *msg):
+        pass
+
+
+class TestSendSubscriptions(SequentialTestCase):
+
+    def send_subscriptions(self, session, addrs, batch_size=10):
+        """Runs send_subscriptions until addrs are subscribed, then delivers
+        one notification per address. Returns the synchronizer."""
+        async def f():
+            sync = MockSynchronizer(session, batch_size)
+            for addr in addrs:
+                sync.requested_addrs.add(addr)
+                sync.add_queue.put_nowait(addr)
+            task = asyncio.ensure_future(sync.send_subscriptions())
+            while sync.requested_addrs:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, *sync.group.tasks, return_exceptions=True)
+            for addr in addrs:
+                await session.notify(sync._get_scripthash(addr))
+            return sync
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(f())
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    def test_addresses_are_subscribed_in_one_batch(self):
+        session = MockSession()
+        sync = self.send_subscriptions(session, ['a1', 'a2', 'a3'])
+        self.assertEqual([['hash_a1', 'hash_a2', 'hash_a3']], session.batches)
+        self.assertEqual([], session.requests)
+        items = drain(sync.status_queue)
+        self.assertEqual(6, len(items))
+        self.assertEqual({'hash_a1': 'a1', 'hash_a2': 'a2', 'hash_a3': 'a3'}, sync.scripthash_to_address)
+        self.assertEqual(3, len([item for item in items if item[1].startswith('new_status_')]))
+
+    def test_rejected_batch_falls_back_to_single_subscriptions(self):
+        session = MockSession(batch_error=ProtocolError(-32600, 'batches not supported'))
+        sync = self.send_subscriptions(session, ['a1', 'a2', 'a3'])
+        self.assertEqual(1, len(session.batches))
+        self.assertFalse(sync._server_supports_batches)
+        self.assertEqual({'hash_a1', 'hash_a2', 'hash_a3'}, set(session.requests))
+        for h in ['hash_a1', 'hash_a2', 'hash_a3']:
+            key = session.get_hashable_key_for_rpc_call(METHOD, [h])
+            self.assertEqual([sync.status_queue], session.subscriptions[key])
+        # one subscription result and one notification per address
+        items = drain(sync.status_queue)
+        self.assertEqual(['hash_a1', 'hash_a1', 'hash_a2', 'hash_a2', 'hash_a3', 'hash_a3'],
+                         sorted(item[0] for item in items))
+
+
+class MockTxNetwork:
+    """Serves the txs it knows. Fetches block until released, and
+    batches are rejected while batch_error is set."""
+
+    def __init__(self, txs, batch_error=None):
+        self.txs = {tx.txid(): tx for tx in txs}
+        self.batch_error = batch_error
+        self.released = asyncio.Event()
+        self.batches = []
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.callbacks = []
+
+    def not_found(self):
+        return UntrustedServerReturnedError(original_exception=RPCError(2, 'No such mempool or blockchain transaction'))
+
+    async def fetch(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await self.released.wait()
+        finally:
+            self.in_flight -= 1
+
+    async def get_transactions(self, tx_hashes):
+        self.batches.append(list(tx_hashes))
+        if self.batch_error:
+            raise self.batch_error
+        await self.fetch()
+        return [self.txs[tx_hash].raw if tx_hash in self.txs else self.not_found()
+                for tx_hash in tx_hashes]
+
+    async def get_transaction(self, tx_hash):
+        self.requests.append(tx_hash)
+        await self.fetch()
+        if tx_hash not in self.txs:
+            raise self.not_found()
+        return self.txs[tx_hash].raw
+
+    def trigger_callback(self, event, *args):
+        self.callbacks.append(event)
+
+
+class MockDB:
+    def get_transaction(self, tx_hash):
+        return None
+
+
+class MockWallet:
+    def __init__(self, network):
+        self.network = network
+        self.db = MockDB()
+        self.received = []
+        self.txs = []
+
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.received.append((tx_hash, tx_height))
+        self.txs.append(tx)
+
+
+class MockTxSynchronizer(Synchronizer):
+    """Only the tx fetching parts of Synchronizer."""
+
+    def __init__(self, network, batch_size, concurrency):
+        self.network = network
+        self.wallet = MockWallet(network)
+        self.group = MockTaskGroup()
+        self.tx_batch_size = batch_size
+        self.tx_concurrency = concurrency
+        self._server_supports_batches = batch_size > 1
+        self.requested_tx = {}
+        self.tx_queue = asyncio.PriorityQueue()
+        self._tx_queue_seq = 0
+        self.tx_fetch_semaphore = asyncio.Semaphore(concurrency)
+
+    def print_error(self, *msg):
+        pass
+
+
+def funding_tx(label):
+    return make_tx([external_outpoint(label)], [(ADDRESSES[0], 1000)])
+
+
+class TestFetchTransactions(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        super().tearDown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def settle(self):
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def finish(self, sync, task):
+        """Releases the fetches and waits for them, then stops the fetch loop."""
+        sync.network.released.set()
+        while sync.requested_tx and not any(t.done() and t.exception() for t in sync.group.tasks):
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*sync.group.tasks, return_exceptions=True)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    def test_newest_txs_are_fetched_first(self):
+        txs = {height: funding_tx(str(height)) for height in [0, 100, 200, 300]}
+        network = MockTxNetwork(txs.values())
+        sync = MockTxSynchronizer(network, batch_size=2, concurrency=1)
+        async def f():
+            task = asyncio.ensure_future(sync._fetch_transactions())
+            await sync._request_missing_txs([(txs[100].txid(), 100)])
+            await self.settle()
+            # the only fetch is busy while more txs are queued, older ones first
+            for h in [200, 300, 0]:
+                await sync._request_missing_txs([(txs[h].txid(), h)])
+                await self.settle()
+            self.assertEqual(1, network.in_flight)
+            await self.finish(sync, task)
+        self.run_coro(f())
+        self.assertEqual([txs[100].txid(), txs[200].txid()], network.requests)
+        self.assertEqual([[txs[0].txid(), txs[300].txid()]], network.batches)
+        self.assertEqual([(txs[h].txid(), h) for h in [100, 0, 300, 200]], sync.wallet.received)
+        self.assertEqual({}, sync.requested_tx)
+
+    def test_concurrency_is_bounded(self):
+        txs = [funding_tx(str(i)) for i in range(6)]
+        network = MockTxNetwork(txs)
+        sync = MockTxSynchronizer(network, batch_size=2, concurrency=2)
+        async def f():
+            task = asyncio.ensure_future(sync._fetch_transactions())
+            await sync._request_missing_txs([(tx.txid(), 100) for tx in txs])
+            await self.settle()
+            self.assertEqual(2, network.in_flight)
+            self.assertEqual([2, 2], [len(batch) for batch in network.batches])
+            # the rest waits in the queue
+            self.assertEqual(2, sync.tx_queue.qsize())
+            await self.finish(sync, task)
+        self.run_coro(f())
+        self.assertEqual(2, network.max_in_flight)
+        self.assertEqual(3, len(network.batches))
+        self.assertEqual({tx.txid() for tx in txs}, {tx_hash for tx_hash, height in sync.wallet.received})
+        # checked without deserializing the inputs
+        self.assertEqual([None] * 6, [tx._inputs for tx in sync.wallet.txs])
+
+    def test_tx_not_found_in_batch(self):
+        found = [funding_tx('found1'), funding_tx('found2')]
+        missing = funding_tx('missing')
+        network = MockTxNetwork(found)
+        sync = MockTxSynchronizer(network, batch_size=10, concurrency=1)
+        async def f():
+            task = asyncio.ensure_future(sync._fetch_transactions())
+            await sync._request_missing_txs([(tx.txid(), 100) for tx in found + [missing]],
+                                            allow_server_not_finding_tx=True)
+            await self.finish(sync, task)
+        self.run_coro(f())
+        self.assertEqual(1, len(network.batches))
+        self.assertEqual({tx.txid() for tx in found}, {tx_hash for tx_hash, height in sync.wallet.received})
+        self.assertEqual({}, sync.requested_tx)
+
+    def test_tx_not_found_in_batch_is_an_error(self):
+        found = funding_tx('found')
+        missing = funding_tx('missing')
+        network = MockTxNetwork([found])
+        sync = MockTxSynchronizer(network, batch_size=10, concurrency=1)
+        async def f():
+            task = asyncio.ensure_future(sync._fetch_transactions())
+            await sync._request_missing_txs([(found.txid(), 100), (missing.txid(), 100)])
+            await self.finish(sync, task)
+            return sync.group.tasks[0].exception()
+        e = self.run_coro(f())
+        self.assertIsInstance(e, UntrustedServerReturnedError)
+        self.assertEqual([], sync.wallet.received)
+
+    def test_rejected_batch_falls_back_to_single_requests(self):
+        txs = [funding_tx(str(i)) for i in range(3)]
+        missing = funding_tx('missing')
+        network = MockTxNetwork(txs, batch_error=UntrustedServerReturnedError(
+            original_exception=ProtocolError(-32600, 'batches not supported')))
+        sync = MockTxSynchronizer(network, batch_size=10, concurrency=1)
+        async def f():
+            task = asyncio.ensure_future(sync._fetch_transactions())
+            await sync._request_missing_txs([(tx.txid(), 100) for tx in txs + [missing]],
+                                            allow_server_not_finding_tx=True)
+            await self.finish(sync, task)
+        self.run_coro(f())
+        self.assertEqual(1, len(network.batches))
+        self.assertFalse(sync._server_supports_batches)
+        self.assertEqual({tx.txid() for tx in txs + [missing]}, set(network.requests))
+        self.assertEqual({tx.txid() for tx in txs}, {tx_hash for tx_hash, height in sync.wallet.received})
+        self.assertEqual({}, sync.requested_tx)
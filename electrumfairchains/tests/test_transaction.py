@@ -1,7 +1,9 @@
 from electrumfairchains import transaction
-from ...transaction import TxOutputForUI, tx_from_str
-from ...bitcoin import TYPE_ADDRESS
+from ...transaction import TxOutput, TxOutputForUI, tx_from_str
+from ...bitcoin import TYPE_ADDRESS, pubkey_to_address, var_int, int_to_hex
+from ...ecc import ECPrivkey
 from ...keystore import xpubkey_to_address
+from ...signing_pool import SigningPool, set_signing_pool
 from ...util import bh2u, bfh
 
 from . import SequentialTestCase, TestCaseForTestnet
@@ -173,6 +175,83 @@ class TestTransaction(SequentialTestCase):
         tx = transaction.Transaction(v2_blob)
         self.assertEqual(tx.txid(), "b97f9180173ab141b61b9f944d841e60feec691d6daab4d4d932b24dd36606fe")
 
+    def test_txid_cache_invalidated_on_mutation(self):
+        tx = transaction.Transaction(v2_blob)
+        txid = tx.txid()
+        self.assertEqual(txid, tx.txid())
+        self.assertEqual(v2_blob, tx.serialize_to_network())
+        tx.locktime += 1
+        self.assertNotEqual(txid, tx.txid())
+        tx.locktime -= 1
+        self.assertEqual(txid, tx.txid())
+        tx.set_rbf(True)
+        self.assertNotEqual(txid, tx.txid())
+        tx.set_rbf(False)
+        self.assertEqual(txid, tx.txid())
+
+    def test_outputs_and_outpoints_without_inputs(self):
+        tx = transaction.Transaction(v2_blob)
+        outputs = tx.outputs()
+        self.assertEqual([('b5b9f4db712f34c996ef0853afe6d1f6cea1eac6fb7b2b5061e0814aa4011619', 0)],
+                         tx.outpoints())
+        self.assertFalse(tx.is_coinbase())
+        self.assertIsNone(tx._inputs)
+        self.assertEqual(468134, tx.locktime)
+        d = transaction.deserialize(v2_blob)
+        self.assertEqual([(x['type'], x['address'], x['value']) for x in d['outputs']],
+                         [tuple(o) for o in outputs])
+        self.assertEqual([(x['prevout_hash'], x['prevout_n']) for x in tx.inputs()], tx.outpoints())
+        self.assertIs(outputs, tx.outputs())
+
+    def test_legacy_preimage_uses_cached_parts(self):
+        pubkeys = ['02e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6',
+                   '0253e8e0254b0c95776786e40984c1aa32a7d03efa6bdacdea5f421b774917d346',
+                   '03cb3e00561c3439ccbacc033a72e0513bcfabff8826de0bc651d661991ade6171']
+        inputs = [{'type': 'p2pkh', 'address': pubkey_to_address('p2pkh', pubkey),
+                   'prevout_hash': '%02x' % k * 32, 'prevout_n': k, 'x_pubkeys': [pubkey],
+                   'pubkeys': [pubkey], 'signatures': [None], 'num_sig': 1, 'value': 1000}
+                  for k, pubkey in enumerate(pubkeys)]
+        outputs = [TxOutput(TYPE_ADDRESS, inputs[0]['address'], 2500)]
+        tx = transaction.Transaction.from_io(inputs, outputs, locktime=1234)
+
+        def expected_preimage(i):
+            txins = var_int(3) + ''.join(tx.serialize_input(txin, tx.get_preimage_script(txin) if i == k else '')
+                                         for k, txin in enumerate(tx.inputs()))
+            txouts = var_int(1) + tx.serialize_output(tx.outputs()[0])
+            return (int_to_hex(tx.version, 4) + txins + txouts
+                    + int_to_hex(tx.locktime, 4) + int_to_hex(1, 4))
+
+        for i in range(3):
+            self.assertEqual(expected_preimage(i), tx.serialize_preimage(i))
+        tx.add_signature_to_txin(1, 0, signed_blob_signatures[0])
+        tx.set_rbf(True)
+        tx.locktime = 1235
+        for i in range(3):
+            self.assertEqual(expected_preimage(i), tx.serialize_preimage(i))
+
+    def test_sign_with_signing_pool(self):
+        secrets = [bytes([k + 1]) * 32 for k in range(4)]
+        keypairs = {}
+        inputs = []
+        for k, secret in enumerate(secrets):
+            pubkey = ECPrivkey(secret).get_public_key_hex(compressed=True)
+            keypairs[pubkey] = (secret, True)
+            inputs.append({'type': 'p2pkh', 'address': pubkey_to_address('p2pkh', pubkey),
+                           'prevout_hash': '%02x' % k * 32, 'prevout_n': 0, 'x_pubkeys': [pubkey],
+                           'pubkeys': [pubkey], 'signatures': [None], 'num_sig': 1, 'value': 1000})
+        outputs = [TxOutput(TYPE_ADDRESS, inputs[0]['address'], 3000)]
+        serial_tx = transaction.Transaction.from_io([dict(x) for x in inputs], outputs)
+        serial_tx.sign(keypairs)
+        self.assertTrue(serial_tx.is_complete())
+        pool = SigningPool(1, min_signatures=2)
+        set_signing_pool(pool)
+        try:
+            tx = transaction.Transaction.from_io([dict(x) for x in inputs], outputs)
+            tx.sign(keypairs)
+        finally:
+            set_signing_pool(None)
+        self.assertEqual(serial_tx.raw, tx.raw)
+
     def test_tx_from_str(self):
         # json dict
         self.assertEqual('020000000001012005273af813ba23b0c205e4b145e525c280dd876e061f35bff7db9b2e0043640100000000fdffffff02d885010000000000160014e73f444b8767c84afb46ef4125d8b81d2542a53d00e1f5050000000017a914052ed032f5c74a636ed5059611bb90012d40316c870247304402200c628917673d75f05db893cc377b0a69127f75e10949b35da52aa1b77a14c350022055187adf9a668fdf45fc09002726ba7160e713ed79dddcd20171308273f1a2f1012103cb3e00561c3439ccbacc033a72e0513bcfabff8826de0bc651d661991ade6171049e1600',
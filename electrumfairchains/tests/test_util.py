@@ -1,7 +1,10 @@
+import asyncio
 from decimal import Decimal
 
+from aiohttp import web
+
 from ...util import (format_satoshis, format_fee_satoshis, parse_URI,
-                           is_hash256_str)
+                           is_hash256_str, make_aiohttp_session, http_session_pool)
 
 from . import SequentialTestCase
 
@@ -94,3 +97,38 @@ class TestUtil(SequentialTestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'faircoin:fRX2YQHNpFMSyzNAnjfQii4kCcmHhwFdQq?amount=0.0003&label=test&amount=30.0')
+
+    def test_aiohttp_sessions_are_pooled(self):
+        async def handle(request):
+            return web.Response(text='ok')
+        async def run():
+            app = web.Application()
+            app.router.add_get('/', handle)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', 0).start()
+            host, port = runner.addresses[0][:2]
+            url = 'http://%s:%d/' % (host, port)
+            sessions = []
+            try:
+                for i in range(3):
+                    async with make_aiohttp_session(None) as session:
+                        async with session.get(url) as response:
+                            self.assertEqual('ok', await response.text())
+                        sessions.append(session)
+                for fut in http_session_pool.reset():
+                    await asyncio.wrap_future(fut)
+            finally:
+                await runner.cleanup()
+            return sessions, http_session_pool.get_host_stats()[host]
+        loop = asyncio.new_event_loop()
+        try:
+            sessions, stats = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertIs(sessions[0], sessions[1])
+        self.assertIs(sessions[0], sessions[2])
+        self.assertTrue(sessions[0].closed)
+        self.assertEqual(3, stats['requests'])
+        self.assertEqual(1, stats['connections_created'])
+        self.assertEqual(2, stats['connections_reused'])
@@ -0,0 +1,221 @@
+import asyncio
+from unittest import mock
+
+from aiorpcx import RPCError
+
+from ... import verifier
+from ...bitcoin import hash_encode
+from ...crypto import sha256d
+from ...interface import GracefulDisconnect
+from ...network import UntrustedServerReturnedError
+from ...verifier import SPV, verify_txs_are_in_blocks, MerkleRootMismatch
+
+from . import SequentialTestCase
+
+
+def make_block(height, num_txs):
+    """Header and merkle branch of each tx of a block of num_txs made up
+    txs (num_txs a power of two). Returns header, [(tx_hash, pos, branch)]."""
+    leaves = [sha256d(('%d:%d' % (height, i)).encode()) for i in range(num_txs)]
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)])
+    txs = []
+    for pos, leaf in enumerate(leaves):
+        branch = [hash_encode(level[(pos >> i) ^ 1]) for i, level in enumerate(levels[:-1])]
+        txs.append((hash_encode(leaf), pos, branch))
+    header = {'version': 1, 'prev_block_hash': '00' * 32, 'merkle_root': hash_encode(levels[-1][0]),
+              'payload_hash': '00' * 32, 'timestamp': 1500000000 + height, 'creatorId': 1,
+              'block_height': height}
+    return header, txs
+
+
+class CountingSha256d:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, x):
+        self.calls += 1
+        return sha256d(x)
+
+
+class TestVerifyTxsAreInBlocks(SequentialTestCase):
+
+    def verify(self, proofs, headers):
+        counter = CountingSha256d()
+        with mock.patch.object(verifier, 'sha256d', counter):
+            errors = verify_txs_are_in_blocks(proofs, headers)
+        return errors, counter.calls
+
+    def test_txs_in_one_block_share_inner_nodes(self):
+        header, txs = make_block(100, 8)
+        proofs = [(tx_hash, 100, pos, branch) for tx_hash, pos, branch in txs[:4]]
+        errors, calls = self.verify(proofs, {100: header})
+        self.assertEqual([None] * 4, errors)
+        # 12 without the cache: pos 1 and 3 share all of their inner nodes
+        # with pos 0 and 2, pos 2 all but the lowest with pos 0
+        self.assertEqual(4, calls)
+        for tx_hash, pos, branch in txs[:4]:
+            self.assertEqual(header['merkle_root'], SPV.hash_merkle_root(branch, tx_hash, pos))
+
+    def test_blocks_do_not_share_inner_nodes(self):
+        header1, txs1 = make_block(100, 2)
+        header2, txs2 = make_block(101, 2)
+        # same branch against another block's header
+        tx_hash, pos, branch = txs1[1]
+        proofs = ([(tx_hash, 100, pos, branch) for tx_hash, pos, branch in txs1]
+                  + [(tx_hash, 101, pos, branch) for tx_hash, pos, branch in txs2]
+                  + [(tx_hash, 101, pos, branch)])
+        errors, _ = self.verify(proofs, {100: header1, 101: header2})
+        self.assertEqual([None] * 4, errors[:4])
+        self.assertIsInstance(errors[4], MerkleRootMismatch)
+
+    def test_bad_proof_does_not_poison_the_cache(self):
+        header, txs = make_block(100, 4)
+        tx_hash, pos, branch = txs[0]
+        bad_branch = ['00' * 32] + branch[1:]
+        proofs = [(tx_hash, 100, pos, bad_branch)] + [(tx_hash, 100, pos, branch) for tx_hash, pos, branch in txs]
+        errors, _ = self.verify(proofs, {100: header})
+        self.assertIsInstance(errors[0], MerkleRootMismatch)
+        self.assertEqual([None] * 4, errors[1:])
+
+
+class MockBlockchain:
+    def __init__(self, headers):
+        self.headers = headers
+
+    def read_header(self, height):
+        return self.headers.get(height)
+
+
+class MockNetwork:
+    """Serves merkle proofs by tx_hash. The proof of a tx in errors is
+    replaced by that error."""
+
+    def __init__(self, headers, merkles, errors=None, config=None):
+        self.headers = headers
+        self.merkles = merkles
+        self.errors = errors or {}
+        self.config = config or {}
+        self.bhi_lock = asyncio.Lock()
+        self.batches = []
+
+    def blockchain(self):
+        return MockBlockchain(self.headers)
+
+    async def get_merkles_for_transactions(self, txs):
+        self.batches.append([tx_hash for tx_hash, tx_height in txs])
+        return [self.errors.get(tx_hash) or self.merkles[tx_hash] for tx_hash, tx_height in txs]
+
+
+class MockWallet:
+    def __init__(self):
+        self.verified = {}
+        self.removed = []
+
+    def add_verified_tx(self, tx_hash, info):
+        self.verified[tx_hash] = info
+
+    def remove_unverified_tx(self, tx_hash, tx_height):
+        self.removed.append((tx_hash, tx_height))
+
+
+class MockSPV(SPV):
+    """Only the proof verifying parts of SPV."""
+
+    def __init__(self, network):
+        self.network = network
+        self.wallet = MockWallet()
+        self.merkle_roots = {}
+        self.requested_merkle = set()
+        self._server_supports_batches = True
+
+    def print_error(self, *msg):
+        pass
+
+
+class TestRequestAndVerifyProofs(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.headers = {}
+        self.merkles = {}
+        self.txs = []
+        for height in [100, 101]:
+            header, txs = make_block(height, 4)
+            self.headers[height] = header
+            for tx_hash, pos, branch in txs:
+                self.merkles[tx_hash] = {'block_height': height, 'pos': pos, 'merkle': branch}
+                self.txs.append((tx_hash, height))
+
+    def tearDown(self):
+        super().tearDown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def request_and_verify(self, network):
+        spv = MockSPV(network)
+        spv.requested_merkle.update(tx_hash for tx_hash, tx_height in self.txs)
+        coro = spv._request_and_verify_proofs(self.txs)
+        return spv, coro
+
+    def test_batch_is_verified(self):
+        network = MockNetwork(self.headers, self.merkles)
+        spv, coro = self.request_and_verify(network)
+        self.loop.run_until_complete(coro)
+        self.assertEqual([[tx_hash for tx_hash, tx_height in self.txs]], network.batches)
+        self.assertEqual({tx_hash for tx_hash, tx_height in self.txs}, set(spv.wallet.verified))
+        for tx_hash, tx_height in self.txs:
+            info = spv.wallet.verified[tx_hash]
+            self.assertEqual(tx_height, info.height)
+            self.assertEqual(self.merkles[tx_hash]['pos'], info.txpos)
+            self.assertEqual(self.headers[tx_height]['merkle_root'], spv.merkle_roots[tx_hash])
+        self.assertEqual(set(), spv.requested_merkle)
+        self.assertTrue(spv.is_up_to_date())
+
+    def bad_proof_network(self, config=None):
+        bad_tx_hash = self.txs[5][0]
+        merkle = dict(self.merkles[bad_tx_hash])
+        merkle['merkle'] = ['00' * 32] + merkle['merkle'][1:]
+        self.merkles[bad_tx_hash] = merkle
+        return bad_tx_hash, MockNetwork(self.headers, self.merkles, config=config)
+
+    def test_bad_proof_in_batch_disconnects(self):
+        bad_tx_hash, network = self.bad_proof_network()
+        spv, coro = self.request_and_verify(network)
+        with self.assertRaises(GracefulDisconnect):
+            self.loop.run_until_complete(coro)
+        # the proofs before it were good
+        self.assertEqual({tx_hash for tx_hash, tx_height in self.txs[:5]}, set(spv.wallet.verified))
+        self.assertIn(bad_tx_hash, spv.requested_merkle)
+
+    def test_bad_proof_in_batch_with_skipmerklecheck(self):
+        bad_tx_hash, network = self.bad_proof_network(config={'skipmerklecheck': True})
+        spv, coro = self.request_and_verify(network)
+        self.loop.run_until_complete(coro)
+        self.assertEqual({tx_hash for tx_hash, tx_height in self.txs}, set(spv.wallet.verified))
+        self.assertEqual(set(), spv.requested_merkle)
+
+    def test_rpc_error_in_batch_removes_unverified_tx(self):
+        missing_tx_hash, missing_height = self.txs[2]
+        error = UntrustedServerReturnedError(original_exception=RPCError(1, 'tx not in block'))
+        network = MockNetwork(self.headers, self.merkles, errors={missing_tx_hash: error})
+        spv, coro = self.request_and_verify(network)
+        self.loop.run_until_complete(coro)
+        self.assertEqual([(missing_tx_hash, missing_height)], spv.wallet.removed)
+        self.assertEqual({tx_hash for tx_hash, tx_height in self.txs} - {missing_tx_hash},
+                         set(spv.wallet.verified))
+        self.assertEqual(set(), spv.requested_merkle)
+
+    def test_other_error_in_batch_is_raised(self):
+        failed_tx_hash = self.txs[2][0]
+        error = UntrustedServerReturnedError(original_exception=Exception('unexpected'))
+        network = MockNetwork(self.headers, self.merkles, errors={failed_tx_hash: error})
+        spv, coro = self.request_and_verify(network)
+        with self.assertRaises(UntrustedServerReturnedError):
+            self.loop.run_until_complete(coro)
+        self.assertEqual([], spv.wallet.removed)
+        self.assertEqual({}, spv.wallet.verified)
@@ -7,13 +7,16 @@ from decimal import Decimal
 import time
 
 from io import StringIO
-from ...storage import WalletStorage
+from ...storage import WalletStorage, convert_wallet_file
+from ...sqlite_db import SqliteDB
+from ...util import WalletFileException
 from ...json_db import FINAL_SEED_VERSION
 from ...wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
                              restore_wallet_from_text)
 from ...exchange_rate import ExchangeBase, FxThread
 from ...util import TxMinedInfo
 from ...bitcoin import COIN
+from ...transaction import Transaction
 from ...json_db import JsonDB
 
 from . import SequentialTestCase
@@ -79,6 +82,205 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def test_write_appends_journal_records(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.put("c", {"d": 1})
+        storage.write()
+        snapshot_size = os.path.getsize(self.wallet_path)
+
+        storage.put("a", "x")
+        storage.put("c", None)
+        storage.db.set_addr_history("addr1", [["txid1", 5]])
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertGreater(len(contents), snapshot_size)
+        self.assertEqual(3, contents.count("\n[", snapshot_size))
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("x", storage.get("a"))
+        self.assertEqual(None, storage.get("c"))
+        self.assertEqual([["txid1", 5]], storage.db.get_addr_history("addr1"))
+
+    def test_truncated_journal_record_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+        with open(self.wallet_path, "a") as f:
+            f.write('\n["set", ["a"], "trunc')
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("c", storage.get("a"))
+
+    def test_save_after_truncated_journal_record(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+        # crash while appending
+        with open(self.wallet_path, "a") as f:
+            f.write('\n["set", ["a"], "trunc')
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        storage.put("d", "e")
+        storage.write()
+        storage.put("f", "g")
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertEqual("c", storage.get("a"))
+        self.assertEqual("e", storage.get("d"))
+        self.assertEqual("g", storage.get("f"))
+
+    def test_sqlite_storage(self):
+        storage = WalletStorage(self.wallet_path, db_type='sqlite')
+        storage.put("a", {"b": 1})
+        storage.db.set_addr_history("addr1", [("txid1", 5)])
+        storage.db.add_txo_addr("txid1", "addr1", 0, 1000, False)
+        storage.db.set_spent_outpoint("txid1", 0, "txid2")
+        storage.write()
+        storage.db.close()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"b": 1}, storage.get("a"))
+        self.assertEqual([("txid1", 5)], storage.db.get_addr_history("addr1"))
+        self.assertEqual({(0, 1000, False)}, storage.db.get_txo_addr("txid1", "addr1"))
+        self.assertEqual(["addr1"], storage.db.get_txo("txid1"))
+        self.assertEqual("txid2", storage.db.get_spent_outpoint("txid1", 0))
+        storage.db.close()
+
+    def test_addr_status_is_stored_with_history(self):
+        for db_type in ['json', 'sqlite']:
+            path = self.wallet_path + '.' + db_type
+            storage = WalletStorage(path, db_type=db_type)
+            storage.db.set_addr_history("addr1", [("txid1", 5)], "status1")
+            storage.db.set_addr_history("addr2", [("txid2", 6)], "status2")
+            storage.write()
+            storage.db.set_addr_history("addr2", [("txid2", 6), ("txid3", 7)])
+            storage.write()
+            if db_type == 'sqlite':
+                storage.db.close()
+
+            storage = WalletStorage(path)
+            self.assertEqual("status1", storage.db.get_addr_status("addr1"))
+            # history changed without a known status
+            self.assertEqual(None, storage.db.get_addr_status("addr2"))
+            storage.db.remove_addr_history("addr1")
+            self.assertEqual(None, storage.db.get_addr_status("addr1"))
+            if db_type == 'sqlite':
+                storage.db.close()
+
+    def test_convert_wallet_file_round_trip(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", {"b": 1})
+        db = storage.db
+        db.add_txi_addr("txid2", "addr1", "txid1:0", 1000)
+        db.add_txo_addr("txid1", "addr1", 0, 1000, False)
+        db.add_transaction("txid1", Transaction("0100"))
+        db.add_transaction("txid2", Transaction("0200"))
+        db.set_spent_outpoint("txid1", 0, "txid2")
+        db.set_addr_history("addr1", [("txid1", 5), ("txid2", 6)], "status1")
+        db.add_verified_tx("txid1", TxMinedInfo(height=5, timestamp=1, txpos=2, header_hash="hash1"))
+        db.update_tx_fees({"txid2": 100})
+        storage.write()
+
+        def check(storage):
+            db = storage.db
+            self.assertEqual({"b": 1}, storage.get("a"))
+            self.assertEqual({("txid1:0", 1000)}, set(db.get_txi_addr("txid2", "addr1")))
+            self.assertEqual({(0, 1000, False)}, set(db.get_txo_addr("txid1", "addr1")))
+            self.assertEqual("0100", db.get_transaction("txid1").raw)
+            self.assertEqual("txid2", db.get_spent_outpoint("txid1", 0))
+            self.assertEqual([("txid1", 5), ("txid2", 6)],
+                             [tuple(x) for x in db.get_addr_history("addr1")])
+            self.assertEqual("status1", db.get_addr_status("addr1"))
+            self.assertEqual(5, db.get_verified_tx("txid1").height)
+            self.assertEqual("hash1", db.get_verified_tx("txid1").header_hash)
+            self.assertEqual(100, db.get_tx_fee("txid2"))
+
+        backup = convert_wallet_file(self.wallet_path, 'sqlite')
+        self.assertEqual(self.wallet_path + '.bak', backup)
+        storage = WalletStorage(self.wallet_path)
+        self.assertIsInstance(storage.db, SqliteDB)
+        check(storage)
+        storage.db.close()
+
+        with self.assertRaises(WalletFileException):
+            convert_wallet_file(self.wallet_path, 'json')
+        os.remove(backup)
+        convert_wallet_file(self.wallet_path, 'json')
+        storage = WalletStorage(self.wallet_path)
+        self.assertIsInstance(storage.db, JsonDB)
+        check(storage)
+
+    def test_transactions_are_loaded_lazily(self):
+        db = JsonDB(json.dumps({
+            "seed_version": FINAL_SEED_VERSION,
+            "transactions": {"txid1": "0100", "txid2": "0200"},
+            "txo": {"txid1": {"addr1": [[0, 1000, False]]}},
+            "spent_outpoints": {"txid0": {"0": "txid2"}},
+        }), manual_upgrades=True)
+        self.assertEqual("0100", db.transactions["txid1"])
+        self.assertEqual([[0, 1000, False]], db.txo["txid1"]["addr1"])
+
+        self.assertEqual("0100", str(db.get_transaction("txid1")))
+        self.assertEqual({(0, 1000, False)}, db.get_txo_addr("txid1", "addr1"))
+        # txid2 is not referenced by txi/txo
+        self.assertEqual(["txid1"], db.list_transactions())
+        self.assertEqual(None, db.get_spent_outpoint("txid0", 0))
+
+    def test_get_readonly_does_not_copy(self):
+        storage = WalletStorage(self.wallet_path)
+        labels = {"addr1": "label"}
+        storage.put("labels", labels)
+        labels["addr2"] = "not saved"
+        self.assertEqual({"addr1": "label"}, storage.get_readonly("labels"))
+        self.assertIs(storage.get_readonly("labels"), storage.get_readonly("labels"))
+        self.assertIsNot(storage.get("labels"), storage.get_readonly("labels"))
+        self.assertEqual([], storage.get_readonly("frozen_coins", []))
+
+    def test_encrypted_journal(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.set_password("secret", enc_version=1)
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        storage.decrypt("secret")
+        self.assertEqual("c", storage.get("a"))
+
+    def test_save_after_truncated_encrypted_journal_record(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", "b")
+        storage.set_password("secret", enc_version=1)
+        storage.write()
+        storage.put("a", "c")
+        storage.write()
+        # crash while appending
+        with open(self.wallet_path, "a") as f:
+            f.write('\nQklFMQ')
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        storage.decrypt("secret")
+        self.assertEqual("c", storage.get("a"))
+        storage.put("d", "e")
+        storage.write()
+        storage.put("f", "g")
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True)
+        storage.decrypt("secret")
+        self.assertEqual("c", storage.get("a"))
+        self.assertEqual("e", storage.get("d"))
+        self.assertEqual("g", storage.get("f"))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -163,6 +365,23 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(d['seed'], wallet.keystore.get_seed(password))
         self.assertEqual(encrypt_file, wallet.storage.is_encrypted())
 
+    def test_encrypted_sqlite_wallet_is_rejected(self):
+        with self.assertRaises(WalletFileException):
+            create_new_wallet(path=self.wallet_path, password='mypassword', db_type='sqlite')
+        self.assertFalse(os.path.exists(self.wallet_path))
+        text = 'bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw'
+        with self.assertRaises(WalletFileException):
+            restore_wallet_from_text(text, path=self.wallet_path, network=None,
+                                     password='mypassword', db_type='sqlite')
+        self.assertFalse(os.path.exists(self.wallet_path))
+        # without storage encryption, the keystore is still encrypted
+        d = create_new_wallet(path=self.wallet_path, password='mypassword', encrypt_file=False,
+                              db_type='sqlite')
+        wallet = d['wallet']
+        wallet.check_password('mypassword')
+        self.assertFalse(wallet.storage.is_encrypted())
+        self.assertIsInstance(wallet.storage.db, SqliteDB)
+
     def test_restore_wallet_from_text_mnemonic(self):
         text = 'bitter grass shiver impose acquire brush forget axis eager alone wine silver'
         passphrase = 'mypassphrase'
@@ -33,7 +33,7 @@ import sys
 from typing import (Sequence, Union, NamedTuple, Tuple, Optional, Iterable,
                     Callable, List, Dict)
 
-from . import ecc, bitcoin, segwit_addr
+from . import ecc, bitcoin, segwit_addr, signing_pool
 from .util import print_error, profiler, to_bytes, bh2u, bfh
 from .bitcoin import (TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT, hash_160,
                       hash160_to_p2sh, hash160_to_p2pkh, hash_to_segwit_addr,
@@ -388,6 +388,11 @@ def parse_redeemScript_multisig(redeem_script: bytes):
 
 
 def get_address_from_output_script(_bytes: bytes, *, net=None) -> Tuple[int, str]:
+    # fast path for the two standard templates, without decoding the script
+    if len(_bytes) == 25 and _bytes[:3] == b'\x76\xa9\x14' and _bytes[23:] == b'\x88\xac':
+        return TYPE_ADDRESS, hash160_to_p2pkh(bytes(_bytes[3:23]), net=net)
+    if len(_bytes) == 23 and _bytes[:2] == b'\xa9\x14' and _bytes[22] == 0x87:
+        return TYPE_ADDRESS, hash160_to_p2sh(bytes(_bytes[2:22]), net=net)
     try:
         decoded = [x for x in script_GetOp(_bytes)]
     except MalformedBitcoinScript:
@@ -423,33 +428,6 @@ def get_address_from_output_script(_bytes: bytes, *, net=None) -> Tuple[int, str
     return TYPE_SCRIPT, bh2u(_bytes)
 
 
-def parse_input(vds, full_parse: bool):
-    d = {}
-    prevout_hash = hash_encode(vds.read_bytes(32))
-    prevout_n = vds.read_uint32()
-    scriptSig = vds.read_bytes(vds.read_compact_size())
-    sequence = vds.read_uint32()
-    d['prevout_hash'] = prevout_hash
-    d['prevout_n'] = prevout_n
-    d['scriptSig'] = bh2u(scriptSig)
-    d['sequence'] = sequence
-    d['type'] = 'unknown' if prevout_hash != '00'*32 else 'coinbase'
-    d['address'] = None
-    d['num_sig'] = 0
-    if not full_parse:
-        return d
-    d['x_pubkeys'] = []
-    d['pubkeys'] = []
-    d['signatures'] = {}
-    if d['type'] != 'coinbase' and scriptSig:
-        try:
-            parse_scriptSig(d, scriptSig)
-        except BaseException:
-            traceback.print_exc(file=sys.stderr)
-            print_error('failed to parse scriptSig', bh2u(scriptSig))
-    return d
-
-
 def construct_witness(items: Sequence[Union[str, int, bytes]]) -> str:
     """Constructs a witness from the given stack items."""
     witness = var_int(len(items))
@@ -516,55 +494,171 @@ def parse_witness(vds, txin, full_parse: bool):
         print_error('failed to parse witness', txin.get('witness'))
 
 
-def parse_output(vds, i):
-    d = {}
-    d['value'] = vds.read_int64()
-    if d['value'] > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
-        raise SerializationError('invalid output amount (too large)')
-    if d['value'] < 0:
-        raise SerializationError('invalid output amount (negative)')
-    scriptPubKey = vds.read_bytes(vds.read_compact_size())
-    d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
-    d['scriptPubKey'] = bh2u(scriptPubKey)
-    d['prevout_n'] = i
-    return d
+class RawTxParser:
+    """Zero-copy parser over a serialized (network or partial) transaction.
+
+    The constructor makes a single pass over the buffer and only records
+    offsets; inputs, outputs and witnesses are decoded from the underlying
+    memoryview when they are asked for. Callers that only need the
+    outpoints or the outputs of a transaction never build the input dicts.
+    """
+
+    def __init__(self, raw_bytes: bytes):
+        buf = memoryview(raw_bytes)
+        if buf[:5] == PARTIAL_TXN_HEADER_MAGIC:
+            self.is_partial = True
+            partial_format_version = buf[5]
+            if partial_format_version != 0:
+                raise SerializationError('unknown tx partial serialization format version: {}'
+                                         .format(partial_format_version))
+            buf = buf[6:]
+        else:
+            self.is_partial = False
+        self._buf = buf
+        try:
+            self._scan()
+        except (IndexError, struct.error) as e:
+            raise SerializationError("attempt to read past end of buffer") from e
+
+    def _read_compact_size(self, pos: int) -> Tuple[int, int]:
+        size = self._buf[pos]
+        if size < 253:
+            return size, pos + 1
+        if size == 253:
+            return struct.unpack_from('<H', self._buf, pos + 1)[0], pos + 3
+        if size == 254:
+            return struct.unpack_from('<I', self._buf, pos + 1)[0], pos + 5
+        return struct.unpack_from('<Q', self._buf, pos + 1)[0], pos + 9
+
+    def _read_script(self, pos: int) -> Tuple[int, int]:
+        size, start = self._read_compact_size(pos)
+        end = start + size
+        if end > len(self._buf):
+            raise IndexError()
+        return start, end
+
+    def _scan(self):
+        buf = self._buf
+        self.version, = struct.unpack_from('<i', buf, 0)
+        n_vin, pos = self._read_compact_size(4)
+        self.segwit_ser = (n_vin == 0)
+        if self.segwit_ser:
+            marker = bytes(buf[pos:pos+1])
+            if marker != b'\x01':
+                raise ValueError('invalid txn marker byte: {}'.format(marker))
+            n_vin, pos = self._read_compact_size(pos + 1)
+        # (offset of input, scriptSig start, scriptSig end)
+        self._txins = []  # type: List[Tuple[int, int, int]]
+        for i in range(n_vin):
+            start, end = self._read_script(pos + 36)
+            self._txins.append((pos, start, end))
+            pos = end + 4
+        # (value, scriptPubKey start, scriptPubKey end)
+        self._txouts = []  # type: List[Tuple[int, int, int]]
+        n_vout, pos = self._read_compact_size(pos)
+        for i in range(n_vout):
+            value, = struct.unpack_from('<q', buf, pos)
+            if value > TOTAL_COIN_SUPPLY_LIMIT_IN_BTC * COIN:
+                raise SerializationError('invalid output amount (too large)')
+            if value < 0:
+                raise SerializationError('invalid output amount (negative)')
+            start, end = self._read_script(pos + 8)
+            self._txouts.append((value, start, end))
+            pos = end
+        self._witness_pos = pos
+        if self.segwit_ser:
+            # skip over the witnesses; they are parsed by deserialize()
+            for i in range(n_vin):
+                n, pos = self._read_compact_size(pos)
+                if n == 0xffffffff:
+                    n, pos = self._read_compact_size(pos + 10)
+                for j in range(n):
+                    start, pos = self._read_script(pos)
+        self.locktime, = struct.unpack_from('<I', buf, pos)
+        if pos + 4 != len(buf):
+            raise SerializationError('extra junk at the end')
+
+    def num_inputs(self) -> int:
+        return len(self._txins)
+
+    def num_outputs(self) -> int:
+        return len(self._txouts)
+
+    def outpoint(self, i: int) -> Tuple[str, int]:
+        pos = self._txins[i][0]
+        prevout_hash = bytes(self._buf[pos:pos+32][::-1]).hex()
+        prevout_n, = struct.unpack_from('<I', self._buf, pos + 32)
+        return prevout_hash, prevout_n
+
+    def outpoints(self) -> List[Tuple[str, int]]:
+        """(prevout_hash, prevout_n) of every input, coinbase included."""
+        return [self.outpoint(i) for i in range(len(self._txins))]
+
+    def input(self, i: int, full_parse: bool) -> dict:
+        pos, start, end = self._txins[i]
+        prevout_hash, prevout_n = self.outpoint(i)
+        scriptSig = bytes(self._buf[start:end])
+        d = {}
+        d['prevout_hash'] = prevout_hash
+        d['prevout_n'] = prevout_n
+        d['scriptSig'] = bh2u(scriptSig)
+        d['sequence'], = struct.unpack_from('<I', self._buf, end)
+        d['type'] = 'unknown' if prevout_hash != '00'*32 else 'coinbase'
+        d['address'] = None
+        d['num_sig'] = 0
+        if not full_parse:
+            return d
+        d['x_pubkeys'] = []
+        d['pubkeys'] = []
+        d['signatures'] = {}
+        if d['type'] != 'coinbase' and scriptSig:
+            try:
+                parse_scriptSig(d, scriptSig)
+            except BaseException:
+                traceback.print_exc(file=sys.stderr)
+                print_error('failed to parse scriptSig', bh2u(scriptSig))
+        return d
+
+    def output_script(self, i: int) -> bytes:
+        value, start, end = self._txouts[i]
+        return bytes(self._buf[start:end])
+
+    def output(self, i: int) -> TxOutput:
+        value = self._txouts[i][0]
+        _type, addr = get_address_from_output_script(self.output_script(i))
+        return TxOutput(_type, addr, value)
+
+    def outputs(self) -> List[TxOutput]:
+        return [self.output(i) for i in range(len(self._txouts))]
+
+    def output_dict(self, i: int) -> dict:
+        scriptPubKey = self.output_script(i)
+        d = {}
+        d['value'] = self._txouts[i][0]
+        d['type'], d['address'] = get_address_from_output_script(scriptPubKey)
+        d['scriptPubKey'] = bh2u(scriptPubKey)
+        d['prevout_n'] = i
+        return d
+
+    def deserialize(self, force_full_parse=False) -> dict:
+        full_parse = force_full_parse or self.is_partial
+        d = {}
+        d['partial'] = self.is_partial
+        d['version'] = self.version
+        d['segwit_ser'] = self.segwit_ser
+        d['inputs'] = [self.input(i, full_parse) for i in range(len(self._txins))]
+        d['outputs'] = [self.output_dict(i) for i in range(len(self._txouts))]
+        if self.segwit_ser:
+            vds = BCDataStream()
+            vds.write(self._buf[self._witness_pos:])
+            for txin in d['inputs']:
+                parse_witness(vds, txin, full_parse=full_parse)
+        d['lockTime'] = self.locktime
+        return d
 
 
 def deserialize(raw: str, force_full_parse=False) -> dict:
-    raw_bytes = bfh(raw)
-    d = {}
-    if raw_bytes[:5] == PARTIAL_TXN_HEADER_MAGIC:
-        d['partial'] = is_partial = True
-        partial_format_version = raw_bytes[5]
-        if partial_format_version != 0:
-            raise SerializationError('unknown tx partial serialization format version: {}'
-                                     .format(partial_format_version))
-        raw_bytes = raw_bytes[6:]
-    else:
-        d['partial'] = is_partial = False
-    full_parse = force_full_parse or is_partial
-    vds = BCDataStream()
-    vds.write(raw_bytes)
-    d['version'] = vds.read_int32()
-    n_vin = vds.read_compact_size()
-    is_segwit = (n_vin == 0)
-    if is_segwit:
-        marker = vds.read_bytes(1)
-        if marker != b'\x01':
-            raise ValueError('invalid txn marker byte: {}'.format(marker))
-        n_vin = vds.read_compact_size()
-    d['segwit_ser'] = is_segwit
-    d['inputs'] = [parse_input(vds, full_parse=full_parse) for i in range(n_vin)]
-    n_vout = vds.read_compact_size()
-    d['outputs'] = [parse_output(vds, i) for i in range(n_vout)]
-    if is_segwit:
-        for i in range(n_vin):
-            txin = d['inputs'][i]
-            parse_witness(vds, txin, full_parse=full_parse)
-    d['lockTime'] = vds.read_uint32()
-    if vds.can_read_more():
-        raise SerializationError('extra junk at the end')
-    return d
+    return RawTxParser(bfh(raw)).deserialize(force_full_parse)
 
 
 # pay & redeem scripts
@@ -598,6 +692,7 @@ class Transaction:
             raise Exception("cannot initialize transaction", raw)
         self._inputs = None
         self._outputs = None  # type: List[TxOutput]
+        self._raw_parser = None  # type: Optional[RawTxParser]
         self.locktime = 0
         self.version = 1
         # by default we assume this is a partial txn;
@@ -605,12 +700,38 @@ class Transaction:
         self.is_partial_originally = True
         self._segwit_ser = None  # None means "don't know"
         self.output_info = None  # type: Optional[Dict[str, TxOutputHwInfo]]
+        # (version, locktime, network serialization, txid) of a complete tx;
+        # cleared by every method that modifies inputs or outputs
+        self._ser_cache = None  # type: Optional[Tuple[int, int, str, Optional[str]]]
+        # (version, locktime, prefix, blank inputs, suffix) of the legacy
+        # signing preimage, see _get_preimage_parts
+        self._preimage_cache = None  # type: Optional[Tuple[int, int, bytes, bytes, bytes]]
+
+    def _invalidate_ser_cache(self):
+        self._ser_cache = None
+        self._preimage_cache = None
+
+    def _get_ser_cache(self):
+        c = self._ser_cache
+        if c is not None and c[0] == self.version and c[1] == self.locktime:
+            return c
+        return None
 
     def update(self, raw):
         self.raw = raw
         self._inputs = None
+        self._outputs = None
+        self._raw_parser = None
+        self._invalidate_ser_cache()
         self.deserialize()
 
+    def _get_raw_parser(self) -> Optional[RawTxParser]:
+        if self._raw_parser is None and self.raw is not None:
+            self._raw_parser = parser = RawTxParser(bfh(self.raw))
+            self.locktime = parser.locktime
+            self.version = parser.version
+        return self._raw_parser
+
     def inputs(self):
         if self._inputs is None:
             self.deserialize()
@@ -618,9 +739,30 @@ class Transaction:
 
     def outputs(self) -> List[TxOutput]:
         if self._outputs is None:
-            self.deserialize()
+            # outputs can be decoded without building the input dicts
+            parser = self._get_raw_parser()
+            if parser is not None:
+                self._outputs = parser.outputs()
         return self._outputs
 
+    def outpoints(self) -> List[Tuple[str, int]]:
+        """(prevout_hash, prevout_n) of every input, coinbase included.
+        Does not deserialize the inputs if they have not been yet.
+        """
+        if self._inputs is None:
+            parser = self._get_raw_parser()
+            if parser is not None:
+                return parser.outpoints()
+        return [(txin['prevout_hash'], txin['prevout_n']) for txin in self.inputs()]
+
+    def is_coinbase(self) -> bool:
+        if self._inputs is None:
+            parser = self._get_raw_parser()
+            if parser is not None:
+                return parser.num_inputs() > 0 and parser.outpoint(0)[0] == '00'*32
+        inputs = self.inputs()
+        return bool(inputs) and inputs[0]['type'] == 'coinbase'
+
     @classmethod
     def get_sorted_pubkeys(self, txin):
         # sort pubkeys and x_pubkeys, using the order of pubkeys
@@ -651,7 +793,7 @@ class Transaction:
             sig = signatures[i]
             if sig in txin.get('signatures'):
                 continue
-            pre_hash = sha256d(bfh(self.serialize_preimage(i)))
+            pre_hash = self.preimage_hash(i)
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
             for recid in range(4):
                 try:
@@ -679,16 +821,20 @@ class Transaction:
         txin['scriptSig'] = None  # force re-serialization
         txin['witness'] = None    # force re-serialization
         self.raw = None
+        # scriptSigs are blanked in the signing preimage, keep that cache
+        self._ser_cache = None
 
     def add_inputs_info(self, wallet):
         if self.is_complete():
             return
+        self._invalidate_ser_cache()
         for txin in self.inputs():
             wallet.add_input_info(txin)
 
     def remove_signatures(self):
         for txin in self.inputs():
             txin['signatures'] = [None] * len(txin['signatures'])
+        self._ser_cache = None
         assert not self.is_complete()
 
     def deserialize(self, force_full_parse=False):
@@ -697,14 +843,16 @@ class Transaction:
             #self.raw = self.serialize()
         if self._inputs is not None:
             return
-        d = deserialize(self.raw, force_full_parse)
+        d = self._get_raw_parser().deserialize(force_full_parse)
+        self._raw_parser = None  # everything is decoded now
         self._inputs = d['inputs']
-        self._outputs = [TxOutput(x['type'], x['address'], x['value']) for x in d['outputs']]
+        if self._outputs is None:
+            self._outputs = [TxOutput(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
         self.version = d['version']
         #self.is_partial_originally = d['partial']
         #self._segwit_ser = d['segwit_ser']
-        print_error("deserialized " + str(d))
+        print_error("deserialized", d)
         return d
 
     @classmethod
@@ -947,8 +1095,11 @@ class Transaction:
         nSequence = 0xffffffff - (2 if rbf else 1)
         for txin in self.inputs():
             txin['sequence'] = nSequence
+        self._invalidate_ser_cache()
 
     def BIP69_sort(self, inputs=True, outputs=True):
+        self.deserialize()
+        self._invalidate_ser_cache()
         if inputs:
             self._inputs.sort(key = lambda i: (i['prevout_hash'], i['prevout_n']))
         if outputs:
@@ -981,11 +1132,39 @@ class Transaction:
             nSequence = int_to_hex(txin.get('sequence', 0xffffffff - 1), 4)
             preimage = nVersion + hashPrevouts + hashSequence + outpoint + scriptCode + amount + nSequence + hashOutputs + nLocktime + nHashType
         else:
-            txins = var_int(len(inputs)) + ''.join(self.serialize_input(txin, self.get_preimage_script(txin) if i==k else '') for k, txin in enumerate(inputs))
-            txouts = var_int(len(outputs)) + ''.join(self.serialize_output(o) for o in outputs)
-            preimage = nVersion + txins + txouts + nLocktime + nHashType
+            preimage = bh2u(self._serialize_legacy_preimage(i))
         return preimage
 
+    def _get_preimage_parts(self) -> Tuple[bytes, bytes, bytes]:
+        """Parts of the legacy signing preimage shared by all inputs:
+        version and input count, every input with an empty scriptSig,
+        and outputs, locktime and hash type.
+        """
+        c = self._preimage_cache
+        if c is None or c[0] != self.version or c[1] != self.locktime:
+            inputs = self.inputs()
+            outputs = self.outputs()
+            prefix = bfh(int_to_hex(self.version, 4) + var_int(len(inputs)))
+            blank_inputs = bfh(''.join(self.serialize_input(txin, '') for txin in inputs))
+            suffix = bfh(var_int(len(outputs))
+                         + ''.join(self.serialize_output(o) for o in outputs)
+                         + int_to_hex(self.locktime, 4) + int_to_hex(1, 4))
+            c = self._preimage_cache = (self.version, self.locktime, prefix, blank_inputs, suffix)
+        return c[2], c[3], c[4]
+
+    def _serialize_legacy_preimage(self, i) -> bytes:
+        prefix, blank_inputs, suffix = self._get_preimage_parts()
+        txin = self.inputs()[i]
+        # a blank input is outpoint (36) + empty script (1) + sequence (4)
+        start = 41 * i
+        txin_ser = bfh(self.serialize_input(txin, self.get_preimage_script(txin)))
+        return prefix + blank_inputs[:start] + txin_ser + blank_inputs[start+41:] + suffix
+
+    def preimage_hash(self, i) -> bytes:
+        if self.is_segwit_input(self.inputs()[i]):
+            return sha256d(bfh(self.serialize_preimage(i)))
+        return sha256d(self._serialize_legacy_preimage(i))
+
     def is_segwit(self, guess_for_address=False):
         if not self.is_partial_originally:
             return self._segwit_ser
@@ -1003,8 +1182,12 @@ class Transaction:
 
     def serialize_to_network(self, estimate_size=False, witness=False):
         self.deserialize()
+        if not estimate_size:
+            cache = self._get_ser_cache()
+            if cache is not None:
+                return cache[2]
         nVersion = int_to_hex(self.version, 4)
-        print_error("version " + nVersion)
+        print_error("version", nVersion)
         nLocktime = int_to_hex(self.locktime, 4)
         inputs = self.inputs()
         outputs = self.outputs()
@@ -1020,16 +1203,36 @@ class Transaction:
         #    witness = ''.join(self.serialize_witness(x, estimate_size) for x in inputs)
         #    return nVersion + marker + flag + txins + txouts + witness + nLocktime
         #else:
-        print_error("TX ser: " + nVersion + txins + txouts + nLocktime)
-        return nVersion + txins + txouts + nLocktime
+        ser = nVersion + txins + txouts + nLocktime
+        print_error("TX ser:", ser)
+        if not estimate_size and self.is_complete():
+            self._ser_cache = (self.version, self.locktime, ser, None)
+        return ser
 
     def txid(self):
+        if self._inputs is None:
+            # a complete network serialized tx is hashed as it is
+            parser = self._get_raw_parser()
+            if (parser is not None and not parser.is_partial and not parser.segwit_ser
+                    and (self.version, self.locktime) == (parser.version, parser.locktime)):
+                cache = self._get_ser_cache()
+                if cache is None or cache[3] is None:
+                    txid = bh2u(sha256d(bfh(self.raw))[::-1])
+                    self._ser_cache = cache = (self.version, self.locktime, self.raw, txid)
+                return cache[3]
         self.deserialize()
+        cache = self._get_ser_cache()
+        if cache is not None and cache[3] is not None:
+            return cache[3]
         all_segwit = all(self.is_segwit_input(x) for x in self.inputs())
         if not all_segwit and not self.is_complete():
             return None
         ser = self.serialize_to_network(witness=False)
-        return bh2u(sha256d(bfh(ser))[::-1])
+        txid = bh2u(sha256d(bfh(ser))[::-1])
+        cache = self._get_ser_cache()
+        if cache is not None:
+            self._ser_cache = cache[:3] + (txid,)
+        return txid
 
     def wtxid(self):
         self.deserialize()
@@ -1039,14 +1242,16 @@ class Transaction:
         return bh2u(sha256d(bfh(ser))[::-1])
 
     def add_inputs(self, inputs):
+        self.deserialize()
         self._inputs.extend(inputs)
         self.raw = None
-        self.BIP69_sort(outputs=False)
+        self.BIP69_sort(outputs=False)  # also invalidates the serialization cache
 
     def add_outputs(self, outputs):
+        self.deserialize()
         self._outputs.extend(outputs)
         self.raw = None
-        self.BIP69_sort(inputs=False)
+        self.BIP69_sort(inputs=False)  # also invalidates the serialization cache
 
     def input_value(self):
         return sum(x['value'] for x in self.inputs())
@@ -1130,15 +1335,28 @@ class Transaction:
         return s, r
 
     def is_complete(self):
+        if self._inputs is None:
+            # the inputs of a network serialized tx are only parsed for
+            # signatures by a full parse; without one it counts as complete
+            parser = self._get_raw_parser()
+            if parser is not None and not parser.is_partial:
+                return True
         s, r = self.signature_count()
         return r == s
 
-    def sign(self, keypairs) -> None:
-        # keypairs:  (x_)pubkey -> secret_bytes
+    def _get_signing_jobs(self, keypairs) -> List[Tuple[int, int, str]]:
+        """Returns (input index, signing position, key of keypairs) for
+        every signature that can be added with keypairs.
+        """
+        jobs = []
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            if self.is_txin_complete(txin):
+                continue
+            signatures = txin['signatures']
+            missing = txin.get('num_sig', 1) - len(list(filter(None, signatures)))
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
-                if self.is_txin_complete(txin):
+                if missing <= 0:
                     break
                 if pubkey in keypairs:
                     _pubkey = pubkey
@@ -1146,16 +1364,37 @@ class Transaction:
                     _pubkey = x_pubkey
                 else:
                     continue
+                jobs.append((i, j, _pubkey))
+                if not signatures[j]:
+                    missing -= 1
+        return jobs
+
+    def sign(self, keypairs) -> None:
+        # keypairs:  (x_)pubkey -> secret_bytes
+        jobs = self._get_signing_jobs(keypairs)
+        pool = signing_pool.get_signing_pool()
+        sigs = None
+        if pool is not None and len(jobs) >= pool.min_signatures:
+            print_error("signing {} inputs with {} workers".format(len(jobs), pool.num_workers))
+            try:
+                sigs = pool.sign_hashes([(self.preimage_hash(i), keypairs[_pubkey][0])
+                                         for i, j, _pubkey in jobs])
+            except Exception as e:
+                print_error("signing pool failed, signing serially:", repr(e))
+        if sigs is None:
+            sigs = []
+            for i, j, _pubkey in jobs:
                 print_error("adding signature for", _pubkey)
                 sec, compressed = keypairs.get(_pubkey)
-                sig = self.sign_txin(i, sec)
-                self.add_signature_to_txin(i, j, sig)
+                sigs.append(self.sign_txin(i, sec))
+        for (i, j, _pubkey), sig in zip(jobs, sigs):
+            self.add_signature_to_txin(i, j, sig)
 
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
     def sign_txin(self, txin_index, privkey_bytes) -> str:
-        pre_hash = sha256d(bfh(self.serialize_preimage(txin_index)))
+        pre_hash = self.preimage_hash(txin_index)
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = bh2u(sig) + '01'
@@ -23,7 +23,7 @@
 import binascii
 import os, sys, re, json
 from collections import defaultdict, OrderedDict
-from typing import NamedTuple, Union, TYPE_CHECKING, Tuple, Optional, Callable
+from typing import NamedTuple, Union, TYPE_CHECKING, Tuple, Optional, Callable, Dict
 from datetime import datetime
 import decimal
 from decimal import Decimal
@@ -47,6 +47,7 @@ from aiorpcx import TaskGroup
 import certifi
 
 from .i18n import _
+from . import metrics
 
 if TYPE_CHECKING:
     from .network import Network
@@ -361,7 +362,10 @@ def profiler(func):
         t0 = time.time()
         o = func(*args, **kw_args)
         t = time.time() - t0
-        print_error("[profiler]", name, "%.4f"%t)
+        if metrics.is_enabled():
+            metrics.observe('profiler_seconds', t, function=name)
+        else:
+            print_error("[profiler]", name, "%.4f"%t)
         return o
     return lambda *args, **kw_args: do_profile(args, kw_args)
 
@@ -885,17 +889,24 @@ class TxMinedInfo(NamedTuple):
     header_hash: Optional[str] = None  # hash of block that mined tx
 
 
-def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None):
-    if headers is None:
-        headers = {'User-Agent': 'ElectrumFairChains'}
-    if timeout is None:
-        timeout = aiohttp.ClientTimeout(total=10)
-    elif isinstance(timeout, (int, float)):
-        timeout = aiohttp.ClientTimeout(total=timeout)
-    ssl_context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_path)
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+
+
+def get_ssl_context() -> ssl.SSLContext:
+    """Returns the SSL context for http requests. The CA bundle is
+    only parsed once."""
+    global _ssl_context
+    with _ssl_context_lock:
+        if _ssl_context is None:
+            _ssl_context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_path)
+        return _ssl_context
+
 
+def make_aiohttp_connector(proxy: Optional[dict]):
+    ssl_context = get_ssl_context()
     if proxy:
-        connector = SocksConnector(
+        return SocksConnector(
             socks_ver=SocksVer.SOCKS5 if proxy['mode'] == 'socks5' else SocksVer.SOCKS4,
             host=proxy['host'],
             port=int(proxy['port']),
@@ -905,9 +916,131 @@ def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None):
             ssl=ssl_context,
         )
     else:
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
+        return aiohttp.TCPConnector(ssl=ssl_context)
+
+
+class HttpHostStats:
+    """Counters of the http requests made to one host."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add_latency(self, latency: float):
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        answered = self.requests - self.errors
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'avg_latency': self.total_latency / answered if answered > 0 else None,
+            'max_latency': self.max_latency,
+        }
+
+
+class AiohttpSessionPool(PrintError):
+    """Long-lived aiohttp sessions shared by the whole process, so that
+    connections are kept alive between requests. There is one session
+    per event loop, proxy and set of default headers and timeout.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}  # type: Dict[tuple, aiohttp.ClientSession]
+        self.host_stats = defaultdict(HttpHostStats)  # type: Dict[str, HttpHostStats]
+        self.trace_config = self._make_trace_config()
+
+    def _make_trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_start(session, ctx, params):
+            ctx.stats = self.host_stats[params.url.host]
+            ctx.stats.requests += 1
+            ctx.start_time = time.monotonic()
+        async def on_request_end(session, ctx, params):
+            ctx.stats.add_latency(time.monotonic() - ctx.start_time)
+        async def on_request_exception(session, ctx, params):
+            ctx.stats.errors += 1
+        async def on_connection_create_end(session, ctx, params):
+            ctx.stats.connections_created += 1
+        async def on_connection_reuseconn(session, ctx, params):
+            ctx.stats.connections_reused += 1
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def get_session(self, proxy: Optional[dict], headers: dict,
+                    timeout: aiohttp.ClientTimeout) -> aiohttp.ClientSession:
+        """Must be called from the event loop the session is used on."""
+        loop = asyncio.get_event_loop()
+        key = (loop,
+               tuple(sorted(proxy.items())) if proxy else None,
+               tuple(sorted(headers.items())),
+               timeout)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or session.closed:
+                session = aiohttp.ClientSession(headers=headers, timeout=timeout,
+                                                connector=make_aiohttp_connector(proxy),
+                                                trace_configs=[self.trace_config])
+                self.sessions[key] = session
+            return session
+
+    def reset(self) -> list:
+        """Closes all sessions, e.g. after the proxy has changed.
+        New sessions are created on demand. Returns the futures of
+        the closing sessions."""
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+        futures = []
+        for key, session in sessions.items():
+            loop = key[0]
+            if not loop.is_closed():
+                futures.append(asyncio.run_coroutine_threadsafe(session.close(), loop))
+        return futures
+
+    def get_host_stats(self) -> Dict[str, dict]:
+        return {host: stats.as_dict() for host, stats in list(self.host_stats.items())}
+
+
+http_session_pool = AiohttpSessionPool()
+
+
+class _PooledSession:
+
+    def __init__(self, proxy, headers, timeout):
+        self.proxy = proxy
+        self.headers = headers
+        self.timeout = timeout
+
+    async def __aenter__(self) -> aiohttp.ClientSession:
+        return http_session_pool.get_session(self.proxy, self.headers, self.timeout)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # the session is kept open for the next request
+        pass
+
 
-    return aiohttp.ClientSession(headers=headers, timeout=timeout, connector=connector)
+def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None):
+    """Returns an async context manager that yields a pooled session.
+    The session is not closed on exit."""
+    if headers is None:
+        headers = {'User-Agent': 'ElectrumFairChains'}
+    if timeout is None:
+        timeout = aiohttp.ClientTimeout(total=10)
+    elif isinstance(timeout, (int, float)):
+        timeout = aiohttp.ClientTimeout(total=timeout)
+    return _PooledSession(proxy, headers, timeout)
 
 
 class SilentTaskGroup(TaskGroup):
@@ -22,11 +22,13 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+from collections import defaultdict
+from typing import Sequence, Optional, Dict, List, Tuple, TYPE_CHECKING
 
 import aiorpcx
 
 from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer
+from . import metrics
 from .crypto import sha256d
 from .bitcoin import hash_decode, hash_encode
 from .transaction import Transaction
@@ -57,6 +59,7 @@ class SPV(NetworkJobOnDefaultServer):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self._server_supports_batches = True
 
     async def _start_tasks(self):
         async with self.group as group:
@@ -76,6 +79,8 @@ class SPV(NetworkJobOnDefaultServer):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
 
+        to_request = []
+        header_available = {}  # height -> bool
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -84,64 +89,100 @@ class SPV(NetworkJobOnDefaultServer):
             if tx_height <= 0 or tx_height > local_height:
                 continue
             # if it's in the checkpoint region, we still might not have the header
-            header = self.blockchain.read_header(tx_height)
-            if header is None:
+            if tx_height not in header_available:
+                header_available[tx_height] = self.blockchain.read_header(tx_height) is not None
                 # if tx_height < constants.net.max_checkpoint():
-                if tx_height < 0:
+                if not header_available[tx_height] and tx_height < 0:
                     await self.group.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+            if not header_available[tx_height]:
                 continue
-            # request now
-            self.print_error('requested merkle', tx_hash)
-            self.requested_merkle.add(tx_hash)
-            await self.group.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            to_request.append((tx_hash, tx_height))
+        if not to_request:
+            return
+        # request now; in batches of txs at close heights
+        to_request.sort(key=lambda x: x[1])
+        batch_size = max(1, self.network.config.get('spv_batch_size', 50))
+        for i in range(0, len(to_request), batch_size):
+            batch = to_request[i:i+batch_size]
+            self.print_error('requested merkle for {} txs at heights {}-{}'
+                             .format(len(batch), batch[0][1], batch[-1][1]))
+            self.requested_merkle.update(tx_hash for tx_hash, _ in batch)
+            await self.group.spawn(self._request_and_verify_proofs, batch)
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.print_error('tx {} not at height {}'.format(tx_hash, tx_height))
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            try: self.requested_merkle.remove(tx_hash)
-            except KeyError: pass
+    async def _get_merkles(self, txs):
+        if len(txs) > 1 and self._server_supports_batches:
+            try:
+                return await self.network.get_merkles_for_transactions(txs)
+            except UntrustedServerReturnedError as e:
+                if not isinstance(e.original_exception, aiorpcx.jsonrpc.ProtocolError):
+                    raise
+                self.print_error("server rejected batch request, requesting one by one:", repr(e))
+                self._server_supports_batches = False
+        results = []
+        for tx_hash, tx_height in txs:
+            try:
+                results.append(await self.network.get_merkle_for_transaction(tx_hash, tx_height))
+            except UntrustedServerReturnedError as e:
+                results.append(e)
+        return results
+
+    async def _request_and_verify_proofs(self, txs):
+        merkles = await self._get_merkles(txs)
+        proofs = []
+        for (tx_hash, tx_height), merkle in zip(txs, merkles):
+            if isinstance(merkle, UntrustedServerReturnedError):
+                if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                    raise merkle
+                self.print_error('tx {} not at height {}'.format(tx_hash, tx_height))
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                self.requested_merkle.discard(tx_hash)
+                continue
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            if tx_height != merkle.get('block_height'):
+                self.print_error('requested tx_height {} differs from received tx_height {} for txid {}'
+                                 .format(tx_height, merkle.get('block_height'), tx_hash))
+            proofs.append((tx_hash, merkle.get('block_height'), merkle.get('pos'), merkle.get('merkle')))
+        if not proofs:
             return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        if tx_height != merkle.get('block_height'):
-            self.print_error('requested tx_height {} differs from received tx_height {} for txid {}'
-                             .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
         # we need to wait if header sync/reorg is still ongoing, hence lock:
         async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.print_error("skipping merkle proof check %s" % tx_hash)
-            else:
-                self.print_error(str(e))
-                raise GracefulDisconnect(e)
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = header.get('merkle_root')
-        try: self.requested_merkle.remove(tx_hash)
-        except KeyError: pass
-        self.print_error("verified %s" % tx_hash)
-        header_hash = hash_header(header)
-        tx_info = TxMinedInfo(height=tx_height,
-                              timestamp=header.get('timestamp'),
-                              txpos=pos,
-                              header_hash=header_hash)
-        self.wallet.add_verified_tx(tx_hash, tx_info)
+            blockchain = self.network.blockchain()
+            headers = {}
+            for tx_hash, tx_height, pos, merkle_branch in proofs:
+                if tx_height not in headers:
+                    headers[tx_height] = blockchain.read_header(tx_height)
+        with metrics.timer('spv_verify_seconds'):
+            errors = await aiorpcx.run_in_thread(verify_txs_are_in_blocks, proofs, headers)
+        metrics.inc('spv_proofs_checked_total', len(proofs))
+        for (tx_hash, tx_height, pos, merkle_branch), e in zip(proofs, errors):
+            if e is not None:
+                if self.network.config.get("skipmerklecheck"):
+                    self.print_error("skipping merkle proof check %s" % tx_hash)
+                else:
+                    self.print_error(str(e))
+                    raise GracefulDisconnect(e)
+            header = headers[tx_height]
+            # we passed all the tests
+            self.merkle_roots[tx_hash] = header.get('merkle_root')
+            self.requested_merkle.discard(tx_hash)
+            self.print_error("verified %s" % tx_hash)
+            header_hash = hash_header(header)
+            tx_info = TxMinedInfo(height=tx_height,
+                                  timestamp=header.get('timestamp'),
+                                  txpos=pos,
+                                  header_hash=header_hash)
+            self.wallet.add_verified_tx(tx_hash, tx_info)
         #if self.is_up_to_date() and self.wallet.is_up_to_date():
         #    self.wallet.save_verified_tx(write=True)
 
     @classmethod
-    def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
-        """Return calculated merkle root."""
+    def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int,
+                         *, node_cache: Dict[bytes, bytes] = None):
+        """Return calculated merkle root.
+        node_cache maps the concatenated children of checked inner nodes
+        of one block to their hash; proofs in the same block share them.
+        """
         try:
             h = hash_decode(tx_hash)
             merkle_branch_bytes = [hash_decode(item) for item in merkle_branch]
@@ -150,8 +191,14 @@ class SPV(NetworkJobOnDefaultServer):
             raise MerkleVerificationFailure(e)
 
         for i, item in enumerate(merkle_branch_bytes):
-            h = sha256d(item + h) if ((leaf_pos_in_tree >> i) & 1) else sha256d(h + item)
-            cls._raise_if_valid_tx(bh2u(h))
+            children = item + h if ((leaf_pos_in_tree >> i) & 1) else h + item
+            parent = node_cache.get(children) if node_cache is not None else None
+            if parent is None:
+                parent = sha256d(children)
+                cls._raise_if_valid_tx(bh2u(parent))
+                if node_cache is not None:
+                    node_cache[children] = parent
+            h = parent
         return hash_encode(h)
 
     @classmethod
@@ -182,10 +229,7 @@ class SPV(NetworkJobOnDefaultServer):
 
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
-        try:
-            self.requested_merkle.remove(tx_hash)
-        except KeyError:
-            pass
+        self.requested_merkle.discard(tx_hash)
 
     def is_up_to_date(self):
         return not self.requested_merkle
@@ -193,12 +237,31 @@ class SPV(NetworkJobOnDefaultServer):
 
 def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
                           leaf_pos_in_tree: int, block_header: Optional[dict],
-                          block_height: int) -> None:
+                          block_height: int, *, node_cache: Dict[bytes, bytes] = None) -> None:
     """Raise MerkleVerificationFailure if verification fails."""
     if not block_header:
         raise MissingBlockHeader("merkle verification failed for {} (missing header {})"
                                  .format(tx_hash, block_height))
-    calc_merkle_root = SPV.hash_merkle_root(merkle_branch, tx_hash, leaf_pos_in_tree)
+    calc_merkle_root = SPV.hash_merkle_root(merkle_branch, tx_hash, leaf_pos_in_tree,
+                                            node_cache=node_cache)
     if block_header.get('merkle_root') != calc_merkle_root:
         raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
             tx_hash, block_header.get('merkle_root'), calc_merkle_root))
+
+
+def verify_txs_are_in_blocks(proofs: Sequence[Tuple[str, int, int, Sequence[str]]],
+                             headers: Dict[int, Optional[dict]]) -> List[Optional[MerkleVerificationFailure]]:
+    """Verify (tx_hash, block_height, pos, merkle_branch) proofs against
+    the headers by height. Returns the failure of each proof, or None.
+    """
+    node_caches = defaultdict(dict)  # block_height -> node cache
+    errors = []
+    for tx_hash, block_height, pos, merkle_branch in proofs:
+        try:
+            verify_tx_is_in_block(tx_hash, merkle_branch, pos, headers.get(block_height), block_height,
+                                  node_cache=node_caches[block_height])
+        except MerkleVerificationFailure as e:
+            errors.append(e)
+        else:
+            errors.append(None)
+    return errors
@@ -64,6 +64,7 @@ from .contacts import Contacts
 from .interface import RequestTimedOut
 from .ecc_fast import is_using_fast_ecc
 from .mnemonic import Mnemonic
+from .simple_config import FairChains
 
 if TYPE_CHECKING:
     from .network import Network
@@ -204,16 +205,18 @@ class Abstract_Wallet(AddressSynchronizer):
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
         self.labels                = storage.get('labels', {})
-        self.frozen_addresses      = set(storage.get('frozen_addresses', []))
-        self.frozen_coins          = set(storage.get('frozen_coins', []))  # set of txid:vout strings
+        self.frozen_addresses      = set(storage.get_readonly('frozen_addresses', []))
+        self.frozen_coins          = set(storage.get_readonly('frozen_coins', []))  # set of txid:vout strings
         self.fiat_value            = storage.get('fiat_value', {})
         self.receive_requests      = storage.get('payment_requests', {})
 
         self.calc_unused_change_addresses()
 
-        # save wallet type the first time
+        # save wallet type and FairChain the first time
         if self.storage.get('wallet_type') is None:
             self.storage.put('wallet_type', self.wallet_type)
+        if self.storage.get('fairchain') is None:
+            self.storage.put('fairchain', FairChains.FAIRCHAIN)
 
         # invoices and contacts
         self.invoices = InvoiceStore(self.storage)
@@ -1345,7 +1348,7 @@ class Imported_Wallet(Simple_Wallet):
         return bool(self.keystore)
 
     def load_keystore(self):
-        self.keystore = load_keystore(self.storage, 'keystore') if self.storage.get('keystore') else None
+        self.keystore = load_keystore(self.storage, 'keystore') if self.storage.get_readonly('keystore') else None
         # fixme: a reference to addresses is needed
         if self.keystore:
             self.keystore.addresses = self.db.imported_addresses
@@ -1608,27 +1611,39 @@ class Deterministic_Wallet(Abstract_Wallet):
         x = self.derive_pubkeys(for_change, n)
         return self.pubkeys_to_address(x)
 
+    def derive_addresses(self, for_change, start, count):
+        return [self.pubkeys_to_address(x)
+                for x in self.derive_pubkeys_range(for_change, start, count)]
+
     def create_new_address(self, for_change=False):
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, count):
         assert type(for_change) is bool
         with self.lock:
             n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            address = self.derive_address(for_change, n)
-            self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
-            self.add_address(address)
-            if for_change:
-                # note: if it's actually used, it will get filtered later
-                self._unused_change_addresses.append(address)
-            return address
+            addresses = self.derive_addresses(for_change, n, count)
+            for address in addresses:
+                self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
+                self.add_address(address)
+                if for_change:
+                    # note: if it's actually used, it will get filtered later
+                    self._unused_change_addresses.append(address)
+            return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
             if len(addresses) < limit:
-                self.create_new_address(for_change)
+                self.create_new_addresses(for_change, limit - len(addresses))
                 continue
-            if any(map(self.address_is_old, addresses[-limit:])):
-                self.create_new_address(for_change)
+            # the last `limit` addresses must all be unused; extend the
+            # sequence past the newest old address in one batch
+            window = addresses[-limit:]
+            old = [i for i, addr in enumerate(window) if self.address_is_old(addr)]
+            if old:
+                self.create_new_addresses(for_change, old[-1] + 1)
             else:
                 break
 
@@ -1698,6 +1713,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_range(self, c, start, count):
+        return self.keystore.derive_pubkeys(c, start, count)
+
 
 
 
@@ -1741,6 +1759,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_range(self, c, start, count):
+        pubkeys = [k.derive_pubkeys(c, start, count) for k in self.get_keystores()]
+        return [list(x) for x in zip(*pubkeys)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -1848,9 +1870,18 @@ class Wallet(object):
         raise WalletFileException("Unknown wallet type: " + str(wallet_type))
 
 
-def create_new_wallet(*, path, passphrase=None, password=None, encrypt_file=True, segwit=True):
+def check_storage_encryption(db_type, password, encrypt_file):
+    """Raises before a wallet file is created with storage encryption
+    its format does not support."""
+    if db_type == 'sqlite' and password and encrypt_file:
+        raise WalletFileException('storage encryption is not supported for sqlite wallets; '
+                                  'set encrypt_file to false, or use the json format')
+
+
+def create_new_wallet(*, path, passphrase=None, password=None, encrypt_file=True, segwit=True, db_type='json'):
     """Create a new wallet"""
-    storage = WalletStorage(path)
+    check_storage_encryption(db_type, password, encrypt_file)
+    storage = WalletStorage(path, db_type=db_type)
     if storage.file_exists():
         raise Exception("Remove the existing wallet first!")
 
@@ -1868,11 +1899,13 @@ def create_new_wallet(*, path, passphrase=None, password=None, encrypt_file=True
     return {'seed': seed, 'wallet': wallet, 'msg': msg}
 
 
-def restore_wallet_from_text(text, *, path, network, passphrase=None, password=None, encrypt_file=True):
+def restore_wallet_from_text(text, *, path, network, passphrase=None, password=None, encrypt_file=True,
+                             db_type='json'):
     """Restore a wallet from text. Text can be a seed phrase, a master
     public key, a master private key, a list of bitcoin addresses
     or bitcoin private keys."""
-    storage = WalletStorage(path)
+    check_storage_encryption(db_type, password, encrypt_file)
+    storage = WalletStorage(path, db_type=db_type)
     if storage.file_exists():
         raise Exception("Remove the existing wallet first!")
 